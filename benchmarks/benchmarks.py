@@ -0,0 +1,167 @@
+'''
+Benchmarks of the stages of the pipeline on synthetic videos, written for
+airspeed velocity (asv, see asv.conf.json). Every class times one stage
+over a grid of parameters, so that asv tracks both regressions between
+commits and how each stage scales with frames, resolution, cells and
+components.
+'''
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from ornet.track_cells import track_cells
+from ornet.median_normalization import median_normalize
+from ornet.extract_cells import extract_cells, PADDING
+from ornet.cells_to_gray import vid_to_gray
+from ornet.gmm.run_gmm import run_gmm, skl_gmm
+from ornet.gmm.image import img_to_px
+from ornet.affinityfunc import get_all_aff_tables
+
+from .synthetic import synthetic_video, write_dataset
+
+
+class VideoStage:
+    '''
+    Base of the benchmarks of the stages that read a whole video, which
+    write a synthetic video and its mask for every combination of
+    parameters.
+    '''
+    params = ([10, 40], [256, 512], [1, 4])
+    param_names = ['frames', 'resolution', 'cells']
+    number = 1
+    timeout = 300
+
+    def setup(self, frames, resolution, cells):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.vid_path, self.mask_path = write_dataset(
+            self.tmp_dir, n_frames=frames, shape=(resolution, resolution),
+            n_cells=cells)
+        self.out_path = os.path.join(self.tmp_dir, 'outputs')
+        os.makedirs(self.out_path)
+
+    def teardown(self, frames, resolution, cells):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class TrackCells(VideoStage):
+
+    def time_track_cells(self, frames, resolution, cells):
+        track_cells(self.vid_path, self.mask_path,
+                    out_path=os.path.join(self.out_path, 'masks.npy'))
+
+    def time_track_labels(self, frames, resolution, cells):
+        track_cells(self.vid_path, self.mask_path,
+                    out_path=os.path.join(self.out_path, 'masks.npy'),
+                    label_image=True)
+
+
+class MedianNormalize(VideoStage):
+
+    def time_median_normalize(self, frames, resolution, cells):
+        median_normalize('normalized', self.vid_path, self.out_path)
+
+    def time_buffered_median_normalize(self, frames, resolution, cells):
+        median_normalize('normalized', self.vid_path, self.out_path,
+                         buffered=True)
+
+
+class ExtractCells(VideoStage):
+
+    def setup(self, frames, resolution, cells):
+        super().setup(frames, resolution, cells)
+        self.masks_path = os.path.join(self.tmp_dir, 'masks.npy')
+        track_cells(self.vid_path, self.mask_path, out_path=self.masks_path)
+        self.gray_path = os.path.join(self.tmp_dir, 'gray')
+        os.makedirs(self.gray_path)
+
+    def time_extract_cells(self, frames, resolution, cells):
+        extract_cells(self.vid_path, self.masks_path, self.out_path,
+                      padding=PADDING, gray_path=self.gray_path)
+
+
+class VidToGray(VideoStage):
+
+    def time_vid_to_gray(self, frames, resolution, cells):
+        vid_to_gray(self.vid_path, self.out_path, progress=False)
+
+
+class SklGmm:
+    '''
+    The GMM fit to the video of a single cell.
+    '''
+    params = ([10, 40], [4, 12], [False, True])
+    param_names = ['frames', 'components', 'weighted']
+    number = 1
+    timeout = 600
+
+    def setup(self, frames, components, weighted):
+        self.vid, _ = synthetic_video(frames, (128, 128), 1, components)
+
+    def time_skl_gmm(self, frames, components, weighted):
+        skl_gmm(self.vid, weighted=weighted)
+
+    def peakmem_skl_gmm(self, frames, components, weighted):
+        skl_gmm(self.vid, weighted=weighted)
+
+
+class RunGmm:
+    '''
+    The EM of run_gmm against skl_gmm, on the pixel-replicated and on the
+    intensity-weighted pixels, fit to the same video of a single cell.
+    '''
+    params = ([10, 40], [4, 12], ['run_gmm', 'skl_gmm', 'skl_gmm weighted'])
+    param_names = ['frames', 'components', 'fit']
+    number = 1
+    timeout = 600
+
+    def setup(self, frames, components, fit):
+        self.vid, _ = synthetic_video(frames, (128, 128), 1, components)
+
+    def time_fit(self, frames, components, fit):
+        if fit == 'run_gmm':
+            run_gmm(self.vid)
+        else:
+            skl_gmm(self.vid, weighted=fit == 'skl_gmm weighted')
+
+
+class ImgToPx:
+    '''
+    The conversion of a frame to the samples the GMM is fit on.
+    '''
+    params = [64, 128, 256, 512]
+    param_names = ['resolution']
+
+    def setup(self, resolution):
+        frames, _ = synthetic_video(1, (resolution, resolution),
+                                    max(1, (resolution // 128) ** 2))
+        self.image = frames[0]
+
+    def time_img_to_px(self, resolution):
+        img_to_px(self.image)
+
+    def peakmem_img_to_px(self, resolution):
+        img_to_px(self.image)
+
+
+class AffinityTables:
+    '''
+    The affinity tables of 20 frames of random components.
+    '''
+    params = ([16, 64, 256], ['probability', 'KL div', 'JS div',
+                              'Hellinger'])
+    param_names = ['components', 'measure']
+
+    def setup(self, components, measure):
+        rng = np.random.RandomState(0)
+        self.means = rng.uniform(0, 128, size=(20, components, 2))
+        a = rng.normal(0, 3, size=(20, components, 2, 2))
+        self.covars = a @ np.swapaxes(a, -1, -2) + np.eye(2)
+
+    def time_get_all_aff_tables(self, components, measure):
+        get_all_aff_tables(self.means, self.covars, measure, progress=False)
+
+    def peakmem_get_all_aff_tables(self, components, measure):
+        get_all_aff_tables(self.means, self.covars, measure, progress=False)
@@ -0,0 +1,238 @@
+'''
+Generates synthetic fluorescent-cell videos and their initial
+segmentation masks, so every stage of the pipeline can be benchmarked
+without microscopy data. Each cell is a dim disc holding bright,
+gaussian-shaped mitochondria that the GMM picks up as components; the
+cells drift slowly across the frame and their mitochondria jitter inside
+them.
+'''
+
+import os
+import argparse
+
+import cv2
+import imageio
+import numpy as np
+
+# Intensity of the cytoplasm: above the threshold the tracker segments
+# cells with (3), below the one of the peaks that initialize the GMM (6).
+BODY_INTENSITY = 5
+
+# Peak intensity of a mitochondrion.
+PEAK_INTENSITY = 200
+
+# Smallest distance between mitochondria, above the min_distance between
+# the peaks that initialize the GMM.
+MIN_SEPARATION = 12
+
+
+def cell_layout(shape, n_cells, rng):
+    '''
+    Places the cells on a grid so that they never overlap.
+
+    Parameters
+    ----------
+    shape: tuple of ints
+        Height and width of the frames.
+    n_cells: int
+        Number of cells.
+    rng: numpy RandomState
+        Source of the jitter of every cell.
+
+    Returns
+    ----------
+    centers: numpy array, shape (n_cells, 2)
+        Center of every cell in the first frame.
+    radius: float
+        Radius of the cells.
+    '''
+    side = int(np.ceil(np.sqrt(n_cells)))
+    cell_h, cell_w = shape[0] / side, shape[1] / side
+    radius = 0.3 * min(cell_h, cell_w)
+    rows, cols = np.divmod(np.arange(n_cells), side)
+    centers = np.stack([(rows + 0.5) * cell_h, (cols + 0.5) * cell_w], axis=1)
+    centers += rng.uniform(-0.05, 0.05, size=centers.shape) * radius
+    return centers, radius
+
+
+def mitochondria_layout(radius, n_components, rng, tries=1000):
+    '''
+    Scatters mitochondria inside a cell, at least MIN_SEPARATION apart.
+
+    Parameters
+    ----------
+    radius: float
+        Radius of the cell.
+    n_components: int
+        Number of mitochondria wanted.
+    rng: numpy RandomState
+        Source of the positions.
+    tries: int
+        Number of random positions tried.
+
+    Returns
+    ----------
+    offsets: numpy array, shape (n, 2)
+        Positions relative to the center of the cell; fewer than
+        n_components if no more fit in the cell.
+    '''
+    offsets = []
+    for _ in range(tries):
+        if len(offsets) == n_components:
+            break
+        angle = rng.uniform(0, 2 * np.pi)
+        distance = 0.8 * radius * np.sqrt(rng.uniform())
+        offset = distance * np.array([np.sin(angle), np.cos(angle)])
+        if all(np.hypot(*(offset - other)) >= MIN_SEPARATION
+               for other in offsets):
+            offsets.append(offset)
+    return np.array(offsets).reshape(-1, 2)
+
+
+def synthetic_video(n_frames=20, shape=(256, 256), n_cells=4,
+                    n_components=6, seed=0):
+    '''
+    Generates the grayscale frames of a video of fluorescent cells and the
+    label mask of its first frame.
+
+    Parameters
+    ----------
+    n_frames: int
+        Number of frames.
+    shape: tuple of ints
+        Height and width of the frames.
+    n_cells: int
+        Number of cells.
+    n_components: int
+        Number of mitochondria per cell, i.e. of GMM components; cells
+        too small to hold them get as many as fit.
+    seed: int
+        Seed of the random layout and motion.
+
+    Returns
+    ----------
+    frames: numpy array, shape (n_frames, H, W)
+        The 8-bit grayscale frames.
+    mask: numpy array, shape (H, W)
+        Label mask of the first frame, 0 for background and i for the
+        i-th cell.
+    '''
+    rng = np.random.RandomState(seed)
+    centers, radius = cell_layout(shape, n_cells, rng)
+    # Cells drift by at most a tenth of their radius over the video.
+    drift = rng.normal(0, 0.05 * radius / max(n_frames, 1),
+                       size=(n_cells, 2))
+    offsets = [mitochondria_layout(radius, n_components, rng)
+               for _ in range(n_cells)]
+    spread = [rng.uniform(4, 9, size=len(o)) for o in offsets]
+
+    frames = np.zeros((n_frames,) + tuple(shape), dtype=np.uint8)
+    mask = np.zeros(shape, dtype=np.uint16)
+    reach = int(np.ceil(1.1 * radius)) + 1
+    for t in range(n_frames):
+        for c in range(n_cells):
+            cy, cx = centers[c] + drift[c] * t
+            # Only the pixels around a cell are drawn.
+            box = (slice(max(int(cy) - reach, 0), int(cy) + reach + 1),
+                   slice(max(int(cx) - reach, 0), int(cx) + reach + 1))
+            yy, xx = np.mgrid[box]
+            dist = (yy - cy) ** 2 + (xx - cx) ** 2
+            body = dist < radius ** 2
+            cell = BODY_INTENSITY * body.astype(float)
+            jitter = rng.normal(0, 0.3, size=offsets[c].shape)
+            for (my, mx), s in zip(offsets[c] + jitter, spread[c]):
+                # Overlapping mitochondria do not add up, so no peak
+                # saturates into a flat top.
+                cell = np.maximum(cell, PEAK_INTENSITY * body * np.exp(
+                    -((yy - cy - my) ** 2 + (xx - cx - mx) ** 2) / (2 * s)))
+            frames[t][box] = np.maximum(frames[t][box], cell)
+            if t == 0:
+                mask[box][dist < (1.1 * radius) ** 2] = c + 1
+    return frames, mask
+
+
+def write_video(path, frames, fps=10):
+    '''
+    Saves grayscale frames as an RGB Motion JPEG video, as the pipeline
+    writes its videos.
+
+    Parameters
+    ----------
+    path: String
+        Path to the video (.avi).
+    frames: numpy array, shape (F, H, W)
+        The frames.
+    fps: int
+        Frame rate of the video.
+
+    Returns
+    ----------
+    NoneType object
+    '''
+    height, width = frames.shape[1:]
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'),
+                             fps, (width, height))
+    for frame in frames:
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR))
+    writer.release()
+
+
+def write_dataset(directory, name='synthetic', n_frames=20, shape=(256, 256),
+                  n_cells=4, n_components=6, seed=0):
+    '''
+    Writes a synthetic video and its initial mask in the layout the
+    pipeline reads: <name>.avi with <name>.vtk next to it.
+
+    Parameters
+    ----------
+    directory: String
+        Directory to write the files to.
+    name: String
+        File name of the video and mask, without extension.
+    n_frames, shape, n_cells, n_components, seed:
+        See synthetic_video.
+
+    Returns
+    ----------
+    vid_path: String
+        Path to the video (.avi).
+    mask_path: String
+        Path to the mask (.vtk).
+    '''
+    frames, mask = synthetic_video(n_frames, shape, n_cells, n_components,
+                                   seed)
+    os.makedirs(directory, exist_ok=True)
+    vid_path = os.path.join(directory, name + '.avi')
+    mask_path = os.path.join(directory, name + '.vtk')
+    write_video(vid_path, frames)
+    imageio.imwrite(mask_path, mask)
+    return vid_path, mask_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=('Writes a synthetic fluorescent-cell video (.avi) and '
+                     'its initial mask (.vtk) for the pipeline.'),
+        prog='python -m benchmarks.synthetic <args>')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Directory to write the video and mask to.')
+    parser.add_argument('--name', default='synthetic',
+                        help='File name of the video and mask. '
+                             '[DEFAULT synthetic]')
+    parser.add_argument('--frames', type=int, default=20,
+                        help='Number of frames. [DEFAULT 20]')
+    parser.add_argument('--resolution', type=int, nargs=2,
+                        default=[256, 256], metavar=('HEIGHT', 'WIDTH'),
+                        help='Size of the frames. [DEFAULT 256 256]')
+    parser.add_argument('--cells', type=int, default=4,
+                        help='Number of cells. [DEFAULT 4]')
+    parser.add_argument('--components', type=int, default=6,
+                        help='Number of mitochondria (GMM components) per '
+                             'cell. [DEFAULT 6]')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed. [DEFAULT 0]')
+    args = parser.parse_args()
+    paths = write_dataset(args.output, args.name, args.frames,
+                          tuple(args.resolution), args.cells,
+                          args.components, args.seed)
+    print('\n'.join(paths))
@@ -25,7 +25,7 @@ def parse_cli(args):
     '''
 
     parser = argparse.ArgumentParser(
-        usage = 'python -m ornet [-h] -i INPUT -m MASKS -o OUTPUT',
+        usage = 'python -m ornet [-h] -i INPUT -m MASKS -o OUTPUT [-n N_JOBS] [-f FRAME_STRIDE] [-s] [-l] [-a] [-k]',
         description='An end-to-end pipeline of OrNet.'
     )
     parser.add_argument('-i', '--input',
@@ -41,13 +41,69 @@ def parse_cli(args):
     parser.add_argument('-d', '--downsample', type=int, default=1,
                         help='The number of frames to skip when performing'
                               + 'downsampling.')
+    parser.add_argument('-n', '--n_jobs', type=int, default=1,
+                        help='Number of processes used to fit cells and '
+                             + 'compute their distances in parallel. -1 uses '
+                             + 'all cores. Default is 1.')
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help='Decode each video once and stream its frames '
+                             + 'through every stage, without writing '
+                             + 'intermediate videos.')
+    parser.add_argument('--cache',
+                        help='Directory of a persistent cache of stage '
+                             + 'outputs. Unchanged stages are skipped on '
+                             + 'reruns. Default is no cache.')
+    parser.add_argument('--cache_size', type=float, default=None,
+                        help='Maximum size of the cache in GB. Least '
+                             + 'recently used entries are removed first.')
+    parser.add_argument('--cache_age', type=float, default=None,
+                        help='Remove cache entries unused for this many days.')
+    parser.add_argument('-v', '--video_jobs', type=int, default=1,
+                        help='Number of videos processed concurrently. '
+                             + 'Default is 1.')
+    parser.add_argument('-l', '--label_tracking', action='store_true',
+                        help='Track cells on a single label image, so memory '
+                             + 'does not grow with the number of cells.')
+    parser.add_argument('-f', '--frame_stride', type=int, default=1,
+                        help='Fit the GMM to every Nth frame of each cell. '
+                             + 'Default is 1.')
+    parser.add_argument('-a', '--adaptive_gmm', action='store_true',
+                        help='Skip refitting the GMM to frames the previous '
+                             + 'fit already explains.')
+    parser.add_argument('-k', '--dynamic_gmm', action='store_true',
+                        help='Let GMM components appear, split, merge and '
+                             + 'die between frames.')
+    parser.add_argument('--chunk_size', type=int, default=None,
+                        help='Number of frames of distance tables each '
+                             + 'process computes at a time. Lower it to '
+                             + 'bound memory. Default sizes it from the '
+                             + 'number of GMM components.')
+    parser.add_argument('--radius', type=float, default=None,
+                        help='Store sparse distance tables that keep only '
+                             + 'components whose means are within this '
+                             + 'distance. Default is dense tables.')
+    parser.add_argument('--n_neighbors', type=int, default=None,
+                        help='Store sparse distance tables that keep only '
+                             + 'the nearest neighbours of every component. '
+                             + 'Default is dense tables.')
     return vars(parser.parse_args(args))
 
 
 def main(system_args):
     args = parse_cli(system_args[1:])
+    cache_max_bytes = None
+    if args['cache_size'] is not None:
+        cache_max_bytes = int(args['cache_size'] * 2 ** 30)
+    cache_max_age = None
+    if args['cache_age'] is not None:
+        cache_max_age = args['cache_age'] * 24 * 60 * 60
     pipeline.run(args['input'], args['masks'], args['output'], args['count'], 
-                 args['downsample'])
+                 args['downsample'], args['n_jobs'], args['stream'],
+                 args['cache'], cache_max_bytes, cache_max_age,
+                 args['video_jobs'], args['label_tracking'],
+                 args['frame_stride'], args['adaptive_gmm'],
+                 args['dynamic_gmm'], args['chunk_size'], args['radius'],
+                 args['n_neighbors'])
 
 if __name__ == '__main__':
     main(sys.argv)
@@ -4,10 +4,18 @@ from functools import partial
 
 import joblib
 import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+from tqdm import tqdm
 
 from ornet.gmm.loss import normpdf
 from ornet.measure import multivariate_js, multivariate_kl, \
-    multivariate_hellinger
+    multivariate_hellinger, batch_js, batch_kl, batch_hellinger, \
+    pair_hellinger, _det2, _inv2
+
+# Nearest neighbours kept per component by sparse tables given neither a
+# radius nor a number of neighbours.
+N_NEIGHBORS = 10
 
 
 def aff_by_eval(means, covars):
@@ -27,13 +35,12 @@ def aff_by_eval(means, covars):
     aff_Table : array, shape (k, k)
 
     """
-    aff_Table = np.empty([means.shape[0], 0])
+    aff_Table = np.empty([means.shape[0], means.shape[0]])
     # iterate through the components
     for i, (mean, covar) in enumerate(zip(means, covars)):
         # find the probability for every mean point in the current component
-        p_mus_Kx = normpdf(means, mean, covar)
-        # transpose the probabilities and append them as a column
-        aff_Table = np.append(aff_Table, np.transpose([p_mus_Kx]), axis=1)
+        # and store them as a column
+        aff_Table[:, i] = normpdf(means, mean, covar)
     return aff_Table
 
 
@@ -71,7 +78,7 @@ def aff_JS_div(means, covars):
 
 def aff_hellinger(means, covars):
     """
-    Applies Jensen-Shannon divergence to each pair of intermediates to create an affinity
+    Applies Hellinger distance to each pair of intermediates to create an affinity
     table for a frame
     """
 
@@ -86,7 +93,35 @@ def aff_hellinger(means, covars):
     return aff_Table
 
 
-def get_all_aff_tables(means, covars, aff_funct, progress=True):
+def batch_aff_by_eval(means, covars):
+    """
+    Vectorized counterpart of aff_by_eval, evaluating every mean under
+    every component at once with closed-form 2x2 inverses.
+
+    Parameters
+    ----------
+    means : array, shape (..., k, 2)
+        the list of means with k nodes
+    covars : array, shape (..., k, 2, 2)
+        the list of covars with k nodes
+
+    Returns
+    -------
+    aff_Table : array, shape (..., k, k)
+
+    """
+    det = _det2(covars)
+    inv = _inv2(covars, det)
+    # entry (j, i) is the j-th mean evaluated under the i-th component,
+    # contracted exactly as normpdf does ('ni,ji,ni->n') so both agree
+    delta = means[..., :, None, :] - means[..., None, :, :]
+    p = np.einsum('...jia,...ia->...ji', delta ** 2, inv.sum(axis=-2))
+    n = 1 / (2 * np.pi * np.sqrt(det))
+    return np.exp(-0.5 * p) * n[..., None, :]
+
+
+def get_all_aff_tables(means, covars, aff_funct, progress=True,
+                       vectorized=True, out_path=None, chunk_size=None):
     """
     finds all affinity table for a set of Frames
     each with lists of means and covariances
@@ -95,17 +130,27 @@ def get_all_aff_tables(means, covars, aff_funct, progress=True):
     ----------
     means : array, shape (f, k, 2)
         the list of lists of means with f frames and k nodes
-    covars : array, shape (k, 2, 2)
+    covars : array, shape (f, k, 2, 2)
         the list of lists of covars with f frames with k nodes
     aff_funct: string
         the affinity metric that will be applied to the 
         distributions
     progress: bool
         flag to display a progress bar
+    vectorized: bool
+        compute every frame at once with the batched measures rather
+        than one pair of components at a time (default: True)
+    out_path: string
+        if given, the tables are streamed into a memory-mapped .npy file
+        at this path instead of being held in memory (default: None)
+    chunk_size: int
+        number of frames handed to the batched measures at a time
+        (default: sized to roughly a million component pairs)
 
     Returns
     -------
     aff_Table : array, shape (f, k, k)
+        in-memory array, or a read-only memmap of out_path.
 
     """
 
@@ -115,17 +160,252 @@ def get_all_aff_tables(means, covars, aff_funct, progress=True):
         'JS div': aff_JS_div,
         'Hellinger': aff_hellinger
     }
-    aff_Tables = [aff_dispatch[aff_funct](means[0], covars[0])]
-    for i in range(1, means.shape[0]):
-        aff_Tables = np.append(
-            aff_Tables, 
-            [aff_dispatch[aff_funct](means[i], covars[i])],
-            axis=0
-        )
+    batch_dispatch = {
+        'probability': batch_aff_by_eval,
+        'KL div': batch_kl,
+        'JS div': batch_js,
+        'Hellinger': batch_hellinger
+    }
+    means = np.asarray(means)
+    covars = np.asarray(covars)
+    frames, k = means.shape[0], means.shape[1]
+    if out_path is None:
+        aff_Tables = np.empty([frames, k, k])
+    else:
+        aff_Tables = np.lib.format.open_memmap(out_path, mode='w+',
+                                               dtype=np.float64,
+                                               shape=(frames, k, k))
+
+    if not vectorized:
+        chunk_size = 1
+    elif chunk_size is None:
+        chunk_size = max(1, 2 ** 20 // max(1, k * k))
+
+    if progress:
+        progress_bar = tqdm(total=frames)
+        progress_bar.set_description('Computing affinity')
+
+    for start in range(0, frames, chunk_size):
+        stop = min(start + chunk_size, frames)
+        if vectorized:
+            aff_Tables[start:stop] = batch_dispatch[aff_funct](
+                means[start:stop], covars[start:stop])
+        else:
+            aff_Tables[start] = aff_dispatch[aff_funct](means[start],
+                                                        covars[start])
+        if progress:
+            progress_bar.update(stop - start)
+
+    if progress:
+        progress_bar.close()
+
+    if out_path is not None:
+        aff_Tables.flush()
+        del aff_Tables
+        aff_Tables = np.load(out_path, mmap_mode='r')
 
     return aff_Tables
 
 
+def cutoff_radius(covars, cutoff=1e-6, gamma=0.00125):
+    """
+    Distance between means beyond which the Hellinger measure of two
+    components is below cutoff. The measure is at most
+    exp(-gamma * d^2 / s), where s is the largest variance of any
+    component along any direction, so the radius holds for every pair.
+
+    The bound is loose: with the default gamma and cutoff it is about
+    105 standard deviations of the widest component, which for real
+    cells spans the whole cell and keeps nearly every pair. Passing it
+    as the radius of sparse_aff_table makes the sparse table exact, but
+    rarely much sparser than the dense one.
+
+    Parameters
+    ----------
+    covars : array, shape (k, 2, 2)
+        Covariances of the components; NaN ones (absent components) are
+        ignored.
+    cutoff : float
+        Smallest measure kept, in (0, 1).
+    gamma: float
+        Probability measure, as in batch_hellinger.
+
+    Returns
+    -------
+    radius : float
+        The distance.
+    """
+    half_trace = 0.5 * (covars[..., 0, 0] + covars[..., 1, 1])
+    spread = half_trace + np.sqrt(np.maximum(half_trace ** 2 - _det2(covars),
+                                             0))
+    spread = spread[np.isfinite(spread)]
+    if spread.size == 0:
+        return 0.0
+    return np.sqrt(spread.max() * np.log(1 / cutoff) / gamma)
+
+
+def neighbour_pairs(means, radius=None, n_neighbors=None):
+    """
+    Pairs of components whose means are neighbours, found with a KD-tree
+    instead of comparing every pair. The pairs are symmetric and include
+    every component with itself; NaN means (absent components) have no
+    pairs.
+
+    Parameters
+    ----------
+    means : array, shape (k, 2)
+        Means of the components.
+    radius : float
+        Largest distance between neighbouring means (default: no limit).
+    n_neighbors : integer
+        Number of nearest neighbours of every component (default: all
+        within radius).
+
+    Returns
+    -------
+    rows, cols : arrays, shape (n,)
+        Indices of the two components of every pair, sorted by row.
+    """
+    k = means.shape[0]
+    valid = np.flatnonzero(np.isfinite(means).all(axis=1))
+    n = valid.size
+    if n == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+
+    tree = cKDTree(means[valid])
+    bound = np.inf if radius is None else radius
+    if n_neighbors is None:
+        pairs = tree.query_pairs(bound, output_type='ndarray')
+        rows, cols = pairs[:, 0], pairs[:, 1]
+    else:
+        # The nearest neighbour of every mean is itself.
+        _, index = tree.query(means[valid], k=min(n_neighbors + 1, n),
+                              distance_upper_bound=bound)
+        index = index.reshape(n, -1)
+        rows = np.repeat(np.arange(n), index.shape[1])
+        cols = index.ravel()
+        found = cols < n
+        rows, cols = rows[found], cols[found]
+
+    itself = np.arange(n)
+    pairs = np.unique(np.concatenate([rows, cols, itself]) * k +
+                      np.concatenate([cols, rows, itself]))
+    return valid[pairs // k], valid[pairs % k]
+
+
+def sparse_aff_table(means, covars, radius=None, n_neighbors=None):
+    """
+    Hellinger affinity table of a frame as a sparse matrix holding only
+    the pairs of neighbouring components, so time and memory grow with
+    the number of neighbours rather than with k^2.
+
+    The neighbours trade density for accuracy. With n_neighbors every
+    row keeps at least n_neighbors + 1 entries and the table stays
+    sparse however crowded the cell is, but entries beyond the nearest
+    neighbours are dropped even when they are not negligible. With a
+    radius every pair closer than it is kept, so the density follows
+    how crowded the components are; cutoff_radius gives a radius that
+    drops only entries below a cutoff, at the cost of a nearly dense
+    table.
+
+    Parameters
+    ----------
+    means : array, shape (k, 2)
+        the list of means with k nodes
+    covars : array, shape (k, 2, 2)
+        the list of covars with k nodes
+    radius : float
+        Largest distance between the means of a pair that is kept
+        (default: no limit).
+    n_neighbors : integer
+        Number of nearest neighbours kept for every component (default:
+        all within radius, or N_NEIGHBORS if no radius is given either).
+
+    Returns
+    -------
+    aff_Table : csr_matrix, shape (k, k)
+        The entries of batch_hellinger for the neighbouring pairs.
+    """
+    if radius is None and n_neighbors is None:
+        n_neighbors = N_NEIGHBORS
+    rows, cols = neighbour_pairs(means, radius, n_neighbors)
+    values = pair_hellinger(means[rows], covars[rows], means[cols],
+                            covars[cols])
+    k = means.shape[0]
+    return sparse.csr_matrix((values, (rows, cols)), shape=(k, k))
+
+
+def get_sparse_aff_tables(means, covars, radius=None, n_neighbors=None,
+                          progress=True, out_path=None):
+    """
+    Sparse counterpart of get_all_aff_tables for the Hellinger measure,
+    see sparse_aff_table.
+
+    Parameters
+    ----------
+    means : array, shape (f, k, 2)
+        the list of lists of means with f frames and k nodes
+    covars : array, shape (f, k, 2, 2)
+        the list of lists of covars with f frames with k nodes
+    radius, n_neighbors :
+        See sparse_aff_table.
+    progress: bool
+        flag to display a progress bar
+    out_path: string
+        if given, the tables are also saved at this path (.npz), see
+        save_sparse_tables (default: None)
+
+    Returns
+    -------
+    aff_Tables : list of csr_matrix, shape (k, k)
+        The table of every frame.
+    """
+    means = np.asarray(means)
+    covars = np.asarray(covars)
+    frames = tqdm(range(means.shape[0]), disable=not progress,
+                  desc='Computing affinity')
+    aff_Tables = [sparse_aff_table(means[t], covars[t], radius, n_neighbors)
+                  for t in frames]
+    if out_path is not None:
+        save_sparse_tables(out_path, aff_Tables)
+    return aff_Tables
+
+
+def save_sparse_tables(path, tables):
+    """
+    Saves the sparse tables of every frame as a single CSR matrix of
+    shape (f * k, k), the tables stacked frame after frame.
+
+    Parameters
+    ----------
+    path : string
+        Path to the tables (.npz).
+    tables : list of sparse matrices, shape (k, k)
+        The table of every frame.
+    """
+    sparse.save_npz(path, sparse.vstack(tables, format='csr'))
+
+
+def load_sparse_tables(path):
+    """
+    Reads tables saved with save_sparse_tables.
+
+    Parameters
+    ----------
+    path : string
+        Path to the tables (.npz).
+
+    Returns
+    -------
+    tables : list of csr_matrix, shape (k, k)
+        The table of every frame.
+    """
+    stacked = sparse.load_npz(path).tocsr()
+    k = stacked.shape[1]
+    return [stacked[start:start + k]
+            for start in range(0, stacked.shape[0], k)]
+
+
 if __name__ == "__main__":
     cwd = os.getcwd()
     parser = argparse.ArgumentParser(
@@ -149,6 +429,14 @@ if __name__ == "__main__":
                               " 'JS div' is Jenson Shannon divergence",
                               " 'Hellinger' is Hellinger distance"
                               "[DEFAULT probability]"))
+    parser.add_argument("--radius", type=float, default=None,
+                        help=("Store sparse Hellinger tables (.npz) that keep "
+                              "only components whose means are within this "
+                              "distance. [DEFAULT dense tables]"))
+    parser.add_argument("--n_neighbors", type=int, default=None,
+                        help=("Store sparse Hellinger tables (.npz) that keep "
+                              "only the nearest neighbours of every "
+                              "component. [DEFAULT dense tables]"))
     parser.add_argument("--n_jobs", type=int, default=-1,
                         help=("Degree of parallelism for reading in videos."
                               " -1 is all cores. [DEFAULT -1]"))
@@ -166,17 +454,25 @@ if __name__ == "__main__":
     else:
         vidpaths = [args['input']]
     print(vidpaths)
-    # Spawn parallel jobs to read the videos in the directory listing.
-    out = joblib.Parallel(n_jobs=args['n_jobs'], verbose=10)(
-        joblib.delayed(get_all_aff_tables)
-        (np.load(v)['means'], np.load(v)['covars'], args['affinity_type'])
-        for v in vidpaths
-    )
-
-    # Write the files out.
-    for outs, v in zip(out, vidpaths):
+    is_sparse = args['radius'] is not None or args['n_neighbors'] is not None
+
+    # Spawn parallel jobs that stream each table straight to disk.
+    def outfile(v):
         key = v.split(os.path.sep)[-1].split(".")[0]
-        print(key)
-        fname = "{}_aff_table.npy".format(key)
-        outfile = os.path.join(args['output'], fname)
-        np.save(outfile, outs)
+        fname = "{}_aff_table.{}".format(key, "npz" if is_sparse else "npy")
+        return os.path.join(args['output'], fname)
+
+    if is_sparse:
+        joblib.Parallel(n_jobs=args['n_jobs'], verbose=10)(
+            joblib.delayed(get_sparse_aff_tables)
+            (np.load(v)['means'], np.load(v)['covars'], args['radius'],
+             args['n_neighbors'], progress=False, out_path=outfile(v))
+            for v in vidpaths
+        )
+    else:
+        joblib.Parallel(n_jobs=args['n_jobs'], verbose=10)(
+            joblib.delayed(get_all_aff_tables)
+            (np.load(v)['means'], np.load(v)['covars'], args['affinity_type'],
+             progress=False, out_path=outfile(v))
+            for v in vidpaths
+        )
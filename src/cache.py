@@ -0,0 +1,201 @@
+'''
+A persistent, content-addressed cache for the outputs of pipeline stages.
+Every entry is a directory named by a hash of the stage, the contents of
+its input files and its parameters, so a rerun can restore the outputs of
+any stage whose inputs have not changed instead of recomputing them.
+'''
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+# Bump to invalidate existing entries when a stage's algorithm changes.
+CACHE_VERSION = 3
+
+
+def file_digest(path, block_size=2 ** 20):
+    '''
+    Hashes the contents of a file.
+
+    Parameters
+    ----------
+    path: String
+        Path to the file.
+    block_size: int
+        Number of bytes read at a time.
+
+    Returns
+    ----------
+    digest: String
+        Hex SHA-256 digest of the file contents.
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def stage_key(stage, input_paths, params):
+    '''
+    Computes the cache key of a stage.
+
+    Parameters
+    ----------
+    stage: String
+        Name of the stage.
+    input_paths: list of Strings
+        Files the stage reads.
+    params: dict
+        Parameters that affect the output of the stage. Values must be
+        JSON serializable (or representable with str).
+
+    Returns
+    ----------
+    key: String
+        Hex SHA-256 digest identifying the stage outputs.
+    '''
+    sha = hashlib.sha256()
+    header = {'version': CACHE_VERSION, 'stage': stage, 'params': params}
+    sha.update(json.dumps(header, sort_keys=True, default=str).encode())
+    for path in input_paths:
+        sha.update(file_digest(path).encode())
+    return sha.hexdigest()
+
+
+def restore(cache_dir, key, base_dir):
+    '''
+    Copies the outputs stored under a key back into place.
+
+    Parameters
+    ----------
+    cache_dir: String
+        Path to the cache directory.
+    key: String
+        Cache key from stage_key.
+    base_dir: String
+        Directory the stored relative paths are restored under.
+
+    Returns
+    ----------
+    restored: list of Strings or NoneType object
+        Relative paths of the restored files, or None if the key is not
+        in the cache.
+    '''
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry):
+        return None
+
+    restored = []
+    for root, _, files in os.walk(entry):
+        for file_name in files:
+            src = os.path.join(root, file_name)
+            rel_path = os.path.relpath(src, entry)
+            dest = os.path.join(base_dir, rel_path)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copyfile(src, dest)
+            restored.append(rel_path)
+
+    # The modification time of an entry records when it was last used.
+    os.utime(entry)
+    return restored
+
+
+def store(cache_dir, key, base_dir, rel_paths):
+    '''
+    Saves the outputs of a stage under a key. Entries are assembled in a
+    temporary directory and renamed into place, so concurrent workers never
+    see a partial entry.
+
+    Parameters
+    ----------
+    cache_dir: String
+        Path to the cache directory.
+    key: String
+        Cache key from stage_key.
+    base_dir: String
+        Directory the relative paths are resolved against.
+    rel_paths: list of Strings
+        Output files of the stage, relative to base_dir.
+
+    Returns
+    ----------
+    NoneType object
+    '''
+    entry = os.path.join(cache_dir, key)
+    if os.path.isdir(entry):
+        return
+
+    os.makedirs(cache_dir, exist_ok=True)
+    partial = tempfile.mkdtemp(prefix='.partial-', dir=cache_dir)
+    try:
+        for rel_path in rel_paths:
+            dest = os.path.join(partial, rel_path)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copyfile(os.path.join(base_dir, rel_path), dest)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+
+    try:
+        os.rename(partial, entry)
+    except OSError:
+        # Another worker stored the same entry first.
+        shutil.rmtree(partial, ignore_errors=True)
+
+
+def entry_size(entry):
+    '''
+    Total size in bytes of the files in a cache entry.
+    '''
+    return sum(os.path.getsize(os.path.join(root, file_name))
+               for root, _, files in os.walk(entry) for file_name in files)
+
+
+def evict(cache_dir, max_bytes=None, max_age=None):
+    '''
+    Removes cache entries that have not been used for longer than max_age,
+    then the least recently used ones until the cache fits in max_bytes.
+
+    Parameters
+    ----------
+    cache_dir: String
+        Path to the cache directory.
+    max_bytes: int
+        Maximum total size of the cache. None for no limit.
+    max_age: float
+        Maximum time in seconds since an entry was last used.
+        None for no limit.
+
+    Returns
+    ----------
+    removed: int
+        Number of entries removed.
+    '''
+    if not os.path.isdir(cache_dir):
+        return 0
+
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, key)
+        if key.startswith('.partial-') or not os.path.isdir(entry):
+            continue
+        entries.append((os.path.getmtime(entry), entry_size(entry), entry))
+    entries.sort()
+
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for mtime, size, entry in entries:
+        too_old = max_age is not None and now - mtime > max_age
+        too_big = max_bytes is not None and total > max_bytes
+        if not (too_old or too_big):
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        removed += 1
+
+    return removed
@@ -0,0 +1,196 @@
+"""
+Online change-point detection over the eigen time series of a cell. Each
+frame is reduced to a short summary, the leading eigenvalues of its
+Hellinger graph, as soon as its GMM is fit, and a detector that only
+keeps the last few summaries flags the frames where they shift. Events
+are written while the video is still being processed, so long
+acquisitions can be triaged before the pipeline finishes.
+"""
+
+from collections import deque
+
+import numpy as np
+
+from ornet.measure import batch_hellinger
+from ornet.spectral import N_EIGS, batch_eigs, graph_matrices
+
+# Number of summaries on either side of a candidate change.
+WINDOW = 10
+
+# Score above which a frame is a change, see ChangePointDetector.
+THRESHOLD = 4.0
+
+
+def frame_summary(means, covars, n_eigs=N_EIGS):
+    """
+    Summary of one frame: the leading eigenvalues of the graph of its
+    components, weighted by Hellinger affinity as in the distance stage.
+
+    Parameters
+    ----------
+    means : array, shape (k, 2)
+        Component means; NaN for absent components, which are skipped.
+    covars : array, shape (k, 2, 2)
+        Component covariances.
+    n_eigs : integer
+        Number of eigenvalues kept.
+
+    Returns
+    -------
+    summary : array, shape (n_eigs,)
+        Eigenvalues, largest first, padded with zeros for frames with
+        fewer than n_eigs components.
+    """
+    present = np.isfinite(means).all(axis=1)
+    table = batch_hellinger(means[present], covars[present])
+    values, _ = batch_eigs(graph_matrices(table[np.newaxis]), n_eigs)
+    summary = np.zeros(n_eigs)
+    summary[:values.shape[1]] = values[0]
+    return summary
+
+
+class ChangePointDetector:
+    """
+    Flags the frames where a stream of per-frame summaries shifts, keeping
+    only the last 2 * window summaries. A frame is scored by the largest
+    difference, over the features, between the means of the window
+    summaries before it and the window from it on, in units of their
+    pooled standard deviation; it is therefore scored window frames after
+    it arrives. A run of consecutive frames scoring above threshold is one
+    change, reported at its highest score as soon as the run ends.
+
+    Parameters
+    ----------
+    window : integer
+        Number of summaries on either side of a candidate change.
+    threshold : float
+        Score above which a frame is a change.
+    min_change : float
+        Relative change of a feature that is always negligible; keeps
+        summaries that are constant within a window, e.g. frames skipped
+        by the adaptive GMM, from scoring every tiny shift as a change.
+    path : string
+        If given, events are appended to this CSV file (frame,score) and
+        flushed as they are found (default: None).
+    """
+
+    def __init__(self, window=WINDOW, threshold=THRESHOLD, min_change=1e-3,
+                 path=None):
+        self.window = window
+        self.threshold = threshold
+        self.min_change = min_change
+        self._frames = deque(maxlen=2 * window)
+        self._summaries = deque(maxlen=2 * window)
+        self._best = None
+        self._file = None
+        if path is not None:
+            self._file = open(path, 'w')
+            self._file.write('frame,score\n')
+            self._file.flush()
+
+    def score(self):
+        """
+        Score of the frame in the middle of the summaries held, or None
+        until 2 * window summaries have arrived.
+        """
+        if len(self._summaries) < 2 * self.window:
+            return None
+        history = np.array(self._summaries)
+        before, after = history[:self.window], history[self.window:]
+        shift = np.abs(after.mean(axis=0) - before.mean(axis=0))
+        spread = np.sqrt(0.5 * (before.var(axis=0) + after.var(axis=0)))
+        spread += self.min_change * np.abs(history.mean(axis=0))
+        spread = np.maximum(spread, np.finfo(np.float64).tiny)
+        return (shift / spread).max()
+
+    def update(self, frame, summary):
+        """
+        Adds the summary of the next frame.
+
+        Parameters
+        ----------
+        frame : integer
+            Index of the frame in the video.
+        summary : array, shape (m,)
+            Its summary, e.g. from frame_summary.
+
+        Returns
+        -------
+        events : list of tuples
+            (frame, score) of the change that ended with this frame, if
+            any.
+        """
+        self._frames.append(frame)
+        self._summaries.append(np.asarray(summary, dtype=np.float64))
+        score = self.score()
+        if score is None:
+            return []
+        if score > self.threshold:
+            if self._best is None or score > self._best[1]:
+                self._best = (int(self._frames[self.window]), float(score))
+            return []
+        return self._end_run()
+
+    def _end_run(self):
+        if self._best is None:
+            return []
+        event, self._best = self._best, None
+        if self._file is not None:
+            self._file.write('{},{:.6g}\n'.format(*event))
+            self._file.flush()
+        return [event]
+
+    def close(self):
+        """
+        Reports a change still in progress at the end of the video and
+        closes the events file.
+
+        Returns
+        -------
+        events : list of tuples
+            (frame, score) of that change, if any.
+        """
+        events = self._end_run()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return events
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def detect_change_points(means, covars, frames=None, window=WINDOW,
+                         threshold=THRESHOLD, min_change=1e-3, path=None):
+    """
+    Runs the detector over the saved components of a whole video, finding
+    the same changes as when they are fed frame by frame while fitting.
+
+    Parameters
+    ----------
+    means : array, shape (f, k, 2)
+        Component means of every frame.
+    covars : array, shape (f, k, 2, 2)
+        Component covariances of every frame.
+    frames : array, shape (f,)
+        Index in the video of every frame (default: 0 to f - 1).
+    window, threshold, min_change, path :
+        See ChangePointDetector.
+
+    Returns
+    -------
+    events : list of tuples
+        (frame, score) of every change.
+    """
+    if frames is None:
+        frames = range(len(means))
+    events = []
+    with ChangePointDetector(window, threshold, min_change,
+                             path) as detector:
+        for frame, mu, cv in zip(frames, means, covars):
+            events += detector.update(frame, frame_summary(mu, cv))
+        events += detector.close()
+    return events
@@ -5,16 +5,239 @@ each cell.
 '''
 
 import os
+import json
 import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import imageio
 import numpy as np
+from scipy import ndimage
 from tqdm import tqdm
 
-def extract_cells(vid_path, masks_path, output_path, show_vid=False):
+from ornet.framestore import FrameStoreWriter
+
+# Pixels kept around each cell when cropping, more than the min_distance
+# of the GMM initialization so that peaks near a cell's edge are kept.
+PADDING = 16
+
+
+def cell_boxes(masks, segments, padding=PADDING):
+    '''
+    Finds the region each cell covers over the whole video, so that every
+    cell can be processed inside a crop that follows it from frame to frame.
+
+    Parameters
+    ----------
+    masks: iterable of arrays, shape (H, W)
+        Segmentation masks of each frame.
+    segments: int
+        Number of cells.
+    padding: int
+        Pixels added on every side of the bounding box.
+
+    Returns
+    ----------
+    boxes: list of tuples of slices
+        The (rows, columns) crop of each cell. A cell that never appears
+        gets the whole frame.
+    '''
+    masks = iter(masks)
+    first = next(masks, None)
+    if first is None:
+        raise ValueError('No masks to find the cells in.')
+    height, width = first.shape
+
+    lower = np.full((segments, 2), np.iinfo(np.int64).max)
+    upper = np.zeros((segments, 2), dtype=np.int64)
+    for mask in itertools.chain([first], masks):
+        for i, box in enumerate(ndimage.find_objects(mask, segments)):
+            if box is not None:
+                lower[i] = np.minimum(lower[i], [box[0].start, box[1].start])
+                upper[i] = np.maximum(upper[i], [box[0].stop, box[1].stop])
+
+    boxes = []
+    for i in range(segments):
+        if upper[i, 0] == 0:
+            boxes.append((slice(0, height), slice(0, width)))
+            continue
+        boxes.append((slice(int(max(lower[i, 0] - padding, 0)),
+                            int(min(upper[i, 0] + padding, height))),
+                      slice(int(max(lower[i, 1] - padding, 0)),
+                            int(min(upper[i, 1] + padding, width)))))
+    return boxes
+
+
+def offset_path(cell_path):
+    '''
+    Path of the file recording where a cropped cell lies in the frame.
+    '''
+    return os.path.splitext(cell_path)[0] + '.json'
+
+
+def save_offset(cell_path, box):
+    '''
+    Records the (row, column) of the top left corner of a cell's crop.
+
+    Parameters
+    ----------
+    cell_path: String
+        Path to the cropped video (.avi) or array (.npy) of the cell.
+    box: tuple of slices
+        The crop, see cell_boxes.
+
+    Returns
+    ----------
+    NoneType object
+    '''
+    with open(offset_path(cell_path), 'w') as f:
+        json.dump({'offset': [int(box[0].start), int(box[1].start)]}, f)
+
+
+def load_offset(cell_path):
+    '''
+    Reads the offset of a cropped cell.
+
+    Parameters
+    ----------
+    cell_path: String
+        Path to the cropped video (.avi) or array (.npy) of the cell.
+
+    Returns
+    ----------
+    offset: array, shape (2,)
+        The (row, column) of the crop in the frame, zeros if the cell
+        was not cropped.
+    '''
+    if not os.path.exists(offset_path(cell_path)):
+        return np.zeros(2)
+    with open(offset_path(cell_path)) as f:
+        return np.array(json.load(f)['offset'], dtype=float)
+
+def split_frame(frame, mask, boxes, outputs):
+    '''
+    Splits one frame into every cell at once, writing each cell's crop,
+    with everything outside the cell set to 0, into a preallocated buffer.
+
+    Parameters
+    ----------
+    frame: numpy array, shape (H, W) or (H, W, 3)
+        The frame.
+    mask: numpy array, shape (H, W)
+        Segmentation mask of the frame, i for the i-th cell.
+    boxes: list of tuples of slices
+        The crop of each cell, see cell_boxes.
+    outputs: list of numpy arrays
+        Buffer of each cell, the shape of its crop.
+
+    Returns
+    ----------
+    NoneType object
+    '''
+    for j, (box, output) in enumerate(zip(boxes, outputs)):
+        cell = mask[box] == j + 1
+        if output.ndim > cell.ndim:
+            cell = cell[..., np.newaxis]
+        output[...] = 0
+        np.copyto(output, frame[box], where=cell)
+
+
+def write_cells(writers, stores, outputs):
+    '''
+    Writes a frame of every cell to its video, and to its store of
+    grayscale frames.
+
+    Parameters
+    ----------
+    writers: list of cv2.VideoWriter
+        Video of each cell.
+    stores: list of FrameStoreWriter
+        Grayscale frames of each cell, None to skip.
+    outputs: list of numpy arrays
+        Frame of each cell, in color (BGR) or grayscale.
+
+    Returns
+    ----------
+    NoneType object
+    '''
+    for writer, store, output in zip(writers, stores, outputs):
+        if output.ndim == 2:
+            writer.write(cv2.cvtColor(output, cv2.COLOR_GRAY2BGR))
+            gray = output
+        else:
+            writer.write(output)
+            gray = cv2.cvtColor(output, cv2.COLOR_BGR2GRAY)
+        if store is not None:
+            store.append(gray)
+
+
+def extract_frames(frames, masks, boxes, writers, stores=None,
+                   n_threads=None, progress_bar=None):
+    '''
+    Splits every frame into all of its cells (see split_frame) while
+    background threads write the previous frame's cells. Each cell is
+    always written by the same thread, so its frames stay in order.
+
+    Parameters
+    ----------
+    frames: iterable of numpy arrays, shape (H, W) or (H, W, 3)
+        The frames.
+    masks: sequence of numpy arrays, shape (H, W)
+        Segmentation mask of each frame.
+    boxes: list of tuples of slices
+        The crop of each cell, see cell_boxes.
+    writers: list of cv2.VideoWriter
+        Video of each cell.
+    stores: list of FrameStoreWriter
+        Grayscale frames of each cell. None writes only the videos.
+    n_threads: int
+        Number of writing threads. None uses one per core.
+    progress_bar: tqdm
+        Updated after every frame.
+
+    Returns
+    ----------
+    NoneType object
+    '''
+    if stores is None:
+        stores = [None] * len(writers)
+    n_threads = min(n_threads or os.cpu_count(), max(len(boxes), 1))
+    pools = [ThreadPoolExecutor(1) for _ in range(n_threads)]
+    # Two sets of buffers, one filled while the other is being written.
+    buffers = None
+    pending = [[], []]
+    for i, frame in enumerate(frames):
+        if buffers is None:
+            buffers = [[np.zeros((rows.stop - rows.start,
+                                  cols.stop - cols.start) + frame.shape[2:],
+                                 dtype=frame.dtype) for rows, cols in boxes]
+                       for _ in range(2)]
+        for future in pending[i % 2]:
+            future.result()
+        split_frame(frame, masks[i], boxes, buffers[i % 2])
+        pending[i % 2] = [
+            pool.submit(write_cells, writers[k::n_threads],
+                        stores[k::n_threads], buffers[i % 2][k::n_threads])
+            for k, pool in enumerate(pools)]
+        if progress_bar is not None:
+            progress_bar.update()
+
+    for future in pending[0] + pending[1]:
+        future.result()
+    for pool in pools:
+        pool.shutdown()
+
+
+def extract_cells(vid_path, masks_path, output_path, show_vid=False,
+                  padding=None, n_threads=None, gray_path=None):
     '''
     Each individual cell in a video is extracted into it's own video.
+    Frames are split into every cell in one pass, and the cell videos are
+    encoded by background threads while the next frame is decoded.
+    When a padding is given, each video is cropped to the region its
+    cell covers and the crop's offset is saved next to it, or next to
+    its store (see save_offset).
 
     Parameters
     ----------
@@ -26,45 +249,65 @@ def extract_cells(vid_path, masks_path, output_path, show_vid=False):
         Path to the directory to save the individual videos.
     show_vid: boolean
         Flag to show video while extracting cells.
+    padding: int
+        Pixels kept around each cell when cropping. None writes
+        full frames.
+    n_threads: int
+        Number of threads encoding the cell videos. None uses
+        one per core.
+    gray_path: String
+        If given, the grayscale frames of each cell are also saved
+        losslessly in a store (.npz, see framestore) in this
+        directory, without a round trip through the video.
 
     Returns
     ----------
     NoneType object
     '''
 
-    masks = np.load(masks_path)
+    masks = np.load(masks_path, mmap_mode='r')
     segments = len(np.unique(masks[0])) - 1
+    if padding is None:
+        boxes = [(slice(0, masks.shape[1]), slice(0, masks.shape[2]))] * \
+            segments
+    else:
+        boxes = cell_boxes(masks, segments, padding)
 
     writers = []
+    stores = []
     vid_name = os.path.split(vid_path)[1].split('.')[0]
     os.makedirs(output_path, exist_ok=True)
     reader = imageio.get_reader(vid_path)
 
-    for i in range(segments):
+    for i, (rows, cols) in enumerate(boxes):
+        single_name = str(vid_name) + '_' + str(i + 1)
+        single_path = os.path.join(str(output_path), single_name + '.avi')
+        crop_shape = (rows.stop - rows.start, cols.stop - cols.start)
         writers.append(cv2.VideoWriter(
-            os.path.join(
-                str(output_path), str(vid_name) + '_' + str(i + 1) + '.avi'),
-            cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'),
-            reader.get_meta_data()['fps'], (masks.shape[1], masks.shape[2])))
+            single_path, cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'),
+            reader.get_meta_data()['fps'], crop_shape[::-1]))
+        if gray_path is not None:
+            store_path = os.path.join(gray_path, single_name + '.npz')
+            stores.append(FrameStoreWriter(store_path, crop_shape))
+            save_offset(store_path, (rows, cols))
+        elif padding is not None:
+            save_offset(single_path, (rows, cols))
+
+    def frames():
+        for i, frame in enumerate(reader):
+            yield frame
+            if show_vid:
+                cv2.putText(frame, 'Frame number: ' + str(i), (100, 100),
+                            cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255))
+                cv2.imshow("Original Video", frame)
+                if cv2.waitKey(1) == 27:
+                    cv2.destroyAllWindows()
+                    exit(0)
 
     progress_bar = tqdm(total=reader.count_frames())
     progress_bar.set_description('  Extracting cells')
-    for i, frame in enumerate(reader):
-        mask = cv2.cvtColor(masks[i], cv2.COLOR_GRAY2BGR)
-        for j in range(segments):
-            output = np.ma.masked_where(mask != j + 1, frame)
-            output = np.ma.filled(output, 0)
-            writers[j].write(output)
-
-        if show_vid:
-            cv2.putText(frame, 'Frame number: ' + str(i), (100, 100),
-                        cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255))
-            cv2.imshow("Original Video", frame)
-            if cv2.waitKey(1) == 27:
-                cv2.destroyAllWindows()
-                exit(0)
-        progress_bar.update()
-
+    extract_frames(frames(), masks, boxes, writers, stores or None, n_threads,
+                   progress_bar)
     progress_bar.close()
     if show_vid:
         cv2.destroyAllWindows()
@@ -72,6 +315,8 @@ def extract_cells(vid_path, masks_path, output_path, show_vid=False):
     reader.close()
     for writer in writers:
         writer.release()
+    for store in stores:
+        store.close()
 
 
 if __name__ == "__main__":
@@ -83,5 +328,8 @@ if __name__ == "__main__":
                         help="Path to segmentation masks (.npy)")
     parser.add_argument('-o', '--output', default=os.getcwd(),
                         help="Path to output directory. Default cwd")
+    parser.add_argument('-p', '--padding', type=int, default=None,
+                        help="Crop each cell to its region plus this many pixels. Default full frames")
     args = vars(parser.parse_args())
-    extract_cells(args['input'], args['masks'], args['output'])
+    extract_cells(args['input'], args['masks'], args['output'],
+                  padding=args['padding'])
@@ -0,0 +1,253 @@
+'''
+A compressed, chunked store for the frames of a video. A store is a zip
+file of compressed .npy chunks of consecutive frames, readable with
+np.load, so single frames or ranges of frames can be read without
+decompressing the whole video, and unlike a video file it is lossless.
+'''
+
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Frames per chunk, the unit that is compressed and read at a time.
+CHUNK_SIZE = 32
+
+
+def chunk_name(index):
+    '''
+    Name of the member of a store holding the index-th chunk.
+    '''
+    return 'chunk_{:06d}'.format(index)
+
+
+class FrameStoreWriter:
+    '''
+    Appends frames to a new store, compressing a chunk at a time.
+
+    Parameters
+    ----------
+    path: String
+        Path to the store (.npz).
+    frame_shape: tuple of ints
+        Shape of a frame.
+    dtype: numpy dtype
+        Type of the frames.
+    chunk_size: int
+        Number of frames per chunk.
+    '''
+
+    def __init__(self, path, frame_shape, dtype=np.uint8,
+                 chunk_size=CHUNK_SIZE):
+        self.frame_shape = tuple(frame_shape)
+        self.chunk_size = chunk_size
+        self.frames = 0
+        self._buffer = np.empty((chunk_size,) + self.frame_shape, dtype=dtype)
+        self._chunks = 0
+        self._zip = zipfile.ZipFile(path, mode='w',
+                                    compression=zipfile.ZIP_DEFLATED)
+
+    def _write_member(self, name, array):
+        with self._zip.open(name + '.npy', mode='w',
+                            force_zip64=True) as member:
+            np.lib.format.write_array(member, np.ascontiguousarray(array))
+
+    def _flush(self):
+        filled = self.frames - self._chunks * self.chunk_size
+        if filled == 0 and self._chunks > 0:
+            return
+        self._write_member(chunk_name(self._chunks), self._buffer[:filled])
+        self._chunks += 1
+
+    def append(self, frame):
+        '''
+        Adds a frame to the end of the store.
+
+        Parameters
+        ----------
+        frame: numpy array, shape frame_shape
+            The frame.
+
+        Returns
+        ----------
+        NoneType object
+        '''
+        self._buffer[self.frames % self.chunk_size] = frame
+        self.frames += 1
+        if self.frames % self.chunk_size == 0:
+            self._flush()
+
+    def close(self):
+        '''
+        Writes the last partial chunk and the size of the store.
+
+        Returns
+        ----------
+        NoneType object
+        '''
+        if self._zip is None:
+            return
+        self._flush()
+        self._write_member('meta', np.array(
+            [self.frames, self.chunk_size] + list(self.frame_shape)))
+        self._zip.close()
+        self._zip = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FrameStore:
+    '''
+    Reads the frames of a store. Indexing with an int returns a frame, and
+    with a slice an array of frames, decompressing only the chunks needed.
+    The last chunk read is kept, so reading frames in order decompresses
+    every chunk once.
+
+    Parameters
+    ----------
+    path: String
+        Path to the store (.npz).
+    '''
+
+    def __init__(self, path):
+        self._npz = np.load(path)
+        meta = self._npz['meta']
+        self.chunk_size = int(meta[1])
+        self.shape = (int(meta[0]),) + tuple(int(x) for x in meta[2:])
+        self.ndim = len(self.shape)
+        self._chunk_index = 0
+        self._chunk = self._npz[chunk_name(0)]
+        self.dtype = self._chunk.dtype
+
+    def _frame(self, index):
+        if index < 0:
+            index += self.shape[0]
+        if not 0 <= index < self.shape[0]:
+            raise IndexError('frame {} is out of range for a store of {} '
+                             'frames'.format(index, self.shape[0]))
+        chunk_index, offset = divmod(index, self.chunk_size)
+        if chunk_index != self._chunk_index:
+            self._chunk = self._npz[chunk_name(chunk_index)]
+            self._chunk_index = chunk_index
+        return self._chunk[offset]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            frames = [self._frame(i) for i in range(*index.indices(len(self)))]
+            if len(frames) == 0:
+                return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+            return np.stack(frames)
+        return self._frame(int(index))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._frame(i)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def close(self):
+        self._npz.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_frames(path, frames, chunk_size=CHUNK_SIZE):
+    '''
+    Saves an array of frames as a store.
+
+    Parameters
+    ----------
+    path: String
+        Path to the store (.npz).
+    frames: numpy array, shape (F, ...)
+        The frames.
+    chunk_size: int
+        Number of frames per chunk.
+
+    Returns
+    ----------
+    NoneType object
+    '''
+    with FrameStoreWriter(path, frames.shape[1:], frames.dtype,
+                          chunk_size) as writer:
+        for frame in frames:
+            writer.append(frame)
+
+
+def open_frames(path):
+    '''
+    Opens the frames of a video saved either as a store (.npz) or as a
+    .npy file, without reading them into memory.
+
+    Parameters
+    ----------
+    path: String
+        Path to the frames.
+
+    Returns
+    ----------
+    frames: FrameStore or numpy memmap, shape (F, H, W)
+        The frames, indexable by frame.
+    '''
+    if path.endswith('.npz'):
+        return FrameStore(path)
+    return np.load(path, mmap_mode='r')
+
+
+def close_frames(frames):
+    '''
+    Closes frames opened with open_frames. A store holds its file open
+    until it is closed; a memmap is released once it is no longer used.
+    '''
+    if isinstance(frames, FrameStore):
+        frames.close()
+
+
+def read_frame(frames, index):
+    '''
+    Reads a frame into memory, from a store, memmap or array.
+    '''
+    return np.array(frames[index])
+
+
+def prefetch(frames, indices, depth=2):
+    '''
+    Iterates over frames while a background thread reads the next ones,
+    so that decompressing or paging in a frame overlaps with the work done
+    on the previous one. At most depth + 1 frames are in memory at once.
+
+    Parameters
+    ----------
+    frames: FrameStore, numpy memmap or numpy array, shape (F, ...)
+        The frames.
+    indices: iterable of ints
+        Indices of the frames to read, in order.
+    depth: int
+        Number of frames read ahead.
+
+    Yields
+    ----------
+    frame: numpy array
+        The next frame.
+    '''
+    with ThreadPoolExecutor(1) as pool:
+        pending = deque()
+        for index in indices:
+            pending.append(pool.submit(read_frame, frames, index))
+            if len(pending) > depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
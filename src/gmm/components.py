@@ -0,0 +1,266 @@
+import numpy as np
+import skimage.feature as feature
+
+from ornet.gmm import params
+from ornet.measure import _det2, _inv2
+
+
+def mahalanobis(points, means, covars):
+    """
+    Squared Mahalanobis distance of every point to every component.
+
+    Parameters
+    ----------
+    points : array, shape (n, 2)
+        The points.
+    means : array, shape (k, 2)
+        Component means.
+    covars : array, shape (k, 2, 2)
+        Component covariances.
+
+    Returns
+    -------
+    dist : array, shape (n, k)
+        (x_n - mu_k)' inv(sigma_k) (x_n - mu_k).
+    """
+    delta = points[:, np.newaxis, :] - means[np.newaxis, :, :]
+    return np.einsum('nka,kab,nkb->nk', delta, _inv2(covars), delta)
+
+
+def prune_components(weights, means, covars, ids, min_weight=1e-3):
+    """
+    Removes the components that no longer explain any part of the image.
+
+    Parameters
+    ----------
+    weights : array, shape (k,)
+        Mixing coefficients.
+    means : array, shape (k, 2)
+        Component means.
+    covars : array, shape (k, 2, 2)
+        Component covariances.
+    ids : array, shape (k,)
+        Identifier of every component.
+    min_weight : float
+        Components lighter than this die.
+
+    Returns
+    -------
+    weights, means, covars, ids : arrays
+        The surviving components, with the weights renormalized.
+    """
+    keep = weights >= min_weight
+    if not keep.any():
+        keep[np.argmax(weights)] = True
+    weights = weights[keep] / weights[keep].sum()
+    return weights, means[keep], covars[keep], ids[keep]
+
+
+def merge_components(weights, means, covars, ids, merge_tol=2.0,
+                     return_absorbed=False):
+    """
+    Merges pairs of components whose means lie within merge_tol standard
+    deviations of each other, as happens when two parts of a cell fuse.
+    The merged component matches the first two moments of the pair and
+    keeps the identifier of the heavier one; a component takes part in at
+    most one merge per call.
+
+    Parameters
+    ----------
+    weights : array, shape (k,)
+        Mixing coefficients.
+    means : array, shape (k, 2)
+        Component means.
+    covars : array, shape (k, 2, 2)
+        Component covariances.
+    ids : array, shape (k,)
+        Identifier of every component.
+    merge_tol : float
+        Largest Mahalanobis distance, under either component, between the
+        means of a pair that is merged.
+    return_absorbed : boolean
+        True also returns the identifier each component absorbed.
+
+    Returns
+    -------
+    weights, means, covars, ids : arrays
+        The components after merging.
+    absorbed : array, shape (m,)
+        Identifier of the component each one absorbed, -1 if none. Only
+        returned if return_absorbed is True.
+    """
+    k = weights.shape[0]
+    dist = mahalanobis(means, means, covars)
+    dist = np.sqrt(np.minimum(dist, dist.T))
+    dist[np.tril_indices(k)] = np.inf
+    merged = np.zeros(k, dtype=bool)
+    absorbed = np.full(k, -1)
+    weights, means, covars = weights.copy(), means.copy(), covars.copy()
+    for pair in np.argsort(dist, axis=None):
+        i, j = np.unravel_index(pair, dist.shape)
+        if dist[i, j] >= merge_tol:
+            break
+        if merged[i] or merged[j]:
+            continue
+        if weights[j] > weights[i]:
+            i, j = j, i
+        w = weights[i] + weights[j]
+        mu = (weights[i] * means[i] + weights[j] * means[j]) / w
+        di, dj = means[i] - mu, means[j] - mu
+        covars[i] = (weights[i] * (covars[i] + np.outer(di, di)) +
+                     weights[j] * (covars[j] + np.outer(dj, dj))) / w
+        weights[i], means[i] = w, mu
+        merged[i] = merged[j] = True
+        absorbed[i] = ids[j]
+        weights[j] = 0
+
+    keep = weights > 0
+    if return_absorbed:
+        return (weights[keep], means[keep], covars[keep], ids[keep],
+                absorbed[keep])
+    return weights[keep], means[keep], covars[keep], ids[keep]
+
+
+def mixture_density(points, weights, means, covars):
+    """
+    Density of the mixture at every point.
+
+    Parameters
+    ----------
+    points : array, shape (n, 2)
+        The points.
+    weights : array, shape (k,)
+        Mixing coefficients.
+    means : array, shape (k, 2)
+        Component means.
+    covars : array, shape (k, 2, 2)
+        Component covariances.
+
+    Returns
+    -------
+    density : array, shape (n,)
+        The mixture density at every point.
+    """
+    norm = weights / (2 * np.pi * np.sqrt(_det2(covars)))
+    return np.exp(-0.5 * mahalanobis(points, means, covars)) @ norm
+
+
+def spawn_components(img, weights, means, covars, ids, next_id,
+                     threshold_abs=6, min_distance=10, birth_ratio=2.0,
+                     merge_tol=2.0, stable=None):
+    """
+    Adds a component at every peak of the image that the current
+    components fail to explain, i.e. where the image is more than
+    birth_ratio times brighter than the mixture predicts: a new or
+    broken-off part of the cell, or parts that a single stretched
+    component covers as they come apart. New components start from the
+    local moments of the image, as in params.image_init, and get new
+    identifiers.
+
+    A component that had to absorb a newborn is too wide to predict its
+    own peak, so the peak would be reborn, and merged again, on every
+    frame. No component is born within merge_tol of such stable
+    components.
+
+    Parameters
+    ----------
+    img : array, shape (H, W)
+        The frame.
+    weights : array, shape (k,)
+        Mixing coefficients.
+    means : array, shape (k, 2)
+        Component means.
+    covars : array, shape (k, 2, 2)
+        Component covariances.
+    ids : array, shape (k,)
+        Identifier of every component.
+    next_id : integer
+        Identifier of the first new component.
+    threshold_abs : integer
+        See params.image_init.
+    min_distance : integer
+        See params.image_init.
+    birth_ratio : float
+        Ratio of the observed to the predicted intensity above which a
+        peak is unexplained.
+    merge_tol : float
+        Mahalanobis distance, under either component, from a stable
+        component within which no component is born, see
+        merge_components.
+    stable : array, shape (k,)
+        True for the stable components (default: None, no component is
+        stable).
+
+    Returns
+    -------
+    weights, means, covars, ids : arrays
+        The components, new ones last.
+    next_id : integer
+        Identifier of the next new component.
+    """
+    peaks = feature.peak_local_max(img, min_distance=min_distance,
+                                   threshold_abs=threshold_abs)
+    if peaks.shape[0] == 0:
+        return weights, means, covars, ids, next_id
+
+    predicted = img.sum(dtype=float) * mixture_density(
+        peaks.astype(float), weights, means, covars)
+    born = peaks[img[peaks[:, 0], peaks[:, 1]] > birth_ratio * predicted]
+    if born.shape[0] == 0:
+        return weights, means, covars, ids, next_id
+
+    window = 2 * min_distance + 1
+    born_covars = params.local_covariance(img, window)[born[:, 0],
+                                                       born[:, 1]]
+    born_covars += 1e-6 * np.eye(2)
+
+    if stable is not None and stable.any():
+        born_means = born.astype(float)
+        dist = np.minimum(
+            mahalanobis(born_means, means[stable], covars[stable]),
+            mahalanobis(means[stable], born_means, born_covars).T)
+        apart = np.sqrt(dist.min(axis=1)) >= merge_tol
+        born, born_covars = born[apart], born_covars[apart]
+    n = born.shape[0]
+    if n == 0:
+        return weights, means, covars, ids, next_id
+    # Newborns start as heavy as an average component.
+    weights = np.concatenate([weights, np.full(n, weights.mean())])
+    weights /= weights.sum()
+    means = np.concatenate([means, born.astype(float)])
+    covars = np.concatenate([covars, born_covars])
+    ids = np.concatenate([ids, np.arange(next_id, next_id + n)])
+    return weights, means, covars, ids, next_id + n
+
+
+def pad_components(fits, k):
+    """
+    Lays out the components of every frame by identifier, so a component
+    keeps its column across frames. Components absent from a frame have
+    zero weight and NaN parameters.
+
+    Parameters
+    ----------
+    fits : list of tuples
+        (weights, means, covars, precisions, ids) of every frame.
+    k : integer
+        Number of identifiers.
+
+    Returns
+    -------
+    means : array, shape (f, k, 2)
+    covars : array, shape (f, k, 2, 2)
+    weights : array, shape (f, k)
+    precisions : array, shape (f, k, 2, 2)
+    """
+    f = len(fits)
+    means = np.full((f, k, 2), np.nan)
+    covars = np.full((f, k, 2, 2), np.nan)
+    weights = np.zeros((f, k))
+    precisions = np.full((f, k, 2, 2), np.nan)
+    for t, (w, mu, cv, pr, ids) in enumerate(fits):
+        weights[t, ids] = w
+        means[t, ids] = mu
+        covars[t, ids] = cv
+        precisions[t, ids] = pr
+    return means, covars, weights, precisions
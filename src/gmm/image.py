@@ -52,3 +52,27 @@ def img_to_px(image):
     # number of times that event is observed.
     X = np.repeat(z, image.flatten(), axis=0)
     return X
+
+
+def img_to_weighted_px(image):
+    """
+    Converts the image to weighted data amenable to a weighted GMM. Rather
+    than repeating each pixel coordinate by its intensity (see img_to_px),
+    every nonzero pixel appears once with its intensity as the weight, so
+    the data grows with the number of lit pixels instead of their sum.
+
+    Parameters
+    ----------
+    image : array, shape (H, W)
+        8-bit grayscale image.
+
+    Returns
+    -------
+    X : array, shape (N, 2)
+        The (i, j) coordinates of the nonzero pixels.
+    weights : array, shape (N,)
+        The intensity of each of those pixels.
+    """
+    rows, cols = np.nonzero(image)
+    X = np.stack([rows, cols], axis=1)
+    return X, image[rows, cols]
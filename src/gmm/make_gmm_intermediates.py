@@ -5,8 +5,32 @@ import joblib
 
 import numpy as np
 
+from ornet.framestore import open_frames, close_frames
 from ornet.gmm.run_gmm import skl_gmm
 
+
+def gmm_from_file(vid_path, skipframes=1):
+    """
+    Runs skl_gmm on a saved video without loading it into memory; frames
+    are read one at a time from the memmap or store.
+
+    Parameters
+    ----------
+    vid_path : string
+        Path to the grayscale video (.npy or .npz store).
+    skipframes : integer
+        Number of frames to skip (downsampling constant).
+
+    Returns
+    -------
+    See skl_gmm.
+    """
+    frames = open_frames(vid_path)
+    try:
+        return skl_gmm(frames, vizual=False, skipframes=skipframes)
+    finally:
+        close_frames(frames)
+
 if __name__ == "__main__":
     cwd = os.getcwd()
     parser = argparse.ArgumentParser(
@@ -23,7 +47,7 @@ if __name__ == "__main__":
     parser.add_argument("-o", "--output", default=os.path.join(cwd, "videos"),
                         help=("Destination path for intermediates."
                               " [DEFAULT: cwd]"))
-    parser.add_argument("-s", "--skipframes", default=1,
+    parser.add_argument("-s", "--skipframes", type=int, default=1,
                         help=("Number of frames to skip (downsample) when"
                               " reading videos. [DEFAULT: 1]"))
     parser.add_argument("--n_jobs", type=int, default=-1,
@@ -35,7 +59,7 @@ if __name__ == "__main__":
         os.mkdir(args['output'])
 
     if os.path.isdir(args['input']):
-        files = filter(lambda x: x.split(".")[-1] in ["npy"],
+        files = filter(lambda x: x.split(".")[-1] in ["npy", "npz"],
                        os.listdir(args['input']))
         prefix = partial(os.path.join, args['input'])
         vidpaths = list(map(prefix, files))
@@ -44,8 +68,7 @@ if __name__ == "__main__":
 
     # Spawn parallel jobs to read the videos in the directory listing.
     out = joblib.Parallel(n_jobs=args['n_jobs'], verbose=10)(
-        joblib.delayed(skl_gmm)
-        (np.load(v), vizual=False, skipframes=args['skipframes'])
+        joblib.delayed(gmm_from_file)(v, skipframes=args['skipframes'])
         for v in vidpaths
     )
 
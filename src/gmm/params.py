@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.ndimage as ndimage
 import skimage.feature as feature
 
 
@@ -23,7 +24,7 @@ def random_init(X, k):
         List of initial, randomized covariances.
     """
     d = 1 if len(X.shape) == 1 else X.shape[1]
-    pi = np.ones(k, dtype=np.float) / k
+    pi = np.ones(k, dtype=float) / k
     if d == 1:
         means = (X.max() - X.min()) * np.random.random(k) + X.min()
         covars = np.abs((X.max() - X.min()) / 10) * np.random.random(k)
@@ -45,7 +46,69 @@ def random_init(X, k):
     return pi, means, covars
 
 
-def image_init(image, k=None, min_distance=1, threshold_abs=None):
+def local_variance(image, window=3):
+    """
+    Variance of the intensities in a window around every pixel, as the mean
+    of the squares minus the squared mean. Windows are cut off at the
+    borders of the image rather than padded.
+
+    Parameters
+    ----------
+    image : array, shape (H, W)
+        The image.
+    window : integer
+        Side of the square window.
+
+    Returns
+    -------
+    var : array, shape (H, W)
+        The variance around every pixel.
+    """
+    image = np.asarray(image, dtype=float)
+    # The fraction of every window inside the image, to undo the padding.
+    inside = ndimage.uniform_filter(np.ones_like(image), window,
+                                    mode='constant')
+    mean = ndimage.uniform_filter(image, window, mode='constant') / inside
+    mean_sq = ndimage.uniform_filter(image ** 2, window,
+                                     mode='constant') / inside
+    return np.maximum(mean_sq - mean ** 2, 0)
+
+
+def local_covariance(image, window):
+    """
+    Covariance of the pixel coordinates in a window around every pixel,
+    weighted by intensity, i.e. the spread of the light around the pixel.
+
+    Parameters
+    ----------
+    image : array, shape (H, W)
+        The image.
+    window : integer
+        Side of the square window.
+
+    Returns
+    -------
+    covars : array, shape (H, W, 2, 2)
+        The covariance around every pixel.
+    """
+    image = np.asarray(image, dtype=float)
+    yy, xx = np.mgrid[:image.shape[0], :image.shape[1]]
+
+    def window_sum(weights):
+        return ndimage.uniform_filter(image * weights, window, mode='constant')
+
+    mass = window_sum(1)
+    mass[mass == 0] = 1
+    y, x = window_sum(yy) / mass, window_sum(xx) / mass
+    covars = np.empty(image.shape + (2, 2))
+    covars[..., 0, 0] = window_sum(yy ** 2) / mass - y ** 2
+    covars[..., 1, 1] = window_sum(xx ** 2) / mass - x ** 2
+    covars[..., 0, 1] = covars[..., 1, 0] = window_sum(yy * xx) / mass - y * x
+    return covars
+
+
+def image_init(image, k=None, min_distance=1, threshold_abs=None,
+               init='variance', window=None):
     """
     Initialization function for 2D histograms, i.e. images.
 
@@ -60,6 +123,16 @@ def image_init(image, k=None, min_distance=1, threshold_abs=None):
         See http://scikit-image.org/docs/dev/api/skimage.feature.html#skimage.feature.peak_local_max.
     threshold_abs : integer
         See http://scikit-image.org/docs/dev/api/skimage.feature.html#skimage.feature.peak_local_max.
+    init : string
+        How covariances are estimated around each peak. 'variance' uses
+        the variance of the intensities around it as a symmetric
+        covariance; 'moments' uses the intensity-weighted covariance of
+        the pixel coordinates around it, which is much closer to the fit
+        (default is 'variance').
+    window : integer
+        Side of the window around each peak (default is 3 for 'variance'
+        and 2 * min_distance + 1, the area each peak has to itself, for
+        'moments').
 
     Returns
     -------
@@ -83,23 +156,22 @@ def image_init(image, k=None, min_distance=1, threshold_abs=None):
     if K == 0:  # sanity check
         print("No peaks found! Adjust your parameters.")
         return [None, None, None]
-    covars = np.zeros(shape=(K, 2, 2))
-    pi = np.zeros(shape=K, dtype=np.float)
-
-    # Now we need to estimate variances. Uhm... any ideas?
-    for index, (i, j) in enumerate(means):
-        pi[index] = image[i, j]  # We'll normalize this later.
-
-        # We're going to do something really naive: we'll use the variance
-        # of the surrounding 8 pixels as the starting value.
-        i_start = i - 1 if i > 0 else 0
-        i_end = i + 2 if i + 1 < image.shape[0] else image.shape[0]
-        j_start = j - 1 if j > 0 else 0
-        j_end = j + 2 if j + 1 < image.shape[1] else image.shape[1]
-
-        # Assign a symmetric covariance.
-        covars[index, 0, 0] = covars[index, 1, 1] = image[i_start:i_end,
-                                                    j_start:j_end].flatten().var()
+    i, j = means[:, 0], means[:, 1]
+    pi = image[i, j].astype(float)  # We'll normalize this later.
+
+    if init == 'variance':
+        # The variance of the surrounding pixels, as a symmetric covariance.
+        var = local_variance(image, 3 if window is None else window)[i, j]
+        covars = var[:, np.newaxis, np.newaxis] * np.eye(2)
+    elif init == 'moments':
+        if window is None:
+            window = 2 * min_distance + 1
+        covars = local_covariance(image, window)[i, j]
+        # A lone bright pixel has no spread; keep the covariance invertible.
+        covars += 1e-6 * np.eye(2)
+    else:
+        raise ValueError("Unknown init '{}', expected 'variance' or "
+                         "'moments'.".format(init))
 
     pi /= pi.sum()  # Make it sum to 1.
 
@@ -1,94 +1,311 @@
+import warnings
+
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.linalg as sla
+from scipy.special import logsumexp
+from sklearn.exceptions import ConvergenceWarning
 from sklearn.mixture import GaussianMixture
 
-from ornet.gmm import image, params, viz
+from ornet.framestore import prefetch
+from ornet.gmm import components, image, params, viz
+from ornet.gmm.weighted import (WeightedGaussianMixture, _features,
+                                _log_prob, em)
+from ornet.measure import _inv2
+
+
+def _fit_frame(gmmodel, img, weighted):
+    """
+    Fits the model to a single frame, either on the intensity-weighted
+    nonzero pixels or on the pixel-replicated point cloud.
+    """
+    if weighted:
+        X, W = image.img_to_weighted_px(img)
+        gmmodel.fit(X, sample_weight=W)
+    else:
+        gmmodel.fit(image.img_to_px(img))
+
+
+def _frame_change(gmmodel, img):
+    """
+    How well the current parameters of the model explain a frame: the
+    average log-likelihood of its pixels and the share of their intensity
+    each component is responsible for, from a single E-step.
+    """
+    X, W = image.img_to_weighted_px(img)
+    total = W.sum()
+    if total == 0:
+        return -np.inf, np.zeros_like(gmmodel.weights_)
+    X, W = X.astype(np.float64), W.astype(np.float64)
+    # Centered like em(), to keep the quadratic features well conditioned.
+    center = W @ X / total
+    log_prob = _log_prob(_features(X - center), gmmodel.weights_,
+                         gmmodel.means_ - center, gmmodel.covariances_)
+    log_norm = logsumexp(log_prob, axis=1)
+    resp = np.exp(log_prob - log_norm[:, np.newaxis])
+    return W @ log_norm / total, W @ resp / total
+
 
+def _set_components(gmmodel, weights, means, covars):
+    """
+    Replaces the components of a fitted model, so the next warm-started
+    fit starts from them.
+    """
+    precisions = _inv2(covars)
+    gmmodel.n_components = weights.shape[0]
+    gmmodel.weights_init = gmmodel.weights_ = weights
+    gmmodel.means_init = gmmodel.means_ = means
+    gmmodel.precisions_init = gmmodel.precisions_ = precisions
+    gmmodel.covariances_ = covars
+    gmmodel.precisions_cholesky_ = np.linalg.inv(
+        np.linalg.cholesky(covars)).transpose(0, 2, 1)
+    # The likelihood of the old components says nothing about convergence.
+    gmmodel.lower_bound_ = -np.inf
 
-def skl_gmm(vid, vizual=False, skipframes=1, threshold_abs=6, min_distance=10):
+
+def iter_skl_gmm(vid, vizual=False, skipframes=1, threshold_abs=6,
+                 min_distance=10, weighted=False, adaptive=False,
+                 skip_tol=1e-3, mass_tol=0.05, cap_tol=1e-2, warm_max_iter=10,
+                 max_iter=100, init='variance', dynamic=False,
+                 min_weight=1e-3, merge_tol=2.0, birth_ratio=2.0):
     """
-    Runs a warm-start GMM over evenly-spaced frames of the video.
+    Runs a warm-start GMM over evenly-spaced frames of the video, yielding
+    the parameters of each frame as soon as it is fit.
 
     Parameters
     ----------
-    vid : array, shape (f, x, y)
-        Video, with f frames and spatial dimensions x by y.
-    vizual : boolean
-        True will show images and nodes (default: False).
-    skipframes : integer
-        Number of frames to skip (downsampling constant).
-    threshold_abs: int
-        Absolute minimum pixel value to be used in 
-        scikit-image's peak_local max function
-    min_distance: int
-        Minimum distance between image peaks that will be 
-        returned by scikit-image's peak_local max function
+    See skl_gmm.
 
-    Returns
-    -------
-    means : array, shape (f, k, 2)
-        The k 2D means for each of f frames.
-    covars : array, shape (f, k, 2, 2)
-        The k covariance matrices (each 2x2) for each of f frames.
-    weights : array, shape (f, k)
-        The k weights for each of f frames.
-    precisions : array, shape (f, k, 2, 2)
-        The k precision matrices for each of f frames.
+    Yields
+    ------
+    means : array, shape (k, 2)
+        The k 2D means of the frame.
+    covars : array, shape (k, 2, 2)
+        The k covariance matrices (each 2x2) of the frame.
+    weights : array, shape (k,)
+        The k weights of the frame.
+    precisions : array, shape (k, 2, 2)
+        The k precision matrices of the frame.
+    n_iter : integer
+        Number of EM iterations run on the frame, 0 if it was skipped.
+    ids : array, shape (k,)
+        Identifier of each component. Without dynamic components these
+        are 0 to k - 1 on every frame.
     """
     img = vid[0]
     if vizual:
         plt.imshow(img)
         plt.show()
-    X = image.img_to_px(img)
     PI, MU, CV = params.image_init(img, k=None,
                                    min_distance=min_distance,
-                                   threshold_abs=threshold_abs)
+                                   threshold_abs=threshold_abs, init=init)
 
     PR = np.array(list(map(sla.inv, CV)))
-    gmmodel = GaussianMixture(n_components=CV.shape[0], weights_init=PI,
-                              means_init=MU, precisions_init=PR)
-    gmmodel.fit(X)
+    mixture = WeightedGaussianMixture if weighted else GaussianMixture
+    gmmodel = mixture(n_components=CV.shape[0], weights_init=PI,
+                      means_init=MU, precisions_init=PR, max_iter=max_iter)
+    _fit_frame(gmmodel, img, weighted)
+    # Whether the last fit ran to convergence rather than to max_iter.
+    settled = gmmodel.n_iter_ < max_iter
     if vizual:
         viz.plot_results(gmmodel.means_, gmmodel.covariances_,
                          0, img.shape[1], 0, img.shape[0], 0, 'this')
-
-    covars = [gmmodel.covariances_]
-    means = [gmmodel.means_]
-    weights = [gmmodel.weights_]
-    precisions = [gmmodel.precisions_]
+    ids = np.arange(CV.shape[0])
+    next_id = ids.shape[0]
+    born = stable_ids = np.zeros(0, dtype=int)
+    yield (gmmodel.means_, gmmodel.covariances_, gmmodel.weights_,
+           gmmodel.precisions_, gmmodel.n_iter_, ids)
 
     # set warm start to true to use previous parameters
     gmmodel.warm_start = True
 
-    for i in range(0 + skipframes, vid.shape[0], skipframes):
-        img = vid[i]
+    indices = range(0 + skipframes, vid.shape[0], skipframes)
+    for img in prefetch(vid, indices):
         if vizual:
             plt.imshow(img)
             plt.show()
 
-        X = image.img_to_px(img)
-        gmmodel.fit(X)
-        covars = np.append(covars, [gmmodel.covariances_], axis=0)
-        means = np.append(means, [gmmodel.means_], axis=0)
-        weights = np.append(weights, [gmmodel.weights_], axis=0)
-        precisions = np.append(precisions, [gmmodel.precisions_], axis=0)
+        changed = False
+        if dynamic:
+            comps = components.prune_components(
+                gmmodel.weights_, gmmodel.means_, gmmodel.covariances_, ids,
+                min_weight)
+            *comps, absorbed = components.merge_components(
+                *comps, merge_tol, return_absorbed=True)
+            # Absorbing a newborn makes a component stable, so that its
+            # peak is not reborn and merged again on every frame.
+            stable_ids = np.union1d(stable_ids,
+                                    comps[3][np.isin(absorbed, born)])
+            *comps, last_id = components.spawn_components(
+                img, *comps, next_id, threshold_abs, min_distance, birth_ratio,
+                merge_tol, np.isin(comps[3], stable_ids))
+            born = np.arange(next_id, last_id)
+            next_id = last_id
+            changed = not np.array_equal(comps[3], ids)
+            if changed:
+                _set_components(gmmodel, *comps[:3])
+                ids = comps[3]
 
+        # A frame the parameters explain about as well as the last frame
+        # they settled on, with each component carrying about the same
+        # share of the intensity, has barely moved: it keeps them. A frame
+        # that moved a little gets a short refit.
+        skip = capped = False
+        if adaptive and not changed:
+            score, mass = _frame_change(gmmodel, img)
+            delta = abs(gmmodel.lower_bound_ - score)
+            steady = np.abs(mass - gmmodel.weights_).max() < mass_tol
+            skip = steady and delta < skip_tol and settled
+            capped = steady and delta < cap_tol
+        if skip:
+            n_iter = 0
+        else:
+            gmmodel.max_iter = warm_max_iter if capped else max_iter
+            with warnings.catch_warnings():
+                if capped:
+                    # Stopping short of convergence is the point here.
+                    warnings.simplefilter('ignore', ConvergenceWarning)
+                _fit_frame(gmmodel, img, weighted)
+            n_iter = gmmodel.n_iter_
+            settled = n_iter < gmmodel.max_iter
         if vizual:
             viz.plot_results(gmmodel.means_, gmmodel.covariances_,
                              0, img.shape[1], 0, img.shape[0], 0, 'this')
+        yield (gmmodel.means_, gmmodel.covariances_, gmmodel.weights_,
+               gmmodel.precisions_, n_iter, ids)
+
+
+def skl_gmm(vid, vizual=False, skipframes=1, threshold_abs=6, min_distance=10,
+            weighted=False, adaptive=False, skip_tol=1e-3, mass_tol=0.05,
+            cap_tol=1e-2, warm_max_iter=10, max_iter=100, init='variance',
+            dynamic=False, min_weight=1e-3, merge_tol=2.0, birth_ratio=2.0,
+            return_n_iter=False, callback=None):
+    """
+    Runs a warm-start GMM over evenly-spaced frames of the video. The
+    parameters of each frame are written into arrays allocated up front,
+    see iter_skl_gmm to consume them one frame at a time instead.
+
+    Parameters
+    ----------
+    vid : array, shape (f, x, y)
+        Video, with f frames and spatial dimensions x by y. A memmap or
+        FrameStore is read a frame at a time, in a background thread.
+    vizual : boolean
+        True will show images and nodes (default: False).
+    skipframes : integer
+        Number of frames to skip (downsampling constant).
+    threshold_abs: int
+        Absolute minimum pixel value to be used in 
+        scikit-image's peak_local max function
+    min_distance: int
+        Minimum distance between image peaks that will be 
+        returned by scikit-image's peak_local max function
+    weighted: boolean
+        True fits each frame on its nonzero pixels, weighted by intensity,
+        instead of repeating every pixel by its intensity (default: False).
+        Both give the same fit; the weighted form needs far less memory.
+    adaptive: boolean
+        True skips refitting frames that the previous parameters already
+        explain, i.e. whose average log-likelihood is within skip_tol of
+        that of the last frame fit and whose intensity each component
+        takes about the same share of, and caps the EM iterations of
+        frames that changed a little (default: False).
+    skip_tol: float
+        Largest change in average log-likelihood, either way, for which a
+        frame is skipped in adaptive mode.
+    mass_tol: float
+        Largest change in the share of intensity of any component for
+        which a frame is skipped or its fit capped in adaptive mode.
+    cap_tol: float
+        Largest change in average log-likelihood for which the fit of a
+        frame is capped at warm_max_iter EM iterations in adaptive mode.
+    warm_max_iter: integer
+        Maximum number of EM iterations of a capped fit.
+    max_iter: integer
+        Maximum number of EM iterations per frame.
+    init: string
+        How the first frame is initialized, see params.image_init.
+    dynamic: boolean
+        True lets components appear, split, merge and die between frames
+        as the cell fragments and fuses, instead of keeping the components
+        of the first frame (default: False). The outputs then have a
+        column for every component that ever existed, see
+        components.pad_components.
+    min_weight: float
+        Components lighter than this die, see
+        components.prune_components.
+    merge_tol: float
+        Components closer than this many standard deviations merge, see
+        components.merge_components.
+    birth_ratio: float
+        Peaks this many times brighter than the mixture predicts spawn a
+        component, see components.spawn_components.
+    return_n_iter: boolean
+        True also returns the number of EM iterations of each frame.
+    callback: callable
+        Called as callback(t, means, covars, weights) with the components
+        present in the t-th fitted frame as soon as it is fit, e.g. to
+        monitor the video while it is processed (default: None).
+
+    Returns
+    -------
+    means : array, shape (f, k, 2)
+        The k 2D means for each of f frames; NaN for components that are
+        absent from a frame.
+    covars : array, shape (f, k, 2, 2)
+        The k covariance matrices (each 2x2) for each of f frames.
+    weights : array, shape (f, k)
+        The k weights for each of f frames; 0 for absent components.
+    precisions : array, shape (f, k, 2, 2)
+        The k precision matrices for each of f frames.
+    n_iter : array, shape (f,)
+        The number of EM iterations of each frame, 0 for frames skipped
+        in adaptive mode. Only returned if return_n_iter is True.
+    """
+    frames = len(range(0, vid.shape[0], skipframes))
+    fits = iter_skl_gmm(vid, vizual, skipframes, threshold_abs,
+                        min_distance, weighted, adaptive, skip_tol, mass_tol,
+                        cap_tol, warm_max_iter, max_iter, init, dynamic,
+                        min_weight, merge_tol, birth_ratio)
+    if dynamic:
+        # The number of components is only known at the end.
+        layouts, n_iter = [], np.empty(frames, dtype=int)
+        for t, (mu, cv, w, pr, n, ids) in enumerate(fits):
+            layouts.append((w, mu, cv, pr, ids))
+            n_iter[t] = n
+            if callback is not None:
+                callback(t, mu, cv, w)
+        k = 1 + max(ids.max() for _, _, _, _, ids in layouts)
+        means, covars, weights, precisions = components.pad_components(
+            layouts, k)
+    else:
+        for t, fit in enumerate(fits):
+            if t == 0:
+                outs = [np.empty((frames,) + np.shape(x),
+                                 dtype=np.asarray(x).dtype) for x in fit[:5]]
+            for out, x in zip(outs, fit):
+                out[t] = x
+            if callback is not None:
+                callback(t, fit[0], fit[1], fit[2])
+        means, covars, weights, precisions, n_iter = outs
 
+    if return_n_iter:
+        return means, covars, weights, precisions, n_iter
     return means, covars, weights, precisions
 
 
-def run_gmm(vid, vizual=False, skipframes=1, threshold_abs=6, min_distance=10):
+def run_gmm(vid, vizual=False, skipframes=1, threshold_abs=6, min_distance=10,
+            max_iter=100, tol=1e-3):
     """
     Runs packaged GMM reimplementation over evenly-spaced frames of the video.
+    Each frame is fit on its intensity-weighted nonzero pixels, warm-started
+    from the previous frame's parameters.
 
     Parameters
     ----------
     vid : array, shape (f, x, y)
-        Video, with f frames and spatial dimensions x by y.
+        Video, with f frames and spatial dimensions x by y. A memmap or
+        FrameStore is read a frame at a time, in a background thread.
     vizual : boolean
         True will show images and nodes (default: False).
     skipframes : integer
@@ -99,6 +316,10 @@ def run_gmm(vid, vizual=False, skipframes=1, threshold_abs=6, min_distance=10):
     min_distance: int
         Minimum distance between image peaks that will be 
         returned by scikit-image's peak_local max function
+    max_iter : integer
+        Maximum number of EM iterations per frame.
+    tol : float
+        Early-stopping threshold on the change in average log-likelihood.
 
     Returns
     -------
@@ -108,5 +329,33 @@ def run_gmm(vid, vizual=False, skipframes=1, threshold_abs=6, min_distance=10):
         The k covariance matrices (each 2x2) for each of f frames.
     PI : array, shape (f, k)
         The mixing coefficients for each frame.
+    PR : array, shape (f, k, 2, 2)
+        The k precision matrices for each of f frames.
     """
-    return
+    img = vid[0]
+    pi, mu, sigma = params.image_init(img, k=None,
+                                      min_distance=min_distance,
+                                      threshold_abs=threshold_abs)
+    mu = mu.astype(np.float64)
+
+    indices = range(0, vid.shape[0], skipframes)
+    k = pi.shape[0]
+    MU = np.empty((len(indices), k, 2))
+    CV = np.empty((len(indices), k, 2, 2))
+    PI = np.empty((len(indices), k))
+
+    for t, img in enumerate(prefetch(vid, indices)):
+        if vizual:
+            plt.imshow(img)
+            plt.show()
+
+        X, W = image.img_to_weighted_px(img)
+        pi, mu, sigma, _, _ = em(X.astype(np.float64), W, pi, mu, sigma,
+                                 max_iter=max_iter, tol=tol)
+        MU[t], CV[t], PI[t] = mu, sigma, pi
+
+        if vizual:
+            viz.plot_results(mu, sigma, 0, img.shape[1], 0, img.shape[0], 0,
+                             'this')
+
+    return MU, CV, PI, _inv2(CV)
@@ -0,0 +1,245 @@
+import warnings
+
+import numpy as np
+from scipy.special import logsumexp
+from sklearn.cluster import KMeans
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.mixture import GaussianMixture
+
+from ornet.measure import _det2, _inv2
+
+
+class WeightedGaussianMixture(GaussianMixture):
+    """
+    GaussianMixture whose fit accepts per-sample weights.
+
+    Fitting with integer weights is equivalent to fitting the data with each
+    sample repeated that many times, which is how image.img_to_px turns an
+    image into a point cloud. Passing the nonzero pixel coordinates with
+    their intensities as weights gives the same EM updates while touching
+    each pixel once per iteration. All constructor arguments are those of
+    sklearn.mixture.GaussianMixture.
+
+    Weighted fits run em() below and only use the public parameters and
+    fitted attributes of GaussianMixture, so they do not depend on its
+    internals. They are limited to 2D data and full covariances, like em.
+    """
+
+    def fit(self, X, y=None, sample_weight=None):
+        """
+        Estimates the model parameters with the (weighted) EM algorithm.
+
+        Parameters
+        ----------
+        X : array, shape (N, d)
+            The data.
+        y : ignored
+            Present for scikit-learn API consistency.
+        sample_weight : array, shape (N,)
+            Non-negative weight of each data point (default: None, all
+            points weigh the same). Zero-weight points are dropped.
+
+        Returns
+        -------
+        self : WeightedGaussianMixture
+            The fitted model.
+        """
+        if sample_weight is None:
+            return super().fit(X, y)
+
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim != 2 or X.shape[1] != 2 or self.covariance_type != 'full':
+            raise ValueError('Weighted fits need 2D data and full '
+                             'covariances.')
+        sample_weight = np.asarray(sample_weight, dtype=np.float64)
+        keep = sample_weight > 0
+        X, sample_weight = X[keep], sample_weight[keep]
+
+        # Same warm start as GaussianMixture: the previous parameters, and
+        # the previous bound to test convergence against.
+        if self.warm_start and hasattr(self, 'converged_'):
+            pi, mu, sigma = self.weights_, self.means_, self.covariances_
+            ll = self.lower_bound_
+        else:
+            pi, mu, sigma = self._initial_parameters(X, sample_weight)
+            ll = -np.inf
+
+        pi, mu, sigma, ll, n_iter = em(X, sample_weight, pi, mu, sigma,
+                                       self.max_iter, self.tol,
+                                       self.reg_covar, ll)
+        self.converged_ = n_iter < self.max_iter
+        if not self.converged_:
+            warnings.warn('Weighted EM did not converge. Try different '
+                          'init parameters, or increase max_iter or tol.',
+                          ConvergenceWarning)
+        self.weights_, self.means_, self.covariances_ = pi, mu, sigma
+        self.precisions_ = _inv2(sigma)
+        self.precisions_cholesky_ = np.linalg.inv(
+            np.linalg.cholesky(sigma)).transpose(0, 2, 1)
+        self.lower_bound_ = ll
+        self.n_iter_ = n_iter
+        self.n_features_in_ = X.shape[1]
+        return self
+
+    def _initial_parameters(self, X, sample_weight):
+        """
+        The given weights_init, means_init and precisions_init, with the
+        missing ones computed from a weighted k-means clustering, as
+        GaussianMixture does with init_params='kmeans'.
+        """
+        if (self.weights_init is None or self.means_init is None or
+                self.precisions_init is None):
+            labels = KMeans(self.n_components, n_init=1,
+                            random_state=self.random_state).fit(
+                X, sample_weight=sample_weight).labels_
+            resp = np.zeros((X.shape[0], self.n_components))
+            resp[np.arange(X.shape[0]), labels] = sample_weight
+            nk = resp.sum(axis=0) + 10 * np.finfo(np.float64).eps
+            pi = nk / nk.sum()
+            mu = resp.T @ X / nk[:, np.newaxis]
+            diff = X[np.newaxis] - mu[:, np.newaxis]
+            sigma = (np.einsum('nk,kna,knb->kab', resp, diff, diff) /
+                     nk[:, np.newaxis, np.newaxis] +
+                     self.reg_covar * np.eye(2))
+        if self.weights_init is not None:
+            pi = np.asarray(self.weights_init, dtype=np.float64)
+        if self.means_init is not None:
+            mu = np.asarray(self.means_init, dtype=np.float64)
+        if self.precisions_init is not None:
+            sigma = _inv2(np.asarray(self.precisions_init, dtype=np.float64))
+        return pi, mu, sigma
+
+
+def _features(X):
+    """
+    Quadratic features of 2D points, so that every component's Mahalanobis
+    distance is a single matrix product (see _log_prob).
+
+    Parameters
+    ----------
+    X : array, shape (N, 2)
+        The data.
+
+    Returns
+    -------
+    F : array, shape (N, 6)
+        Columns x0^2, x0*x1, x1^2, x0, x1, 1.
+    """
+    x0, x1 = X[:, 0], X[:, 1]
+    return np.stack([x0 * x0, x0 * x1, x1 * x1, x0, x1, np.ones_like(x0)],
+                    axis=1)
+
+
+def _log_prob(F, pi, mu, sigma):
+    """
+    Weighted log-densities of every point under every component.
+
+    Parameters
+    ----------
+    F : array, shape (N, 6)
+        Quadratic features of the data, from _features.
+    pi : array, shape (k,)
+        Mixing coefficients.
+    mu : array, shape (k, 2)
+        Component means.
+    sigma : array, shape (k, 2, 2)
+        Component covariances.
+
+    Returns
+    -------
+    log_prob : array, shape (N, k)
+        log(pi_k) + log N(x_n | mu_k, sigma_k).
+    """
+    det = _det2(sigma)
+    P = _inv2(sigma, det)
+    Pmu = np.einsum('kab,kb->ka', P, mu)
+    # (x - mu)' P (x - mu) expanded into the quadratic features.
+    coefs = np.stack([P[:, 0, 0], P[:, 0, 1] + P[:, 1, 0], P[:, 1, 1],
+                      -2 * Pmu[:, 0], -2 * Pmu[:, 1],
+                      np.einsum('ka,ka->k', mu, Pmu)])
+    mahala = np.maximum(F @ coefs, 0)
+    return (np.log(pi) - np.log(2 * np.pi) - 0.5 * np.log(det)
+            - 0.5 * mahala)
+
+
+def em(X, weights, pi, mu, sigma, max_iter=100, tol=1e-3, reg_covar=1e-6,
+       ll=-np.inf):
+    """
+    Weighted EM for a 2D, full-covariance gaussian mixture, updating all
+    components at once. Starts from the given parameters, so passing the
+    previous frame's result gives a warm start.
+
+    Parameters
+    ----------
+    X : array, shape (N, 2)
+        The data.
+    weights : array, shape (N,)
+        Non-negative weight of each data point, e.g. pixel intensities.
+    pi : array, shape (k,)
+        Initial mixing coefficients.
+    mu : array, shape (k, 2)
+        Initial means.
+    sigma : array, shape (k, 2, 2)
+        Initial covariances.
+    max_iter : integer
+        Maximum number of EM iterations.
+    tol : float
+        EM stops once the average log-likelihood per unit weight changes
+        by less than this amount (same criterion as scikit-learn).
+    reg_covar : float
+        Added to the covariance diagonals to keep them positive definite.
+    ll : float
+        Average log-likelihood the first iteration is compared to
+        (default: -inf). scikit-learn passes the last bound of the
+        previous fit on warm starts, which can stop EM after one
+        iteration.
+
+    Returns
+    -------
+    pi : array, shape (k,)
+        Fitted mixing coefficients.
+    mu : array, shape (k, 2)
+        Fitted means.
+    sigma : array, shape (k, 2, 2)
+        Fitted covariances.
+    ll : float
+        Average log-likelihood per unit weight at the last E-step.
+    n_iter : integer
+        Number of iterations performed.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    if X.shape[0] == 0 or weights.sum() == 0:
+        return pi, mu, sigma, ll, 0
+
+    # Centering the coordinates keeps the moment-based covariance update
+    # well conditioned.
+    total = weights.sum()
+    center = weights @ X / total
+    X = X - center
+    mu = mu - center
+    F = _features(X)
+
+    n_iter = 0
+    for n_iter in range(1, max_iter + 1):
+        # E-step
+        log_prob = _log_prob(F, pi, mu, sigma)
+        log_norm = logsumexp(log_prob, axis=1)
+        prev_ll, ll = ll, weights @ log_norm / total
+        resp = np.exp(log_prob - log_norm[:, np.newaxis])
+        resp *= weights[:, np.newaxis]
+
+        # M-step, from the weighted first and second moments.
+        moments = resp.T @ F
+        nk = moments[:, 5] + 10 * np.finfo(np.float64).eps
+        mu = moments[:, 3:5] / nk[:, np.newaxis]
+        second = moments[:, :3] / nk[:, np.newaxis]
+        sigma = np.empty((pi.shape[0], 2, 2))
+        sigma[:, 0, 0] = second[:, 0] - mu[:, 0] * mu[:, 0] + reg_covar
+        sigma[:, 0, 1] = sigma[:, 1, 0] = second[:, 1] - mu[:, 0] * mu[:, 1]
+        sigma[:, 1, 1] = second[:, 2] - mu[:, 1] * mu[:, 1] + reg_covar
+        pi = nk / nk.sum()
+
+        if abs(ll - prev_ll) < tol:
+            break
+
+    return pi, mu + center, sigma, ll, n_iter
@@ -84,3 +84,149 @@ def multivariate_hellinger(u1, cov1, u2, cov2, gamma=0.00125):
     mahala = (u1 - u2).dot(np.linalg.pinv(mcov)).dot(u1 - u2)
     h = np.exp(-gamma * mahala) * dets
     return 1 - np.sqrt(1 - h)
+
+
+def _det2(s):
+    """
+    Closed-form determinants for a stack of 2x2 matrices.
+
+    Parameters
+    ----------
+    s : array, shape (..., 2, 2)
+        Stack of 2x2 matrices.
+
+    Returns
+    -------
+    det : array, shape (...)
+        Determinant of each matrix.
+    """
+    return s[..., 0, 0] * s[..., 1, 1] - s[..., 0, 1] * s[..., 1, 0]
+
+
+def _inv2(s, det=None):
+    """
+    Closed-form inverses for a stack of 2x2 matrices.
+
+    Parameters
+    ----------
+    s : array, shape (..., 2, 2)
+        Stack of 2x2 matrices.
+    det : array, shape (...)
+        Precomputed determinants of s (default: computed here).
+
+    Returns
+    -------
+    inv : array, shape (..., 2, 2)
+        Inverse of each matrix.
+    """
+    if det is None:
+        det = _det2(s)
+    inv = np.empty(s.shape, dtype=np.result_type(s, np.float64))
+    inv[..., 0, 0] = s[..., 1, 1]
+    inv[..., 0, 1] = -s[..., 0, 1]
+    inv[..., 1, 0] = -s[..., 1, 0]
+    inv[..., 1, 1] = s[..., 0, 0]
+    inv /= det[..., None, None]
+    return inv
+
+
+def batch_kl(means, covars):
+    """
+    All-pairs multivariate KL-divergence between 2D gaussians. Entry (i, j)
+    of the output is equal to multivariate_kl(means[i], covars[i], means[j],
+    covars[j]); any leading dimensions (e.g. frames) are broadcast over.
+
+    Parameters
+    ----------
+    means : array, shape (..., k, 2)
+        Means of the k distributions.
+    covars : array, shape (..., k, 2, 2)
+        Covariance matrices of the k distributions.
+
+    Returns
+    -------
+    kl : array, shape (..., k, k)
+        Pairwise KL-divergences.
+    """
+    det = _det2(covars)
+    inv = _inv2(covars, det)
+    deltamu = means[..., None, :, :] - means[..., :, None, :]
+    a = np.log(det[..., None, :] / det[..., :, None])
+    b = np.einsum('...jab,...iba->...ij', inv, covars)
+    c = np.einsum('...ija,...jab,...ijb->...ij', deltamu, inv, deltamu)
+    d = - means.shape[-1]
+    return 0.5 * (a + b + c + d)
+
+
+def batch_js(means, covars):
+    """
+    All-pairs Jensen-Shannon divergence between 2D gaussians, matching
+    multivariate_js for every (i, j) pair.
+
+    Parameters
+    ----------
+    means : array, shape (..., k, 2)
+        Means of the k distributions.
+    covars : array, shape (..., k, 2, 2)
+        Covariance matrices of the k distributions.
+
+    Returns
+    -------
+    js : array, shape (..., k, k)
+        Pairwise JS-divergences.
+    """
+    kl = batch_kl(means, covars)
+    return 0.5 * (kl + np.swapaxes(kl, -1, -2))
+
+
+def pair_hellinger(means1, covars1, means2, covars2, gamma=0.00125):
+    """
+    Hellinger distance between matching pairs of 2D gaussians, matching
+    multivariate_hellinger for every pair; the inputs broadcast against
+    each other, so any subset of pairs can be evaluated.
+
+    Parameters
+    ----------
+    means1, means2 : array, shape (..., 2)
+        Means of the first and second distribution of every pair.
+    covars1, covars2 : array, shape (..., 2, 2)
+        Covariance matrices of the first and second distribution.
+    gamma: float
+        Probability measure
+
+    Returns
+    -------
+    hellinger : array, shape (...)
+        Hellinger distance of every pair.
+    """
+    mcov = 0.5 * covars1 + 0.5 * covars2
+    mdet = _det2(mcov)
+    dets = np.sqrt(np.sqrt(_det2(covars1)) * np.sqrt(_det2(covars2)) / mdet)
+    du = means1 - means2
+    mahala = np.einsum('...a,...ab,...b->...', du, _inv2(mcov, mdet), du)
+    h = np.exp(-gamma * mahala) * dets
+    return 1 - np.sqrt(1 - h)
+
+
+def batch_hellinger(means, covars, gamma=0.00125):
+    """
+    All-pairs Hellinger distance between 2D gaussians, matching
+    multivariate_hellinger for every (i, j) pair.
+
+    Parameters
+    ----------
+    means : array, shape (..., k, 2)
+        Means of the k distributions.
+    covars : array, shape (..., k, 2, 2)
+        Covariance matrices of the k distributions.
+    gamma: float
+        Probability measure
+
+    Returns
+    -------
+    hellinger : array, shape (..., k, k)
+        Pairwise Hellinger distances.
+    """
+    return pair_hellinger(means[..., :, None, :], covars[..., :, None, :, :],
+                          means[..., None, :, :], covars[..., None, :, :, :],
+                          gamma)
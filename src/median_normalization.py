@@ -3,6 +3,8 @@ Applies median normalization to an input video, and saves the output (.avi).'
 '''
 import os
 import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import imageio
@@ -10,7 +12,161 @@ import numpy as np
 from tqdm import tqdm
 
 
-def median_normalize(vid_name, vid_path, out_path):
+def normalize_frame(grayscale_frame, adjusted_median):
+    '''
+    Shifts every nonzero pixel of a grayscale frame by its adjusted median.
+
+    Parameters
+    ----------
+    grayscale_frame: numpy array, shape (H, W)
+        8-bit grayscale frame.
+    adjusted_median: numpy.uint8
+        Median of the frame minus the largest median of the video, in
+        8-bit arithmetic.
+
+    Returns
+    ----------
+    out_frame: numpy array, shape (H, W)
+        The normalized frame.
+    '''
+    out_frame = np.array(grayscale_frame, dtype=np.uint8)
+    out_frame[out_frame != 0] += adjusted_median
+    return out_frame
+
+
+def frame_histogram(grayscale_frame):
+    '''
+    Counts the pixels of each intensity in a grayscale frame.
+
+    Parameters
+    ----------
+    grayscale_frame: numpy array, shape (H, W)
+        8-bit grayscale frame.
+
+    Returns
+    ----------
+    histogram: numpy array, shape (256,)
+        Number of pixels of every intensity.
+    '''
+    # OpenCV 4 returns a (256, 1) column, OpenCV 5 a flat array.
+    return cv2.calcHist([grayscale_frame], [0], None, [256],
+                        [0, 256]).ravel()
+
+
+def histogram_medians(histograms, pixels):
+    '''
+    Medians of a batch of frames from their histograms, rounded down to
+    8 bits as np.median followed by a cast to np.uint8 would give.
+
+    Parameters
+    ----------
+    histograms: numpy array, shape (F, 256)
+        Histogram of each frame, see frame_histogram.
+    pixels: int
+        Number of pixels in a frame.
+
+    Returns
+    ----------
+    medians: numpy array, shape (F,)
+        8-bit median of each frame.
+    '''
+    counts = np.cumsum(histograms, axis=1)
+    # The two middle values, which coincide for an odd number of pixels.
+    lower = np.argmax(counts > (pixels - 1) // 2, axis=1)
+    upper = np.argmax(counts > pixels // 2, axis=1)
+    return ((lower + upper) // 2).astype(np.uint8)
+
+
+def normalize_frames(grayscale_frames, adjusted_medians):
+    '''
+    Applies normalize_frame to a batch of frames in place.
+
+    Parameters
+    ----------
+    grayscale_frames: numpy array, shape (F, H, W)
+        8-bit grayscale frames, overwritten with the normalized frames.
+    adjusted_medians: numpy array, shape (F,)
+        Adjusted median of each frame, see normalize_frame.
+
+    Returns
+    ----------
+    NoneType object
+    '''
+    np.add(grayscale_frames, adjusted_medians[:, np.newaxis, np.newaxis],
+           out=grayscale_frames, where=grayscale_frames != 0)
+
+
+def buffered_median_normalize(vid_name, vid_path, out_path, n_jobs=None,
+                              chunk_size=64):
+    '''
+    Median normalization that decodes the video only once. Grayscale frames
+    are buffered in a memory-mapped file while their histograms are counted
+    by a pool of threads, and the buffer is then normalized in place, in
+    chunks of frames across the same pool.
+
+    Parameters
+    ----------
+    vid_name: String
+        name for the output video
+    vid_path: String
+        path to the input video
+    out_path: String
+        path to the directory to save the ouptut video, and to
+        buffer the grayscale frames in
+    n_jobs: int
+        Number of threads. None uses the default of ThreadPoolExecutor.
+    chunk_size: int
+        Number of frames normalized by a thread at a time.
+
+    Returns
+    ----------
+    NoneType object
+    '''
+    reader = imageio.get_reader(vid_path)
+    fps = reader.get_meta_data()['fps']
+    width, height = reader.get_meta_data()['size']
+    frame_count = reader.count_frames()
+    progress_bar = tqdm(total=(2 * frame_count))
+    progress_bar.set_description(' Normalizing video')
+
+    with tempfile.TemporaryDirectory(dir=out_path) as buffer_dir, \
+            ThreadPoolExecutor(n_jobs) as pool:
+        grays = np.lib.format.open_memmap(
+            os.path.join(buffer_dir, 'gray.npy'), mode='w+', dtype=np.uint8,
+            shape=(frame_count, height, width))
+        histograms = []
+        for i, frame in enumerate(reader):
+            if i == frame_count:
+                break
+            cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY, dst=grays[i])
+            histograms.append(pool.submit(frame_histogram, grays[i]))
+            progress_bar.update()
+        reader.close()
+
+        histograms = np.array([h.result() for h in histograms])
+        medians = histogram_medians(histograms, height * width)
+        adjusted_medians = medians - np.max(medians)
+        chunks = [slice(start, start + chunk_size)
+                  for start in range(0, len(medians), chunk_size)]
+        normalized = pool.map(normalize_frames,
+                              [grays[chunk] for chunk in chunks],
+                              [adjusted_medians[chunk] for chunk in chunks])
+
+        writer = cv2.VideoWriter(os.path.join(out_path, vid_name + '.avi'),
+                                 cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'),
+                                 fps, (width, height))
+        # pool.map yields in order, so each chunk is written once it is done
+        for chunk, _ in zip(chunks, normalized):
+            for out_frame in grays[chunk]:
+                writer.write(cv2.cvtColor(out_frame, cv2.COLOR_GRAY2RGB))
+                progress_bar.update()
+        writer.release()
+        del grays
+
+    progress_bar.close()
+
+
+def median_normalize(vid_name, vid_path, out_path, buffered=False):
     '''
     Parameters
     ----------
@@ -20,23 +176,28 @@ def median_normalize(vid_name, vid_path, out_path):
         path to the input video
     out_path: String
         path to the directory to save the ouptut video
+    buffered: bool
+        Decode the video once, see buffered_median_normalize,
+        instead of decoding it again to apply the medians.
 
     Returns
     ----------
     NoneType object
     '''
-    medians = []
+    if buffered:
+        buffered_median_normalize(vid_name, vid_path, out_path)
+        return
+
+    histograms = []
     reader = imageio.get_reader(vid_path)
     progress_bar = tqdm(total=(2 * reader.count_frames()))
     progress_bar.set_description(' Normalizing video')
     for frame in reader:
-        grayscale_frame = np.array(cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY))
-        flat_frame = grayscale_frame.flatten()
-        flat_frame[flat_frame > 0]
-        medians.append(np.median(flat_frame))
+        grayscale_frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        histograms.append(frame_histogram(grayscale_frame))
         progress_bar.update()
 
-    medians = np.array(medians, dtype=np.uint8)
+    medians = histogram_medians(np.array(histograms), grayscale_frame.size)
     max_median = np.max(medians)
     adjusted_medians = medians - max_median
 
@@ -50,9 +211,7 @@ def median_normalize(vid_name, vid_path, out_path):
 
     for i, frame in enumerate(reader):
         grayscale_frame = np.array(cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY))
-        flat_frame = grayscale_frame.flatten()
-        flat_frame[flat_frame != 0] += adjusted_medians[i]
-        out_frame = np.array(flat_frame, dtype=np.uint8).reshape(size)
+        out_frame = normalize_frame(grayscale_frame, adjusted_medians[i])
         color_frame = cv2.cvtColor(out_frame, cv2.COLOR_GRAY2RGB)
         writer.write(color_frame)
         progress_bar.update()
@@ -68,7 +227,11 @@ if __name__ == '__main__':
                         help='Input video path')
     parser.add_argument('-o', '--output', required=True,
                         help='Output video path')
+    parser.add_argument('-b', '--buffered', action='store_true',
+                        help='Decode the video once, buffering its frames \
+                              on disk')
     args = vars(parser.parse_args())
 
     vid_name = os.path.split(args['input'])[-1].split('.')[0] + '_normalized'
-    median_normalize(vid_name, args['input'], args['output'])
+    median_normalize(vid_name, args['input'], args['output'],
+                     args['buffered'])
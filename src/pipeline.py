@@ -7,19 +7,31 @@ functions, and eigen-decomposition of the matrix representation.
 
 import os
 import re
+import time
 import shutil
+import tempfile
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import cv2
 import imageio
 import numpy as np
 from tqdm import tqdm
 
+from ornet import cache
 from ornet.gmm.run_gmm import skl_gmm
 from ornet.cells_to_gray import vid_to_gray
-from ornet.track_cells import track_cells
-from ornet.affinityfunc import get_all_aff_tables
-from ornet.extract_cells import extract_cells
-from ornet.median_normalization import median_normalize as normalize
+from ornet.track_cells import track_cells, track_masks, track_labels
+from ornet.affinityfunc import get_all_aff_tables, get_sparse_aff_tables, \
+    load_sparse_tables
+from ornet.spectral import spectra
+from ornet.changepoint import ChangePointDetector, detect_change_points, \
+    frame_summary
+from ornet.framestore import FrameStoreWriter, open_frames, close_frames
+from ornet.extract_cells import extract_cells, extract_frames, cell_boxes, \
+    save_offset, load_offset, offset_path, PADDING
+from ornet.median_normalization import median_normalize as normalize, \
+    normalize_frame, frame_histogram, histogram_medians
 
 
 
@@ -67,10 +79,12 @@ def constrain_vid(vid_path, out_path, constrain_count):
     writer.release()
     progress_bar.close()
 
-def cell_segmentation(vid_name, vid_path, masks_path, out_path):
+def cell_segmentation(vid_name, vid_path, masks_path, out_path,
+                      label_tracking=False):
     '''
     Generates segmentation masks for every frame in the video, and saves
-    the output at the specified output path.
+    the output at the specified output path. Masks are written to disk
+    frame by frame, so memory does not grow with the length of the video.
 
     Parameters
     ----------
@@ -80,18 +94,22 @@ def cell_segmentation(vid_name, vid_path, masks_path, out_path):
         Path to initial segmentation mask.
     out_path: String
         Path to output directory.
+    label_tracking: bool
+        Track the cells on a single label image, see track_labels.
 
     Returns
     ----------
     NoneType object
     '''
-    masks = track_cells(vid_path, masks_path, show_video=False)
-    np.save(os.path.join(out_path, vid_name + 'MASKS.npy'), masks)
+    track_cells(vid_path, masks_path, show_video=False,
+                out_path=os.path.join(out_path, vid_name + 'MASKS.npy'),
+                label_image=label_tracking)
 
 
 def median_normalize(vid_name, input_path, out_path):
     '''
-    Applies median normalization to a grayscale input video (.npy)
+    Applies median normalization to a grayscale input video (.npy),
+    decoding it only once (see buffered_median_normalize).
 
     Parameters
     ----------
@@ -106,7 +124,7 @@ def median_normalize(vid_name, input_path, out_path):
     ----------
     NoneType object
     '''
-    normalize(vid_name, input_path, out_path)
+    normalize(vid_name, input_path, out_path, buffered=True)
 
 
 def gray_to_avi(vid_name, gray_path, original_path, out_path):
@@ -169,11 +187,9 @@ def downsample_vid(vid_name, vid_path, masks_path, downsampled_path,
     ----------
     NoneType object
     '''
-    masks = np.load(masks_path)
-    masks_downsampled = [frame for i, frame in enumerate(masks) if
-                         i % frame_skip == 0]
+    masks = np.load(masks_path, mmap_mode='r')
     np.save(os.path.join(downsampled_path, vid_name + '.npy'),
-            masks_downsampled)
+            masks[::frame_skip])
 
     reader = imageio.get_reader(vid_path)
     fps = reader.get_meta_data()['fps']
@@ -192,9 +208,10 @@ def downsample_vid(vid_name, vid_path, masks_path, downsampled_path,
     writer.release()
     progress_bar.close()
 
-def generate_single_vids(vid_path, masks_path, output_path):
+def generate_single_vids(vid_path, masks_path, output_path, gray_path=None):
     '''
-    Extracts individual cells using the segmentation masks.
+    Extracts individual cells using the segmentation masks. Each video
+    is cropped to the region its cell covers, see cell_boxes.
 
     Parameters
     ----------
@@ -204,12 +221,16 @@ def generate_single_vids(vid_path, masks_path, output_path):
         Path to the segmentation mask for the input video.
     output_path: String
         Directory to save the individual videos.
+    gray_path: String
+        If given, directory to also save the grayscale frames of each
+        cell in, as lossless stores (.npz, see framestore).
 
     Returns
     ----------
     NoneType object
     '''
-    extract_cells(vid_path, masks_path, output_path)
+    extract_cells(vid_path, masks_path, output_path, padding=PADDING,
+                  gray_path=gray_path)
 
 
 def convert_to_grayscale(vid_path, output_path):
@@ -231,7 +252,283 @@ def convert_to_grayscale(vid_path, output_path):
     vid_to_gray(vid_path, output_path, False)
 
 
-def compute_gmm_intermediates(vid_dir, intermediates_path):
+def read_frames(vid_path, constrain_count=-1):
+    '''
+    Decodes the frames of a video one at a time, stopping after the first
+    constrain_count frames.
+
+    Parameters
+    ----------
+    vid_path: String
+        Path to the input video.
+    constrain_count: int
+        First N number of frames to read from the video.
+        If value is -1, then the entire video is used.
+
+    Returns
+    ----------
+    frames: generator of numpy arrays, shape (H, W, 3)
+        The RGB frames of the video.
+    '''
+    reader = imageio.get_reader(vid_path)
+    try:
+        for i, frame in enumerate(reader):
+            if i == constrain_count:
+                break
+            yield frame
+    finally:
+        reader.close()
+
+
+def stream_single_cells(vid_name, vid_path, initial_mask_path, tmp_path,
+                        singles_path, constrain_count=-1, frame_skip=1,
+                        label_tracking=False):
+    '''
+    Streams a video through constraining, cell tracking, median
+    normalization, downsampling, cell extraction and grayscale conversion
+    while decoding it only once. Grayscale frames and masks are buffered in
+    memory-mapped files, because normalization needs the medians of the
+    whole video, and the grayscale arrays of each cell are written directly,
+    without intermediate videos, cropped to the region the cell covers.
+    The grayscale frames of each cell are saved losslessly in a store
+    (.npz, see framestore).
+
+    Parameters
+    ----------
+    vid_name: String
+        Name of the input video.
+    vid_path: String
+        Path to the input video.
+    initial_mask_path: String
+        Path to the initial segmentation mask (.vtk).
+    tmp_path: String
+        Directory to save the grayscale frames (.npz) of each cell.
+    singles_path: String
+        Directory to save the videos (.avi) of each cell.
+    constrain_count: int
+        First N number of frames to use. If value is -1, then the
+        entire video is used.
+    frame_skip: int
+        The number of frames to skip when performing downsampling.
+    label_tracking: bool
+        Track the cells on a single label image, see track_labels.
+
+    Returns
+    ----------
+    segments: int
+        Number of cells extracted.
+    '''
+    reader = imageio.get_reader(vid_path)
+    fps = reader.get_meta_data()['fps']
+    reader.close()
+
+    initial_mask = imageio.imread(initial_mask_path)
+    tracker = track_labels if label_tracking else track_masks
+    histograms = []
+    kept = 0
+    with tempfile.TemporaryDirectory(dir=tmp_path) as buffer_dir:
+        gray_path = os.path.join(buffer_dir, 'gray.raw')
+        masks_path = os.path.join(buffer_dir, 'masks.raw')
+
+        frames, tracked = itertools.tee(read_frames(vid_path,
+                                                    constrain_count))
+        progress_bar = tqdm()
+        progress_bar.set_description('   Streaming video')
+        with open(gray_path, 'wb') as gray_file, \
+                open(masks_path, 'wb') as masks_file:
+            for i, (frame, mask) in enumerate(
+                    zip(frames, tracker(tracked, initial_mask))):
+                # The file-based stages write RGB frames through OpenCV
+                # (swapping red and blue) and read them back as RGB, so
+                # BGR2GRAY here reproduces their grayscale conversion.
+                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                histograms.append(frame_histogram(gray))
+                if i % frame_skip == 0:
+                    gray_file.write(gray.tobytes())
+                    masks_file.write(mask.astype(np.uint8).tobytes())
+                    kept += 1
+                progress_bar.update()
+        progress_bar.close()
+        if kept == 0:
+            raise ValueError("No frames could be read from '{}'.".format(
+                vid_path))
+
+        height, width = gray.shape
+        grays = np.memmap(gray_path, dtype=np.uint8, mode='r',
+                          shape=(kept, height, width))
+        masks = np.memmap(masks_path, dtype=np.uint8, mode='r',
+                          shape=(kept, height, width))
+        medians = histogram_medians(np.array(histograms), gray.size)
+        adjusted_medians = medians - np.max(medians)
+        segments = len(np.unique(masks[0])) - 1
+        boxes = cell_boxes(masks, segments)
+
+        stores = []
+        writers = []
+        for j, (rows, cols) in enumerate(boxes):
+            single_name = str(vid_name) + '_' + str(j + 1)
+            store_path = os.path.join(tmp_path, single_name + '.npz')
+            crop_shape = (rows.stop - rows.start, cols.stop - cols.start)
+            stores.append(FrameStoreWriter(store_path, crop_shape))
+            save_offset(store_path, (rows, cols))
+            writers.append(cv2.VideoWriter(
+                os.path.join(singles_path, single_name + '.avi'),
+                cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'), fps,
+                crop_shape[::-1]))
+
+        normalized = (normalize_frame(grays[t],
+                                      adjusted_medians[t * frame_skip])
+                      for t in range(kept))
+        progress_bar = tqdm(total=kept)
+        progress_bar.set_description('  Extracting cells')
+        extract_frames(normalized, masks, boxes, writers, stores,
+                       progress_bar=progress_bar)
+        progress_bar.close()
+
+        for store, writer in zip(stores, writers):
+            store.close()
+            writer.release()
+        del grays, masks
+
+    return segments
+
+
+def run_tasks(function, tasks, n_jobs, progress_bar):
+    '''
+    Calls a function on every task in a pool of worker processes,
+    advancing the progress bar as each call returns.
+
+    Parameters
+    ----------
+    function: callable
+        Top-level function, so that it can be sent to the workers.
+    tasks: list of tuples
+        Positional arguments of every call.
+    n_jobs: int
+        Number of worker processes. 1 runs the calls in this process,
+        -1 uses all cores.
+    progress_bar: tqdm object
+        Advanced once per completed call.
+
+    Returns
+    ----------
+    results: list
+        Return value of every call, in the order of the tasks.
+    '''
+    if n_jobs == 1:
+        results = []
+        for task in tasks:
+            results.append(function(*task))
+            progress_bar.update()
+        return results
+
+    results = [None] * len(tasks)
+    with ProcessPoolExecutor(n_jobs if n_jobs > 0 else os.cpu_count()) \
+            as pool:
+        futures = {pool.submit(function, *task): i
+                   for i, task in enumerate(tasks)}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            progress_bar.update()
+    return results
+
+
+def fit_single_gmm(vid_dir, vid_name, intermediates_path, cache_dir=None,
+                   frame_stride=1, adaptive_gmm=False, dynamic_gmm=False,
+                   changepoints_path=None):
+    '''
+    Fits the GMM to a single grayscale cell video and saves the intermediate
+    file. The means of a cropped cell are moved back to frame coordinates
+    and the crop's offset and the EM iterations of every frame are saved
+    with them. Any error is returned rather
+    than raised, so one failing cell does not stop the other workers.
+    Change points are detected and written as the frames are fit.
+
+    Parameters
+    ----------
+    vid_dir: String
+        Path to the directory that contains the single videos.
+    vid_name: String
+        File name of the grayscale frames (.npz store or .npy).
+    intermediates_path:
+        Path to save the intermediate files.
+    cache_dir: String
+        Path to the stage cache. None disables caching.
+    frame_stride: int
+        Fit the GMM to every frame_stride-th frame only.
+    adaptive_gmm: bool
+        Skip refitting frames the previous fit already explains,
+        see skl_gmm.
+    dynamic_gmm: bool
+        Let components appear, split, merge and die between
+        frames, see skl_gmm.
+    changepoints_path: String
+        Directory to write the change points of the cell to (.csv),
+        see changepoint.ChangePointDetector. None skips them.
+
+    Returns
+    ----------
+    error: Exception or NoneType object
+        The error raised while fitting, or None on success.
+    '''
+    try:
+        vid_path = os.path.join(vid_dir, vid_name)
+        inter_name = vid_name.split('.')[0] + '.npz'
+        events_path = None
+        if changepoints_path is not None:
+            events_path = os.path.join(changepoints_path,
+                                       vid_name.split('.')[0] + '.csv')
+        if cache_dir is not None:
+            inputs = [vid_path]
+            if os.path.exists(offset_path(vid_path)):
+                inputs.append(offset_path(vid_path))
+            key = cache.stage_key('gmm', inputs,
+                                  {'fit': 'skl_gmm', 'output': inter_name,
+                                   'frame_stride': frame_stride,
+                                   'adaptive': adaptive_gmm,
+                                   'dynamic': dynamic_gmm})
+            if cache.restore(cache_dir, key, intermediates_path) is not None:
+                if events_path is not None:
+                    inter = np.load(os.path.join(intermediates_path,
+                                                 inter_name))
+                    frames = np.arange(len(inter['means'])) * frame_stride
+                    detect_change_points(inter['means'], inter['covars'],
+                                         frames, path=events_path)
+                return None
+
+        offset = load_offset(vid_path)
+        detect = events_path is not None
+        if detect:
+            detector = ChangePointDetector(path=events_path)
+        vid = open_frames(vid_path)
+
+        def detect_frame(t, means, covars, weights):
+            detector.update(t * frame_stride, frame_summary(means, covars))
+
+        try:
+            means, covars, weights, precisions, n_iter = skl_gmm(
+                vid, skipframes=frame_stride, adaptive=adaptive_gmm,
+                dynamic=dynamic_gmm, return_n_iter=True,
+                callback=detect_frame if detect else None)
+        finally:
+            close_frames(vid)
+            if detect:
+                detector.close()
+        np.savez(os.path.join(intermediates_path, inter_name),
+                 means=means + offset, covars=covars, weights=weights,
+                 precs=precisions, offset=offset, n_iter=n_iter)
+        if cache_dir is not None:
+            cache.store(cache_dir, key, intermediates_path, [inter_name])
+    except Exception as error:
+        return error
+
+    return None
+
+
+def compute_gmm_intermediates(vid_dir, intermediates_path, n_jobs=1,
+                              cache_dir=None, frame_stride=1,
+                              adaptive_gmm=False, dynamic_gmm=False,
+                              changepoints_path=None):
     '''
     Generate intermediate files from passing a grayscale video
     through the GMM portion of the pipeline.
@@ -242,35 +539,143 @@ def compute_gmm_intermediates(vid_dir, intermediates_path):
         Path to the directory that contains the single videos.
     intermediates_path:
         Path to save the intermediate files.
+    n_jobs: int
+        Number of worker processes fitting cells concurrently.
+        -1 uses all cores.
+    cache_dir: String
+        Path to the stage cache. None disables caching.
+    frame_stride: int
+        Fit the GMM to every frame_stride-th frame only.
+    adaptive_gmm: bool
+        Skip refitting frames the previous fit already explains,
+        see skl_gmm.
+    dynamic_gmm: bool
+        Let components appear, split, merge and die between
+        frames, see skl_gmm.
+    changepoints_path: String
+        Directory to write the change points of every cell to as
+        they are fit. None skips them.
 
     Returns
     ----------
-    NoneType object
+    failures: dict
+        Maps the name of every cell that could not be fit to its error.
     '''
 
     file_names = os.listdir(vid_dir)
-    gray_vids = [x for x in file_names if x.split('.')[-1] in ['npy']]
+    gray_vids = [x for x in file_names if x.split('.')[-1] in ['npy', 'npz']]
 
     progress_bar = tqdm(total=len(gray_vids))
     progress_bar.set_description('Computing GMM info')
-    for vid_name in gray_vids:
-        try:
-            vid_path = os.path.join(vid_dir, vid_name)
-            vid = np.load(vid_path)
-            means, covars, weights, precisions = skl_gmm(vid)
-            np.savez(os.path.join(intermediates_path,
-                                  vid_name.split('.')[0] + '.npz'),
-                     means=means, covars=covars, weights=weights,
-                     precs=precisions)
-        except:
-            print('Disappering cell: ' + vid_name)
-
-        progress_bar.update()
 
+    tasks = [(vid_dir, vid_name, intermediates_path, cache_dir,
+              frame_stride, adaptive_gmm, dynamic_gmm, changepoints_path)
+             for vid_name in gray_vids]
+    errors = run_tasks(fit_single_gmm, tasks, n_jobs, progress_bar)
     progress_bar.close()
 
+    failures = {}
+    for vid_name, error in zip(gray_vids, errors):
+        if error is not None:
+            failures[vid_name] = error
+            print('Disappearing cell: {} ({}: {})'.format(
+                vid_name, type(error).__name__, error))
+
+    return failures
+
+
+def distance_table_name(name, radius=None, n_neighbors=None):
+    '''
+    File name of the distance tables of a cell.
+
+    Parameters
+    ----------
+    name: String
+        File name of any output of the cell.
+    radius: float
+        Radius of sparse tables, see compute_single_distance.
+    n_neighbors: int
+        Neighbours kept by sparse tables, see compute_single_distance.
+
+    Returns
+    ----------
+    table_name: String
+        The name with a .npz extension for sparse tables, .npy for
+        dense ones.
+    '''
+    is_sparse = radius is not None or n_neighbors is not None
+    return name.split('.')[0] + ('.npz' if is_sparse else '.npy')
+
+
+def compute_single_distance(intermediates_path, intermediate, output_path,
+                            chunk_size=None, cache_dir=None, radius=None,
+                            n_neighbors=None):
+    '''
+    Computes the Hellinger distance tables for a single intermediate file,
+    streaming them into the output (.npy) file. Given a radius or a number
+    of neighbours, only the entries of neighbouring components are kept,
+    in sparse tables (.npz), see affinityfunc.sparse_aff_table.
+
+    Parameters
+    ----------
+    intermediates_path: String
+        Path to the GMM intermediates.
+    intermediate: String
+        File name of the intermediate (.npz).
+    output_path: String
+        Directory to save the distance ouptuts.
+    chunk_size: int
+        Number of frames computed at a time, which bounds the memory
+        used by the worker. Default sizes it from the component count.
+        Dense tables only.
+    cache_dir: String
+        Path to the stage cache. None disables caching.
+    radius: float
+        Keep only the pairs of components whose means are closer than
+        this. None, with n_neighbors None too, keeps every pair.
+    n_neighbors: int
+        Keep only the nearest n_neighbors of every component.
 
-def compute_distances(intermediates_path, output_path):
+    Returns
+    ----------
+    error: Exception or NoneType object
+        The error raised while computing, or None on success.
+    '''
+    try:
+        inter_path = os.path.join(intermediates_path, intermediate)
+        table_name = distance_table_name(intermediate, radius, n_neighbors)
+        is_sparse = table_name.endswith('.npz')
+        if cache_dir is not None:
+            parameters = {'aff_funct': 'Hellinger', 'output': table_name}
+            if is_sparse:
+                parameters.update(radius=radius, n_neighbors=n_neighbors)
+            key = cache.stage_key('distances', [inter_path], parameters)
+            if cache.restore(cache_dir, key, output_path) is not None:
+                return None
+
+        vid_inter = np.load(inter_path)
+        if is_sparse:
+            get_sparse_aff_tables(vid_inter['means'], vid_inter['covars'],
+                                  radius, n_neighbors, progress=False,
+                                  out_path=os.path.join(output_path,
+                                                        table_name))
+        else:
+            get_all_aff_tables(vid_inter['means'], vid_inter['covars'],
+                               'Hellinger', progress=False,
+                               out_path=os.path.join(output_path,
+                                                     table_name),
+                               chunk_size=chunk_size)
+        if cache_dir is not None:
+            cache.store(cache_dir, key, output_path, [table_name])
+    except Exception as error:
+        return error
+
+    return None
+
+
+def compute_distances(intermediates_path, output_path, n_jobs=1,
+                      chunk_size=None, cache_dir=None, radius=None,
+                      n_neighbors=None):
     '''
     Generate distances between means using Hellinger Distance.
 
@@ -280,27 +685,636 @@ def compute_distances(intermediates_path, output_path):
         Path to the GMM intermediates.
     output_path: String
         Directory to save the distance ouptuts.
+    n_jobs: int
+        Number of worker processes computing distances concurrently.
+        -1 uses all cores.
+    chunk_size: int
+        Number of frames each worker computes at a time, which bounds
+        its memory. Default sizes it from the component count, see
+        get_all_aff_tables.
+    cache_dir: String
+        Path to the stage cache. None disables caching.
+    radius: float
+        Radius of sparse tables, see compute_single_distance.
+    n_neighbors: int
+        Neighbours kept by sparse tables, see compute_single_distance.
 
     Returns
     ----------
-    NoneType object
+    failures: dict
+        Maps the name of every intermediate that could not be processed
+        to its error.
     '''
 
-    intermediates = os.listdir(intermediates_path)
+    intermediates = [x for x in os.listdir(intermediates_path) if
+                     x.split('.')[-1] in ['npz']]
     progress_bar = tqdm(total=len(intermediates))
     progress_bar.set_description('Computing distance')
-    for intermediate in intermediates:
-        vid_inter = np.load(os.path.join(intermediates_path, intermediate))
-        table = get_all_aff_tables(vid_inter['means'], vid_inter['covars'],
-                                   'Hellinger')
-        np.save(os.path.join(output_path, intermediate.split('.')[0] + '.npy'),
-                table)
-        progress_bar.update()
 
+    tasks = [(intermediates_path, intermediate, output_path, chunk_size,
+              cache_dir, radius, n_neighbors)
+             for intermediate in intermediates]
+    errors = run_tasks(compute_single_distance, tasks, n_jobs, progress_bar)
     progress_bar.close()
 
+    failures = {}
+    for intermediate, error in zip(intermediates, errors):
+        if error is not None:
+            failures[intermediate] = error
+            print('Failed distances: {} ({}: {})'.format(
+                intermediate, type(error).__name__, error))
+
+    return failures
+
+def compute_single_spectrum(distances_path, table, output_path,
+                            cache_dir=None):
+    '''
+    Computes the eigen time series of a single cell from its dense (.npy)
+    or sparse (.npz) distance tables and saves them as a .npz file with
+    the eigenvalues (f, m) and eigenvectors (f, k, m) of the graph of
+    every frame.
+
+    Parameters
+    ----------
+    distances_path: String
+        Path to the distance tables.
+    table: String
+        File name of the distance tables (.npy or .npz).
+    output_path: String
+        Directory to save the spectra.
+    cache_dir: String
+        Path to the stage cache. None disables caching.
+
+    Returns
+    ----------
+    error: Exception or NoneType object
+        The error raised while computing, or None on success.
+    '''
+    try:
+        table_path = os.path.join(distances_path, table)
+        spectrum_name = table.split('.')[0] + '.npz'
+        if cache_dir is not None:
+            key = cache.stage_key('spectra', [table_path],
+                                  {'graph': 'affinity',
+                                   'output': spectrum_name})
+            if cache.restore(cache_dir, key, output_path) is not None:
+                return None
+
+        if table.endswith('.npz'):
+            tables = load_sparse_tables(table_path)
+        else:
+            tables = np.load(table_path, mmap_mode='r')
+        values, vectors = spectra(tables)
+        np.savez(os.path.join(output_path, spectrum_name),
+                 eigenvalues=values, eigenvectors=vectors)
+        if cache_dir is not None:
+            cache.store(cache_dir, key, output_path, [spectrum_name])
+    except Exception as error:
+        return error
+
+    return None
+
+
+def compute_spectra(distances_path, output_path, tables=None, n_jobs=1,
+                    cache_dir=None):
+    '''
+    Generate the eigen time series of every cell from its distance tables.
+
+    Parameters
+    ----------
+    distances_path: String
+        Path to the distance tables.
+    output_path: String
+        Directory to save the spectra.
+    tables: list of Strings
+        File names of the distance tables to decompose. Default is
+        every table in distances_path.
+    n_jobs: int
+        Number of worker processes computing spectra concurrently.
+        -1 uses all cores.
+    cache_dir: String
+        Path to the stage cache. None disables caching.
+
+    Returns
+    ----------
+    failures: dict
+        Maps the name of every table that could not be decomposed to
+        its error.
+    '''
+    if tables is None:
+        tables = [x for x in os.listdir(distances_path) if
+                  x.split('.')[-1] in ['npy', 'npz']]
+    progress_bar = tqdm(total=len(tables))
+    progress_bar.set_description('Computing spectra')
+
+    tasks = [(distances_path, table, output_path, cache_dir)
+             for table in tables]
+    errors = run_tasks(compute_single_spectrum, tasks, n_jobs, progress_bar)
+    progress_bar.close()
+
+    failures = {}
+    for table, error in zip(tables, errors):
+        if error is not None:
+            failures[table] = error
+            print('Failed spectra: {} ({}: {})'.format(
+                table, type(error).__name__, error))
+
+    return failures
+
+
+def video_name(vid):
+    '''
+    Name used for the outputs of a video file.
+
+    Parameters
+    ----------
+    vid: String
+        File name of the video.
+
+    Returns
+    ----------
+    vid_name: String
+        The file name without extension or conversion suffixes.
+    '''
+    vid_name = vid.split('.')[0]
+    return re.sub(' \(2\)| \(Converted\)', '', vid_name)
+
+
+def extract_single_cells(vid, input_dir, initial_masks_dir, work_path,
+                         constrain_count=-1, downsample=1, streaming=False,
+                         cache_dir=None, label_tracking=False):
+    '''
+    Runs every stage from constraining a video to converting its single
+    cells to grayscale, inside the video's own working directory. The
+    grayscale frames of each cell (.npz, see framestore) are left in
+    work_path/tmp and the single cell videos (.avi) in work_path/singles.
+
+    Parameters
+    ----------
+    vid: String
+        File name of the video.
+    input_dir: String
+        Directory containing the video.
+    initial_masks_dir: String
+        Path to the directory contatining the initial 
+        segmentation mask that corresponds with the input 
+        video.
+    work_path: String
+        Working directory of the video.
+    constrain_count: int
+        The first N number of frames of the video to use.
+    downsample: int
+        The number of frames to skip when performing
+        downsampling.
+    streaming: bool
+        Decode the video once instead of writing and re-reading
+        a video between stages.
+    cache_dir: String
+        Path to the stage cache. None disables caching.
+    label_tracking: bool
+        Track the cells on a single label image, see track_labels.
+
+    Returns
+    ----------
+    singles: list of Strings
+        File names of the grayscale arrays of each cell.
+    '''
+    vid_name = video_name(vid)
+    full_video = os.path.join(work_path, vid_name + '.avi')
+    masks_path = os.path.join(work_path, vid_name + 'MASKS.npy')
+    initial_mask = os.path.join(initial_masks_dir, vid_name + '.vtk')
+    normalized_path = os.path.join(work_path, 'normalized')
+    downsampled_path = os.path.join(work_path, 'downsampled')
+    singles_path = os.path.join(work_path, 'singles')
+    tmp_path = os.path.join(work_path, 'tmp')
+
+    os.makedirs(singles_path, exist_ok=True)
+    os.makedirs(tmp_path, exist_ok=True)
+
+    cells_key = None
+    restored = None
+    if cache_dir is not None:
+        cells_key = cache.stage_key(
+            'cells', [os.path.join(input_dir, vid), initial_mask],
+            {'vid_name': vid_name, 'constrain_count': constrain_count,
+             'downsample': downsample, 'streaming': streaming,
+             'label_tracking': label_tracking})
+        restored = cache.restore(cache_dir, cells_key, work_path)
+
+    if restored is not None:
+        print('Restored single cells from cache')
+    elif streaming:
+        stream_single_cells(vid_name, os.path.join(input_dir, vid),
+                            initial_mask, tmp_path, singles_path,
+                            constrain_count, downsample, label_tracking)
+    else:
+        os.makedirs(normalized_path, exist_ok=True)
+        os.makedirs(downsampled_path, exist_ok=True)
+        constrain_vid(os.path.join(input_dir, vid), full_video, 
+                      constrain_count)
+        cell_segmentation(vid_name, full_video, initial_mask, work_path,
+                          label_tracking)
+        median_normalize(vid_name, full_video, normalized_path)
+        downsample_vid(vid_name,
+                       os.path.join(normalized_path, vid_name + '.avi'),
+                       masks_path, downsampled_path, downsample)
+        generate_single_vids(os.path.join(downsampled_path, vid_name + '.avi'),
+                             masks_path, singles_path, tmp_path)
+        os.remove(full_video)
+        os.remove(masks_path)
+        shutil.rmtree(normalized_path)
+        shutil.rmtree(downsampled_path)
+
+    singles = sorted(x for x in os.listdir(tmp_path) if
+                     x.split('.')[-1] in ['npy', 'npz'])
+    if cells_key is not None and restored is None:
+        cache.store(cache_dir, cells_key, work_path,
+                    [os.path.join('tmp', x) for x in singles] +
+                    [os.path.join('tmp', x.split('.')[0] + '.json')
+                     for x in singles] +
+                    [os.path.join('singles', x.split('.')[0] + '.avi')
+                     for x in singles])
+
+    return singles
+
+
+def process_single_cell(tmp_path, single, intermediates_path, distances_path,
+                        cache_dir=None, frame_stride=1, adaptive_gmm=False,
+                        dynamic_gmm=False, spectra_path=None,
+                        changepoints_path=None, chunk_size=None,
+                        radius=None, n_neighbors=None):
+    '''
+    Fits the GMM to a single cell and computes its distance tables and
+    their spectra.
+
+    Parameters
+    ----------
+    tmp_path: String
+        Directory containing the grayscale array of the cell.
+    single: String
+        File name of the grayscale frames (.npz store or .npy).
+    intermediates_path: String
+        Directory to save the GMM intermediate.
+    distances_path: String
+        Directory to save the distance tables.
+    cache_dir: String
+        Path to the stage cache. None disables caching.
+    frame_stride: int
+        Fit the GMM to every frame_stride-th frame only.
+    adaptive_gmm: bool
+        Skip refitting frames the previous fit already explains,
+        see skl_gmm.
+    dynamic_gmm: bool
+        Let components appear, split, merge and die between
+        frames, see skl_gmm.
+    spectra_path: String
+        Directory to save the spectra. None skips them.
+    changepoints_path: String
+        Directory to write the change points to as the GMM is fit.
+        None skips them.
+    chunk_size: int
+        Number of frames of distance tables computed at a time,
+        see get_all_aff_tables.
+    radius: float
+        Radius of sparse distance tables, see
+        compute_single_distance.
+    n_neighbors: int
+        Neighbours kept by sparse distance tables, see
+        compute_single_distance.
+
+    Returns
+    ----------
+    error: Exception or NoneType object
+        The error raised by any stage, or None on success.
+    '''
+    error = fit_single_gmm(tmp_path, single, intermediates_path, cache_dir,
+                           frame_stride, adaptive_gmm, dynamic_gmm,
+                           changepoints_path)
+    if error is not None:
+        return error
+    error = compute_single_distance(intermediates_path,
+                                    single.split('.')[0] + '.npz',
+                                    distances_path, chunk_size, cache_dir,
+                                    radius, n_neighbors)
+    if error is not None or spectra_path is None:
+        return error
+    return compute_single_spectrum(distances_path,
+                                   distance_table_name(single, radius,
+                                                       n_neighbors),
+                                   spectra_path, cache_dir)
+
+
+def finish_video(out_path, work_path):
+    '''
+    Moves the single cell videos and GMM intermediates of a video from its
+    working directory into the shared output directories, then removes the
+    working directory.
+
+    Parameters
+    ----------
+    out_path: String
+        The shared output directory.
+    work_path: String
+        Working directory of the video.
+
+    Returns
+    ----------
+    NoneType object
+    '''
+    for sub_dir in ['singles', 'intermediates']:
+        src_dir = os.path.join(work_path, sub_dir)
+        if not os.path.isdir(src_dir):
+            continue
+        for file_name in os.listdir(src_dir):
+            shutil.move(os.path.join(src_dir, file_name),
+                        os.path.join(out_path, sub_dir, file_name))
+
+    shutil.rmtree(work_path)
+
+
+def process_video(vid, input_dir, initial_masks_dir, output_path,
+                  constrain_count=-1, downsample=1, n_jobs=1, streaming=False,
+                  cache_dir=None, label_tracking=False, frame_stride=1,
+                  adaptive_gmm=False, dynamic_gmm=False, chunk_size=None,
+                  radius=None, n_neighbors=None):
+    '''
+    Runs the entire pipeline for a single video, in its own working
+    directory under outputs/work.
+
+    Parameters
+    ----------
+    vid: String
+        File name of the video.
+    input_dir: String
+        Directory containing the video.
+    initial_masks_dir: String
+        Path to the directory contatining the initial 
+        segmentation masks.
+    output_path: String
+        Path to the output directory.
+    constrain_count: int
+        The first N number of frames of the video to use.
+    downsample: int
+        The number of frames to skip when performing
+        downsampling.
+    n_jobs: int
+        Number of worker processes used for the GMM and
+        distance stages. -1 uses all cores.
+    streaming: bool
+        Decode the video once instead of writing and re-reading
+        a video between stages.
+    cache_dir: String
+        Path to the stage cache. None disables caching.
+    label_tracking: bool
+        Track the cells on a single label image, see track_labels.
+    frame_stride: int
+        Fit the GMM to every frame_stride-th frame only.
+    adaptive_gmm: bool
+        Skip refitting frames the previous fit already explains,
+        see skl_gmm.
+    dynamic_gmm: bool
+        Let components appear, split, merge and die between
+        frames, see skl_gmm.
+    chunk_size: int
+        Number of frames of distance tables computed at a time,
+        see get_all_aff_tables.
+    radius: float
+        Radius of sparse distance tables, see
+        compute_single_distance.
+    n_neighbors: int
+        Neighbours kept by sparse distance tables, see
+        compute_single_distance.
+
+    Returns
+    ----------
+    summary: dict
+        Outcome of the video, see video_summary.
+    '''
+    start = time.time()
+    out_path = os.path.join(output_path, 'outputs')
+    work_path = os.path.join(out_path, 'work', video_name(vid))
+    tmp_path = os.path.join(work_path, 'tmp')
+    intermediates_path = os.path.join(work_path, 'intermediates')
+    distances_path = os.path.join(out_path, 'distances')
+    spectra_path = os.path.join(out_path, 'spectra')
+    changepoints_path = os.path.join(out_path, 'changepoints')
+    os.makedirs(intermediates_path, exist_ok=True)
+
+    try:
+        singles = extract_single_cells(vid, input_dir, initial_masks_dir,
+                                       work_path, constrain_count,
+                                       downsample, streaming, cache_dir,
+                                       label_tracking)
+    except Exception as error:
+        # The outputs of the stages that ran are of no use without the rest.
+        shutil.rmtree(work_path, ignore_errors=True)
+        return video_summary(vid, [], {}, start, error)
+
+    failures = compute_gmm_intermediates(tmp_path, intermediates_path,
+                                         n_jobs, cache_dir, frame_stride,
+                                         adaptive_gmm, dynamic_gmm,
+                                         changepoints_path)
+    failures.update(compute_distances(intermediates_path, distances_path,
+                                      n_jobs, chunk_size, cache_dir, radius,
+                                      n_neighbors))
+    tables = [distance_table_name(x, radius, n_neighbors) for x in singles
+              if x not in failures]
+    failures.update(compute_spectra(distances_path, spectra_path, tables,
+                                    n_jobs, cache_dir))
+    finish_video(out_path, work_path)
+    return video_summary(vid, singles, failures, start)
+
+
+def video_summary(vid, singles, failures, start, error=None):
+    '''
+    Collects the outcome of processing a video.
+
+    Parameters
+    ----------
+    vid: String
+        File name of the video.
+    singles: list of Strings
+        The single cells extracted from the video.
+    failures: dict
+        Maps cells (or their intermediates) that failed to their errors.
+    start: float
+        Time the video started processing.
+    error: Exception
+        Error that stopped the video from being processed.
+
+    Returns
+    ----------
+    summary: dict
+        The video, the number of cells, the failed cells, the elapsed
+        time in seconds and the error, if any.
+    '''
+    return {'video': vid, 'cells': len(singles), 'failures': failures,
+            'elapsed': time.time() - start, 'error': error}
+
+
+def print_summary(summaries):
+    '''
+    Prints one line per processed video.
+
+    Parameters
+    ----------
+    summaries: list of dicts
+        Outcomes from video_summary.
+
+    Returns
+    ----------
+    NoneType object
+    '''
+    print('Summary')
+    for summary in summaries:
+        if summary['error'] is not None:
+            print('{}: failed after {:.1f}s ({}: {})'.format(
+                summary['video'], summary['elapsed'],
+                type(summary['error']).__name__, summary['error']))
+        else:
+            print('{}: {} cells, {} failed, {:.1f}s'.format(
+                summary['video'], summary['cells'],
+                len(summary['failures']), summary['elapsed']))
+
+
+def schedule_videos(vids, input_dir, initial_masks_dir, output_path,
+                    constrain_count=-1, downsample=1, n_jobs=1, video_jobs=2,
+                    streaming=False, cache_dir=None, label_tracking=False,
+                    frame_stride=1, adaptive_gmm=False, dynamic_gmm=False,
+                    chunk_size=None, radius=None, n_neighbors=None):
+    '''
+    Processes several videos concurrently. Videos are decoded, tracked and
+    split into single cells by a pool of video_jobs processes, while the
+    cells of finished videos are fit and measured by a separate pool of
+    n_jobs processes, so that decoding and encoding overlap with the GMM.
+    Every video works in its own directory under outputs/work.
+
+    Parameters
+    ----------
+    vids: list of Strings
+        File names of the videos.
+    input_dir: String
+        Directory containing the videos.
+    initial_masks_dir: String
+        Path to the directory contatining the initial 
+        segmentation masks.
+    output_path: String
+        Path to the output directory.
+    constrain_count: int
+        The first N number of frames of the video to use.
+    downsample: int
+        The number of frames to skip when performing
+        downsampling.
+    n_jobs: int
+        Number of processes fitting and measuring cells.
+        -1 uses all cores.
+    video_jobs: int
+        Number of videos extracted concurrently.
+    streaming: bool
+        Decode each video once instead of writing and re-reading
+        a video between stages.
+    cache_dir: String
+        Path to the stage cache. None disables caching.
+    label_tracking: bool
+        Track the cells on a single label image, see track_labels.
+    frame_stride: int
+        Fit the GMM to every frame_stride-th frame only.
+    adaptive_gmm: bool
+        Skip refitting frames the previous fit already explains,
+        see skl_gmm.
+    dynamic_gmm: bool
+        Let components appear, split, merge and die between
+        frames, see skl_gmm.
+    chunk_size: int
+        Number of frames of distance tables computed at a time,
+        see get_all_aff_tables.
+    radius: float
+        Radius of sparse distance tables, see
+        compute_single_distance.
+    n_neighbors: int
+        Neighbours kept by sparse distance tables, see
+        compute_single_distance.
+
+    Returns
+    ----------
+    summaries: list of dicts
+        Outcome of every video, see video_summary.
+    '''
+    out_path = os.path.join(output_path, 'outputs')
+    distances_path = os.path.join(out_path, 'distances')
+    spectra_path = os.path.join(out_path, 'spectra')
+    changepoints_path = os.path.join(out_path, 'changepoints')
+    cpu_jobs = n_jobs if n_jobs > 0 else os.cpu_count()
+
+    starts = {}
+    singles = {}
+    failures = {vid: {} for vid in vids}
+    summaries = {}
+    work_paths = {vid: os.path.join(out_path, 'work', video_name(vid))
+                  for vid in vids}
+
+    with ProcessPoolExecutor(video_jobs) as io_pool, \
+            ProcessPoolExecutor(cpu_jobs) as cpu_pool:
+        extractions = {}
+        for vid in vids:
+            starts[vid] = time.time()
+            os.makedirs(os.path.join(work_paths[vid], 'intermediates'),
+                        exist_ok=True)
+            extractions[io_pool.submit(
+                extract_single_cells, vid, input_dir, initial_masks_dir,
+                work_paths[vid], constrain_count, downsample, streaming,
+                cache_dir, label_tracking)] = vid
+
+        cells = {}
+        for future in as_completed(extractions):
+            vid = extractions[future]
+            try:
+                singles[vid] = future.result()
+            except Exception as error:
+                shutil.rmtree(work_paths[vid], ignore_errors=True)
+                summaries[vid] = video_summary(vid, [], {}, starts[vid],
+                                               error)
+                continue
+
+            print('Extracted {} cells from {}'.format(len(singles[vid]),
+                                                      vid))
+            for single in singles[vid]:
+                cells[cpu_pool.submit(
+                    process_single_cell,
+                    os.path.join(work_paths[vid], 'tmp'), single,
+                    os.path.join(work_paths[vid], 'intermediates'),
+                    distances_path, cache_dir, frame_stride,
+                    adaptive_gmm, dynamic_gmm, spectra_path,
+                    changepoints_path, chunk_size, radius,
+                    n_neighbors)] = (vid, single)
+
+        remaining = {vid: len(singles[vid]) for vid in singles}
+        for vid in remaining:
+            if remaining[vid] == 0:
+                finish_video(out_path, work_paths[vid])
+                summaries[vid] = video_summary(vid, [], {}, starts[vid])
+
+        for future in as_completed(cells):
+            vid, single = cells[future]
+            error = future.result()
+            if error is not None:
+                failures[vid][single] = error
+                print('Disappearing cell: {} ({}: {})'.format(
+                    single, type(error).__name__, error))
+            remaining[vid] -= 1
+            if remaining[vid] == 0:
+                finish_video(out_path, work_paths[vid])
+                summaries[vid] = video_summary(vid, singles[vid],
+                                               failures[vid], starts[vid])
+
+    return [summaries[vid] for vid in vids]
+
+
 def run(input_path, initial_masks_dir, output_path, constrain_count=-1, 
-        downsample=1):
+        downsample=1, n_jobs=1, streaming=False, cache_dir=None,
+        cache_max_bytes=None, cache_max_age=None, video_jobs=1,
+        label_tracking=False, frame_stride=1, adaptive_gmm=False,
+        dynamic_gmm=False, chunk_size=None, radius=None, n_neighbors=None):
     '''
     Runs the entire ornet pipeline from start to finish for any video(s)
     found at the input path location.
@@ -320,10 +1334,63 @@ def run(input_path, initial_masks_dir, output_path, constrain_count=-1,
     downsample: int
         The number of frames to skip when performing
         downsampling.
+    n_jobs: int
+        Number of worker processes used to fit the GMM to
+        the extracted cells and to compute their distances.
+        -1 uses all cores.
+    streaming: bool
+        Decode each video once and pass its frames through
+        every stage up to grayscale conversion, instead of
+        writing and re-reading a video between stages.
+    cache_dir: String
+        Path to a persistent cache of stage outputs. Stages
+        whose inputs and parameters are unchanged since an
+        earlier run are restored from it instead of being
+        recomputed. None disables caching.
+    cache_max_bytes: int
+        Size the cache is trimmed to after the run, removing
+        the least recently used entries first.
+    cache_max_age: float
+        Entries unused for longer than this many seconds are
+        removed after the run.
+    video_jobs: int
+        Number of videos processed concurrently. With more
+        than one, see schedule_videos.
+    label_tracking: bool
+        Track the cells on a single label image, so memory
+        does not grow with the number of cells. See
+        track_labels.
+    frame_stride: int
+        Fit the GMM to every frame_stride-th frame of the
+        extracted cells only.
+    adaptive_gmm: bool
+        Skip refitting the GMM to frames that the fit of
+        the previous frame already explains. See skl_gmm.
+    dynamic_gmm: bool
+        Let GMM components appear, split, merge and die as
+        the mitochondria fragment and fuse, rather than
+        keeping those of the first frame. Components keep
+        their index across frames; absent ones have NaN
+        parameters and distances. See skl_gmm.
+    chunk_size: int
+        Number of frames of distance tables each worker
+        computes at a time, which bounds its memory. Default
+        sizes it from the component count. See
+        get_all_aff_tables.
+    radius: float
+        Store sparse distance tables (.npz) that keep only
+        the pairs of components whose means are closer than
+        this. See affinityfunc.sparse_aff_table.
+    n_neighbors: int
+        Store sparse distance tables (.npz) that keep only
+        the nearest n_neighbors of every component. Memory
+        and time then grow linearly with the number of
+        components. None for both stores dense tables.
 
     Returns
     ----------
-    NoneType object
+    summaries: list of dicts
+        Outcome of every video, see video_summary.
     '''
 
     if os.path.isdir(input_path):
@@ -341,56 +1408,36 @@ def run(input_path, initial_masks_dir, output_path, constrain_count=-1,
         print('No videos were found.')
         quit(1)
 
-    for vid in vids:
-        print(vid)
-        out_path = os.path.join(output_path, 'outputs')
-        vid_name = vid.split('.')[0]
-        vid_name = re.sub(' \(2\)| \(Converted\)', '', vid_name)
-        full_video = os.path.join(out_path, vid_name + '.avi')
-        masks_path = os.path.join(out_path, vid_name + 'MASKS.npy')
-        normalized_path = os.path.join(out_path, 'normalized')
-        downsampled_path = os.path.join(out_path, 'downsampled')
-        singles_path = os.path.join(out_path, 'singles')
-        intermediates_path = os.path.join(out_path, 'intermediates')
-        distances_path = os.path.join(out_path, 'distances')
-        tmp_path = os.path.join(out_path, 'tmp')
-
-        os.makedirs(out_path, exist_ok=True)
-        os.makedirs(normalized_path, exist_ok=True)
-        os.makedirs(downsampled_path, exist_ok=True)
-        os.makedirs(singles_path, exist_ok=True)
-        os.makedirs(intermediates_path, exist_ok=True)
-        os.makedirs(distances_path, exist_ok=True)
-        os.makedirs(tmp_path, exist_ok=True)
+    out_path = os.path.join(output_path, 'outputs')
+    for sub_dir in ['singles', 'intermediates', 'distances', 'spectra',
+                    'changepoints', 'work']:
+        os.makedirs(os.path.join(out_path, sub_dir), exist_ok=True)
 
-        constrain_vid(os.path.join(input_dir, vid), full_video, 
-                      constrain_count)
-        cell_segmentation(vid_name, full_video,
-                          os.path.join(initial_masks_dir, vid_name + '.vtk'),
-                          out_path)
-        median_normalize(vid_name, full_video, normalized_path)
-        downsample_vid(vid_name,
-                       os.path.join(normalized_path, vid_name + '.avi'),
-                       masks_path, downsampled_path, downsample)
-        generate_single_vids(os.path.join(downsampled_path, vid_name + '.avi'),
-                             masks_path, tmp_path)
-        single_vids = os.listdir(tmp_path)
-
-        progress_bar = tqdm(total=len(single_vids))
-        progress_bar.set_description('Converting to gray')
-        for single in single_vids:
-            convert_to_grayscale(os.path.join(tmp_path, single), tmp_path)
-            shutil.move(os.path.join(tmp_path, single),
-                        os.path.join(singles_path, single))
-            progress_bar.update()
+    if video_jobs > 1 and len(vids) > 1:
+        summaries = schedule_videos(vids, input_dir, initial_masks_dir,
+                                    output_path, constrain_count, downsample,
+                                    n_jobs, video_jobs, streaming, cache_dir,
+                                    label_tracking, frame_stride,
+                                    adaptive_gmm, dynamic_gmm, chunk_size,
+                                    radius, n_neighbors)
+    else:
+        summaries = []
+        for vid in vids:
+            print(vid)
+            summaries.append(process_video(vid, input_dir, initial_masks_dir,
+                                           output_path, constrain_count,
+                                           downsample, n_jobs, streaming,
+                                           cache_dir, label_tracking,
+                                           frame_stride, adaptive_gmm,
+                                           dynamic_gmm, chunk_size, radius,
+                                           n_neighbors))
+            print()
 
-        progress_bar.close()
-        compute_gmm_intermediates(tmp_path, intermediates_path)
-        compute_distances(intermediates_path, distances_path)
+    if not os.listdir(os.path.join(out_path, 'work')):
+        os.rmdir(os.path.join(out_path, 'work'))
 
-        os.remove(full_video)
-        os.remove(masks_path)
-        shutil.rmtree(normalized_path)
-        shutil.rmtree(downsampled_path)
-        shutil.rmtree(tmp_path)
-        print()
+    if cache_dir is not None:
+        cache.evict(cache_dir, cache_max_bytes, cache_max_age)
+
+    print_summary(summaries)
+    return summaries
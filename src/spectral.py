@@ -0,0 +1,362 @@
+"""
+Spectral decomposition of the graphs of every frame. The distance tables
+of a cell hold the edge weights between its GMM components, frame by
+frame; the leading eigenvalues of each frame's graph form a time series
+whose jumps mark the frames where the mitochondria change.
+"""
+
+import warnings
+
+import numpy as np
+from scipy import sparse
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse.linalg import ArpackNoConvergence, eigsh, lobpcg
+
+# Number of eigenpairs kept per frame.
+N_EIGS = 5
+
+# Smallest graph for which solver='auto' picks the partial Lanczos solver.
+LANCZOS_MIN_NODES = 512
+
+
+def graph_matrices(tables, graph='affinity'):
+    """
+    Turns distance tables into the symmetric matrices of each frame's graph.
+    Components absent from a frame (NaN distances) become isolated nodes.
+
+    Parameters
+    ----------
+    tables : array, shape (..., k, k)
+        Edge weights between the k components, e.g. from
+        affinityfunc.get_all_aff_tables.
+    graph : string
+        'affinity' for the symmetrized weights themselves, 'laplacian' for
+        the normalized graph Laplacian I - D^-1/2 W D^-1/2 (without
+        self-loops; isolated nodes get an all-zero row).
+
+    Returns
+    -------
+    matrices : array, shape (..., k, k)
+        Symmetric matrix of each frame.
+    """
+    weights = np.nan_to_num(np.asarray(tables, dtype=np.float64), nan=0.0)
+    weights = 0.5 * (weights + np.swapaxes(weights, -1, -2))
+    if graph == 'affinity':
+        return weights
+    if graph != 'laplacian':
+        raise ValueError("Unknown graph '{}', expected 'affinity' or "
+                         "'laplacian'.".format(graph))
+
+    diag = np.arange(weights.shape[-1])
+    weights[..., diag, diag] = 0
+    degrees = weights.sum(axis=-1)
+    scale = np.zeros_like(degrees)
+    np.divide(1, np.sqrt(degrees), out=scale, where=degrees > 0)
+    laplacian = -weights * scale[..., :, None] * scale[..., None, :]
+    laplacian[..., diag, diag] += degrees > 0
+    return laplacian
+
+
+def sparse_graph_matrix(table, graph='affinity'):
+    """
+    Sparse counterpart of graph_matrices for the table of one frame, e.g.
+    from affinityfunc.sparse_aff_table. Entries absent from the table are
+    zero weights.
+
+    Parameters
+    ----------
+    table : sparse matrix, shape (k, k)
+        Edge weights between the k components.
+    graph : string
+        'affinity' or 'laplacian', see graph_matrices.
+
+    Returns
+    -------
+    matrix : csr_matrix, shape (k, k)
+        Symmetric matrix of the frame.
+    """
+    weights = sparse.csr_matrix(table, dtype=np.float64)
+    weights.data = np.nan_to_num(weights.data, nan=0.0)
+    weights = 0.5 * (weights + weights.T)
+    if graph == 'affinity':
+        return sparse.csr_matrix(weights)
+    if graph != 'laplacian':
+        raise ValueError("Unknown graph '{}', expected 'affinity' or "
+                         "'laplacian'.".format(graph))
+
+    weights = weights - sparse.diags(weights.diagonal())
+    degrees = np.asarray(weights.sum(axis=1)).ravel()
+    scale = np.zeros_like(degrees)
+    np.divide(1, np.sqrt(degrees), out=scale, where=degrees > 0)
+    laplacian = sparse.diags((degrees > 0).astype(np.float64)) - \
+        sparse.diags(scale) @ weights @ sparse.diags(scale)
+    return sparse.csr_matrix(laplacian)
+
+
+def batch_eigs(matrices, n_eigs=N_EIGS, which='largest'):
+    """
+    Leading eigenpairs of a stack of symmetric matrices, with a single
+    batched call to numpy.linalg.eigh.
+
+    Parameters
+    ----------
+    matrices : array, shape (f, k, k)
+        Symmetric matrices.
+    n_eigs : integer
+        Number of eigenpairs to keep (at most k).
+    which : string
+        'largest' or 'smallest' eigenvalues.
+
+    Returns
+    -------
+    values : array, shape (f, m)
+        Eigenvalues of each matrix, largest (or smallest) first.
+    vectors : array, shape (f, k, m)
+        The matching unit eigenvectors, as columns.
+    """
+    values, vectors = np.linalg.eigh(matrices)
+    if which == 'largest':
+        values, vectors = values[..., ::-1], vectors[..., ::-1]
+    return values[..., :n_eigs], vectors[..., :n_eigs]
+
+
+def lanczos_eigs(matrix, n_eigs=N_EIGS, which='largest', v0=None):
+    """
+    Leading eigenpairs of one symmetric matrix with the partial Lanczos
+    solver of scipy.sparse.linalg.eigsh, which only computes the n_eigs
+    wanted instead of all k. If Lanczos does not converge, as happens when
+    the wanted eigenvalues are tightly clustered, the eigenpairs are
+    computed from scratch.
+
+    Parameters
+    ----------
+    matrix : array or sparse matrix, shape (k, k)
+        Symmetric matrix.
+    n_eigs : integer
+        Number of eigenpairs to keep (less than k).
+    which : string
+        'largest' or 'smallest' eigenvalues.
+    v0 : array, shape (k,)
+        Starting vector, e.g. the leading eigenvector of the previous frame,
+        which the graph changes little from (default: random).
+
+    Returns
+    -------
+    values : array, shape (m,)
+        Eigenvalues, largest (or smallest) first.
+    vectors : array, shape (k, m)
+        The matching unit eigenvectors, as columns.
+    """
+    try:
+        values, vectors = eigsh(matrix, k=n_eigs, v0=v0,
+                                which='LA' if which == 'largest' else 'SA')
+    except ArpackNoConvergence:
+        if sparse.issparse(matrix):
+            matrix = matrix.toarray()
+        values, vectors = batch_eigs(matrix, n_eigs, which)
+    order = np.argsort(values)
+    if which == 'largest':
+        order = order[::-1]
+    return values[order], vectors[:, order]
+
+
+def lobpcg_eigs(matrix, guess, which='largest', tol=1e-6, max_iter=50):
+    """
+    Leading eigenpairs of one symmetric matrix with LOBPCG, seeded with a
+    guess of the eigenvectors such as those of the previous frame. When
+    the graph barely changed, a handful of block iterations suffice. If
+    LOBPCG does not converge, the eigenpairs are computed from scratch.
+
+    Parameters
+    ----------
+    matrix : array or sparse matrix, shape (k, k)
+        Symmetric matrix.
+    guess : array, shape (k, m)
+        Initial eigenvectors, as columns.
+    which : string
+        'largest' or 'smallest' eigenvalues.
+    tol : float
+        Residual norm at which an eigenpair has converged, relative to the
+        largest row sum of the matrix.
+    max_iter : integer
+        Maximum number of LOBPCG iterations.
+
+    Returns
+    -------
+    values : array, shape (m,)
+        Eigenvalues, largest (or smallest) first.
+    vectors : array, shape (k, m)
+        The matching unit eigenvectors, as columns.
+    """
+    n_eigs = guess.shape[1]
+    # lobpcg iterates in place on its initial block.
+    guess = np.array(guess, dtype=np.float64)
+    # The largest row sum bounds the magnitude of every eigenvalue.
+    scale = np.abs(matrix).sum(axis=1).max()
+    tol = tol * max(scale, np.finfo(np.float64).tiny)
+    with warnings.catch_warnings():
+        # Convergence is checked on the residuals below.
+        warnings.simplefilter('ignore')
+        values, vectors = lobpcg(matrix, guess, largest=which == 'largest',
+                                 tol=tol, maxiter=max_iter)
+    residuals = np.linalg.norm(matrix @ vectors - vectors * values, axis=0)
+    if not np.all(residuals <= 10 * tol):
+        if sparse.issparse(matrix):
+            matrix = matrix.toarray()
+        values, vectors = batch_eigs(matrix, n_eigs, which)
+    order = np.argsort(values)
+    if which == 'largest':
+        order = order[::-1]
+    return values[order], vectors[:, order]
+
+
+def match_eigenvectors(vectors, previous):
+    """
+    Orders eigenvectors so that each follows the eigenvector of the frame
+    before that it overlaps most, keeping their identity when eigenvalues
+    cross.
+
+    Parameters
+    ----------
+    vectors : array, shape (k, m)
+        Eigenvectors of a frame, as columns.
+    previous : array, shape (k, m)
+        Eigenvectors of the frame before.
+
+    Returns
+    -------
+    order : array, shape (m,)
+        Column of vectors that follows each column of previous.
+    """
+    overlap = np.abs(previous.T @ vectors)
+    _, order = linear_sum_assignment(overlap, maximize=True)
+    return order
+
+
+def align_signs(vectors, previous=None):
+    """
+    Flips eigenvectors so each points the same way as in the frame before,
+    since an eigensolver may return either sign and the time series of the
+    vectors should only change when the graph does.
+
+    Parameters
+    ----------
+    vectors : array, shape (f, k, m)
+        Eigenvectors of consecutive frames.
+    previous : array, shape (k, m)
+        Aligned eigenvectors of the frame before the first (default: none,
+        the largest entry of each vector of the first frame is made
+        positive).
+
+    Returns
+    -------
+    vectors : array, shape (f, k, m)
+        The aligned eigenvectors.
+    """
+    if previous is None:
+        first = vectors[0]
+        peaks = np.argmax(np.abs(first), axis=0)
+        previous = first * np.sign(first[peaks, np.arange(first.shape[1])])
+    before = np.concatenate([previous[np.newaxis], vectors[:-1]])
+    flips = np.sign(np.einsum('fkm,fkm->fm', vectors, before))
+    flips[flips == 0] = 1
+    # A frame is flipped relative to the previous raw frame, so the flips
+    # accumulate along the video.
+    return vectors * np.cumprod(flips, axis=0)[:, np.newaxis, :]
+
+
+def spectra(tables, n_eigs=N_EIGS, graph='affinity', which='largest',
+            solver='auto', chunk_size=None, tol=1e-6):
+    """
+    Eigen time series of a cell: the leading eigenpairs of the graph of
+    every frame.
+
+    Parameters
+    ----------
+    tables : array, shape (f, k, k), or list of sparse matrices
+        Distance tables of every frame. A memmap is read a chunk at a time.
+        Sparse tables (see affinityfunc.get_sparse_aff_tables) are
+        decomposed one frame at a time without densifying them, except
+        by the 'eigh' solver.
+    n_eigs : integer
+        Number of eigenpairs per frame (at most k).
+    graph : string
+        'affinity' or 'laplacian', see graph_matrices.
+    which : string
+        'largest' or 'smallest' eigenvalues.
+    solver : string
+        'eigh' decomposes chunks of frames with one batched call, 'lanczos'
+        computes only the wanted eigenpairs of one frame at a time,
+        warm-started from the previous frame, 'lobpcg' tracks the
+        eigenvectors from frame to frame, seeding LOBPCG with those of the
+        previous frame, and 'auto' uses Lanczos for sparse tables and for
+        graphs of at least LANCZOS_MIN_NODES nodes.
+    chunk_size : integer
+        Number of frames decomposed at a time with 'eigh' (default: sized
+        to roughly a million matrix entries).
+    tol : float
+        Relative residual tolerance of the 'lobpcg' solver.
+
+    Returns
+    -------
+    values : array, shape (f, m)
+        Eigenvalues of every frame. With 'lobpcg' the columns follow the
+        same eigenvector over time instead of being sorted.
+    vectors : array, shape (f, k, m)
+        Eigenvectors of every frame, with consistent signs over time.
+    """
+    frames = len(tables)
+    is_sparse = frames > 0 and sparse.issparse(tables[0])
+    k = tables[0].shape[-1] if is_sparse else tables.shape[-1]
+    n_eigs = min(n_eigs, k)
+    if solver == 'auto':
+        use_lanczos = is_sparse or k >= LANCZOS_MIN_NODES
+        solver = 'lanczos' if use_lanczos else 'eigh'
+    if solver == 'lanczos' and n_eigs >= k - 1:
+        # eigsh needs fewer eigenpairs than nodes.
+        solver = 'eigh'
+    if chunk_size is None:
+        chunk_size = max(1, 2 ** 20 // max(1, k * k))
+    if is_sparse or solver in ['lanczos', 'lobpcg']:
+        chunk_size = 1
+
+    values = np.empty((frames, n_eigs))
+    vectors = np.empty((frames, k, n_eigs))
+    previous = None
+    for start in range(0, frames, chunk_size):
+        stop = min(start + chunk_size, frames)
+        if is_sparse:
+            matrix = sparse_graph_matrix(tables[start], graph)
+            # Only eigh, which lobpcg starts from, needs the dense matrix.
+            dense = solver == 'eigh' or (solver == 'lobpcg' and
+                                         previous is None)
+            matrices = matrix.toarray()[np.newaxis] if dense else None
+        else:
+            matrices = graph_matrices(tables[start:stop], graph)
+            matrix = matrices[0]
+        if solver == 'eigh':
+            chunk_values, chunk_vectors = batch_eigs(matrices, n_eigs, which)
+        elif solver == 'lanczos':
+            v0 = None if previous is None else previous[:, 0]
+            chunk_values, chunk_vectors = lanczos_eigs(matrix, n_eigs,
+                                                       which, v0)
+            chunk_values = chunk_values[np.newaxis]
+            chunk_vectors = chunk_vectors[np.newaxis]
+        elif solver == 'lobpcg':
+            if previous is None:
+                chunk_values, chunk_vectors = batch_eigs(matrices, n_eigs,
+                                                         which)
+            else:
+                frame_values, frame_vectors = lobpcg_eigs(
+                    matrix, previous, which, tol)
+                order = match_eigenvectors(frame_vectors, previous)
+                chunk_values = frame_values[np.newaxis, order]
+                chunk_vectors = frame_vectors[np.newaxis, :, order]
+        else:
+            raise ValueError("Unknown solver '{}', expected 'auto', 'eigh', "
+                             "'lanczos' or 'lobpcg'.".format(solver))
+        values[start:stop] = chunk_values
+        vectors[start:stop] = align_signs(chunk_vectors, previous)
+        previous = vectors[stop - 1]
+
+    return values, vectors
@@ -14,38 +14,57 @@ from functools import partial
 import cv2
 import imageio
 import numpy as np
+from scipy import ndimage
 from tqdm import tqdm
 from matplotlib import pyplot as plt
 
 
-def track_cells(vidfile, maskfile, show_video=False):
+def padded_box(box, kernel, iterations=3):
     """
-    reads a video file and initial masks and returns a set of frames for each cell
+    Pads the bounding box of a cell so that opening the cropped image gives
+    the same result as opening the whole frame. Opening reaches
+    iterations * (kernel size // 2) pixels, and twice that is enough context.
+
+    Parameters
+    ----------
+    box : tuple of slices
+        Bounding box of the cell, e.g. from scipy.ndimage.find_objects.
+    kernel : array
+        Kernel of the opening.
+    iterations : integer
+        Iterations of the opening.
+
+    Returns
+    ---------
+    box : tuple of slices
+        The padded bounding box.
+    """
+    margin = 2 * iterations * (kernel.shape[0] // 2) + 1
+    return tuple(slice(max(s.start - margin, 0), s.stop + margin)
+                 for s in box)
+
 
+def track_masks(frames, im, show_video=False):
+    """
+    Tracks the cells of an initial mask through a sequence of frames,
+    yielding one label mask per frame as soon as it is computed.
 
     Parameters
     ----------
-    vidfile : string
-        path to a single video file
-    maskfile : string
-        path to a single vtk mask file
+    frames : iterable of arrays, shape (H, W, 3)
+        RGB video frames, e.g. an imageio reader.
+    im : array, shape (H, W)
+        Initial label mask, 0 for background and i for the i-th cell.
     show_video : boolean (Default : False)
         If true, display video with contours drawn during processing
 
-    Returns
+    Yields
     ---------
-    videos : Returns a list of arrays each with shape (H, W, F)
+    frameMask : array, shape (H, W)
+        Label mask of the frame, 0 for background and i for the i-th cell.
     """
-    im = imageio.imread(maskfile)
-    if show_video:
-        plt.imshow(im)
-        plt.show()
-
-    vf = imageio.get_reader(vidfile)
-    frameNum = 0
     number_of_segments = len(
         np.unique(im)) - 1  # defines number of segs from vtk
-    outs = []
     ims = list()
     masks = list()
     colors = list()  # the colors to make the contours in the output video?
@@ -64,9 +83,7 @@ def track_cells(vidfile, maskfile, show_video=False):
     for i in range(number_of_segments):  # separates each mask from the vtk and lists them
         masks.append(im != i + 1)
 
-    progress_bar = tqdm(total=vf.count_frames())
-    progress_bar.set_description('    Tracking cells')
-    for frameNum, frame in enumerate(vf):  # while( vf.isOpened() ):
+    for frameNum, frame in enumerate(frames):  # while( vf.isOpened() ):
         for i in range(number_of_segments):  # adds a copy of the current frame for each segment
             ims.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
 
@@ -80,9 +97,14 @@ def track_cells(vidfile, maskfile, show_video=False):
         del dilates[:]
         for i in range(number_of_segments):
             ret, ims[i] = cv2.threshold(ims[i], 3, 255, cv2.THRESH_BINARY_INV)
-            temp = cv2.morphologyEx(ims[i], cv2.MORPH_OPEN, kernel,
-                                    iterations=3)
-            temp = cv2.bitwise_not(temp)
+            # only the region around the cell can change when opened
+            temp = np.zeros_like(ims[i])
+            box = ndimage.find_objects((ims[i] == 0).astype(np.uint8), 1)[0]
+            if box is not None:
+                box = padded_box(box, kernel)
+                temp[box] = cv2.bitwise_not(cv2.morphologyEx(
+                    np.ascontiguousarray(ims[i][box]), cv2.MORPH_OPEN,
+                    kernel, iterations=3))
             dilates.append(temp)
 
         # each segment dilates
@@ -118,7 +140,8 @@ def track_cells(vidfile, maskfile, show_video=False):
         for conts in range(number_of_segments):  # bulds the contours and draws them onto the frame
             contours.append(cv2.findContours(dilates[conts], cv2.RETR_TREE,
                                              cv2.CHAIN_APPROX_SIMPLE)[0])
-            cv2.drawContours(frame, contours[conts], -1, colors[conts], 2)
+            if show_video:
+                cv2.drawContours(frame, contours[conts], -1, colors[conts], 2)
             if (conts == number_of_segments - 1 and show_video):  # prints contours frame by frame
                 cv2.putText(frame, 'Frame # ' + str(frameNum), (10, 40), font,
                             0.5, (0, 255, 50), 1)
@@ -130,17 +153,197 @@ def track_cells(vidfile, maskfile, show_video=False):
         frameMask = np.zeros_like(dilates[0])
         for i in range(number_of_segments):
             frameMask[dilates[i] == 255] = i + 1
-        outs.append(frameMask)
 
         del ims[:]
         del contours[:]
         del masks[:]
+        yield frameMask
+
+    if show_video:
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()
+
+
+def claim(labels, contested, cell, label):
+    """
+    Assigns the pixels of one cell to a label image, recording the pixels
+    that another cell has already claimed.
+
+    Parameters
+    ----------
+    labels : array, shape (H, W)
+        Label image being built.
+    contested : array, shape (H, W)
+        Boolean image of pixels claimed by more than one cell.
+    cell : array, shape (H, W)
+        Boolean mask of the cell.
+    label : integer
+        Label of the cell.
+    """
+    contested |= cell & (labels != 0)
+    labels[cell] = label
+
+
+def grow_labels(labels, radius):
+    """
+    Dilates every cell of a label image at once by competitive dilation.
+    Each background pixel within radius (chessboard distance) of a cell
+    goes to the nearest cell, and pixels where two cells meet are left to
+    neither, so no pairs of cells have to be compared.
+
+    Parameters
+    ----------
+    labels : array, shape (H, W)
+        Label image, 0 for background. Fewer than 65535 labels.
+    radius : integer
+        Number of pixels each cell grows by.
+
+    Returns
+    ---------
+    grown : array, shape (H, W)
+        Label image of the dilated cells, dtype uint16.
+    """
+    distances, indices = ndimage.distance_transform_cdt(
+        labels == 0, metric='chessboard', return_indices=True)
+    grown = labels[indices[0], indices[1]].astype(np.uint16)
+    grown[distances > radius] = 0
+
+    # A pixel next to a differently labelled one is on a boundary.
+    kernel = np.ones((3, 3), np.uint8)
+    highest = cv2.dilate(grown, kernel)
+    lowest = cv2.erode(np.where(grown == 0, np.iinfo(np.uint16).max, grown)
+                       .astype(np.uint16), kernel)
+    grown[(highest != grown) | (lowest != grown)] = 0
+    return grown
+
+
+def track_labels(frames, im, show_video=False):
+    """
+    Memory-bounded variant of track_masks. The tracking state between frames
+    is a single label image rather than one binary image per cell, and the
+    cost of a frame grows with the image size rather than with the number
+    of cells: each cell is opened only within its bounding box, and
+    overlaps are resolved by one competitive dilation of the label image
+    (see grow_labels) instead of pairwise comparisons.
+
+    Parameters
+    ----------
+    frames : iterable of arrays, shape (H, W, 3)
+        RGB video frames, e.g. an imageio reader.
+    im : array, shape (H, W)
+        Initial label mask, 0 for background and i for the i-th cell.
+    show_video : boolean (Default : False)
+        If true, display video with contours drawn during processing
+
+    Yields
+    ---------
+    frameMask : array, shape (H, W)
+        Label mask of the frame, 0 for background and i for the i-th cell.
+    """
+    number_of_segments = len(
+        np.unique(im)) - 1  # defines number of segs from vtk
+    mask_dtype = np.uint8 if number_of_segments < 256 else np.uint16
+    labels = np.array(im, dtype=np.int32)
+
+    kernel = np.ones((17, 17), np.uint8)  # kernel for opening
+    # 5 rounds of 2 dilations with a 3x3 kernel, as in track_masks.
+    radius = 5 * 2
+    colors = [(random.randint(1, 255), random.randint(0, 255),
+               random.randint(1, 255)) for _ in range(number_of_segments)]
+
+    for frameNum, frame in enumerate(frames):
+        dark = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) <= 3
+        new_labels = np.zeros_like(labels)
+        contested = np.zeros(labels.shape, dtype=bool)
+        for i, box in enumerate(ndimage.find_objects(labels), 1):
+            if box is None:  # the cell has disappeared
+                continue
+            box = padded_box(box, kernel)
+            # Same thresholding and opening as track_masks, for one cell.
+            background = np.where(dark[box] | (labels[box] != i), 255, 0)
+            temp = cv2.morphologyEx(background.astype(np.uint8),
+                                    cv2.MORPH_OPEN, kernel, iterations=3)
+            claim(new_labels[box], contested[box], temp == 0, i)
+        new_labels[contested] = 0
+
+        labels = grow_labels(new_labels, radius).astype(np.int32)
+
+        if show_video:
+            for i in range(number_of_segments):
+                contours = cv2.findContours((labels == i + 1).astype(np.uint8),
+                                            cv2.RETR_TREE,
+                                            cv2.CHAIN_APPROX_SIMPLE)[0]
+                cv2.drawContours(frame, contours, -1, colors[i], 2)
+            cv2.putText(frame, 'Frame # ' + str(frameNum), (10, 40),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 50), 1)
+            cv2.imshow("Keypoints2", frame)
+            cv2.waitKey(10)
+
+        yield labels.astype(mask_dtype)
+
+    if show_video:
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()
+
+
+def track_cells(vidfile, maskfile, show_video=False, out_path=None,
+                label_image=False):
+    """
+    reads a video file and initial masks and returns a set of frames for each cell
+
+
+    Parameters
+    ----------
+    vidfile : string
+        path to a single video file
+    maskfile : string
+        path to a single vtk mask file
+    show_video : boolean (Default : False)
+        If true, display video with contours drawn during processing
+    out_path : string (Default : None)
+        If given, the masks are written frame by frame into a
+        memory-mapped .npy file at this path instead of being
+        collected in memory.
+    label_image : boolean (Default : False)
+        If true, track with the memory-bounded track_labels instead
+        of track_masks.
+
+    Returns
+    ---------
+    videos : Returns a list of arrays each with shape (H, W, F), or
+        a read-only memmap of out_path.
+    """
+    im = imageio.imread(maskfile)
+    if show_video:
+        plt.imshow(im)
+        plt.show()
+
+    vf = imageio.get_reader(vidfile)
+    frame_count = vf.count_frames()
+    tracker = track_labels if label_image else track_masks
+    outs = []
+    if out_path is not None:
+        mask_dtype = np.uint8 if len(np.unique(im)) <= 256 else np.uint16
+        outs = np.lib.format.open_memmap(out_path, mode='w+',
+                                         dtype=mask_dtype,
+                                         shape=(frame_count,) + im.shape)
+
+    progress_bar = tqdm(total=frame_count)
+    progress_bar.set_description('    Tracking cells')
+    for frameNum, frameMask in enumerate(tracker(vf, im, show_video)):
+        if out_path is None:
+            outs.append(frameMask)
+        elif frameNum < frame_count:
+            outs[frameNum] = frameMask
         progress_bar.update()
 
     vf.close()
     progress_bar.close()
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
+
+    if out_path is not None:
+        outs.flush()
+        del outs
+        outs = np.load(out_path, mmap_mode='r')
 
     return outs
 
@@ -166,6 +369,9 @@ if __name__ == '__main__':
     parser.add_argument("-s", "--showvid", action="store_true",
                         help="If set, each frame with contours is drawn during processing. [Default: False]")
 
+    parser.add_argument("-l", "--labels", action="store_true",
+                        help="If set, track on a single label image so memory does not grow with the number of cells. [Default: False]")
+
     args = vars(parser.parse_args())
 
     if not os.path.exists(args['output']):
@@ -173,9 +379,9 @@ if __name__ == '__main__':
 
     vidpath = args['input']
 
-    out = track_cells(vidfile=args['input'], maskfile=args['masks'],
-                        show_video=args['showvid'])
     fname = vidpath.split("/")[-1].split(".")[0]
     fname = "{}.npy".format(fname + 'MASKS')
     outfile = os.path.join(args['output'], fname)
-    np.save(outfile, out)
+    track_cells(vidfile=args['input'], maskfile=args['masks'],
+                show_video=args['showvid'], out_path=outfile,
+                label_image=args['labels'])
@@ -0,0 +1,99 @@
+'''
+Tests for the affinity table computations in affinityfunc.py.
+'''
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from ornet.affinityfunc import get_all_aff_tables, get_sparse_aff_tables, \
+		load_sparse_tables, cutoff_radius, N_NEIGHBORS
+
+
+def random_components(frames, k, seed=0):
+	'''
+	Generates random means and symmetric positive definite covariances.
+	'''
+	rng = np.random.RandomState(seed)
+	means = rng.uniform(0, 100, size=(frames, k, 2))
+	a = rng.normal(0, 3, size=(frames, k, 2, 2))
+	covars = a @ np.swapaxes(a, -1, -2) + np.eye(2)
+	return means, covars
+
+
+class Test_Affinity(unittest.TestCase):
+
+	def test_vectorized_matches_loops(self):
+		'''
+		The batched measures reproduce the per-pair reference implementations.
+		'''
+		means, covars = random_components(4, 7)
+		for aff_funct in ['probability', 'KL div', 'JS div', 'Hellinger']:
+			expected = get_all_aff_tables(means, covars, aff_funct,
+					progress=False, vectorized=False)
+			actual = get_all_aff_tables(means, covars, aff_funct,
+					progress=False)
+			self.assertEqual(actual.shape, (4, 7, 7))
+			# 1 - sqrt(1 - h) turns rounding in h ~ 1 into ~1e-8 differences.
+			np.testing.assert_allclose(actual, expected, rtol=1e-9,
+					atol=1e-7, err_msg=aff_funct)
+
+	def test_streamed_tables(self):
+		'''
+		Tables streamed to a memory-mapped file match the in-memory result.
+		'''
+		means, covars = random_components(5, 6, seed=1)
+		expected = get_all_aff_tables(means, covars, 'Hellinger',
+				progress=False)
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			out_path = os.path.join(tmp_dir, 'table.npy')
+			actual = get_all_aff_tables(means, covars, 'Hellinger',
+					progress=False, out_path=out_path, chunk_size=2)
+			np.testing.assert_allclose(actual, expected)
+			np.testing.assert_allclose(np.load(out_path), expected)
+			del actual
+
+	def test_sparse_tables(self):
+		'''
+		Sparse tables keep the dense entries of neighbouring components and,
+		within the cutoff radius, drop only negligible ones.
+		'''
+		means, covars = random_components(3, 60, seed=2)
+		# Spread out, so that the loose cutoff radius leaves gaps.
+		means[:, :, 0] *= 50
+		means[1, 4] = np.nan
+		covars[1, 4] = np.nan
+		dense = get_all_aff_tables(means, covars, 'Hellinger',
+				progress=False)
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			out_path = os.path.join(tmp_dir, 'table.npz')
+			tables = get_sparse_aff_tables(means, covars,
+					radius=cutoff_radius(covars), progress=False,
+					out_path=out_path)
+			loaded = load_sparse_tables(out_path)
+		self.assertEqual(len(loaded), 3)
+		for table, saved in zip(tables, loaded):
+			self.assertEqual((table != saved).nnz, 0)
+		self.assertLess(tables[0].nnz, 60 * 60)
+		self.assertEqual(tables[1][4].nnz, 0)
+		for t in [0, 2]:
+			np.testing.assert_allclose(tables[t].toarray(), dense[t],
+					atol=1e-6)
+
+		nearest = get_sparse_aff_tables(means, covars, n_neighbors=3,
+				progress=False)[0]
+		self.assertEqual((nearest != nearest.T).nnz, 0)
+		self.assertTrue(np.all(np.diff(nearest.indptr) >= 4))
+		np.testing.assert_allclose(nearest.diagonal(), 1)
+
+		# Without a radius, only the nearest neighbours are kept.
+		default = get_sparse_aff_tables(means, covars, progress=False)[0]
+		expected = get_sparse_aff_tables(means, covars,
+				n_neighbors=N_NEIGHBORS, progress=False)[0]
+		self.assertEqual((default != expected).nnz, 0)
+		self.assertLessEqual(default.nnz, 60 * (2 * N_NEIGHBORS + 1))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,91 @@
+'''
+Tests for the stage cache defined in cache.py.
+'''
+
+import os
+import time
+import tempfile
+import unittest
+
+from ornet import cache
+
+
+def write(path, content):
+	'''
+	Writes a small text file, creating its directory.
+	'''
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, 'w') as f:
+		f.write(content)
+
+
+class Test_Cache(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.cache_dir = os.path.join(self.tmp.name, 'cache')
+		self.input_path = os.path.join(self.tmp.name, 'input.txt')
+		write(self.input_path, 'frames')
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_key_tracks_content_and_params(self):
+		'''
+		Keys change with the input contents and the parameters.
+		'''
+		key = cache.stage_key('gmm', [self.input_path], {'k': 1})
+		self.assertEqual(key,
+				cache.stage_key('gmm', [self.input_path], {'k': 1}))
+		self.assertNotEqual(key,
+				cache.stage_key('gmm', [self.input_path], {'k': 2}))
+		write(self.input_path, 'other frames')
+		self.assertNotEqual(key,
+				cache.stage_key('gmm', [self.input_path], {'k': 1}))
+
+	def test_store_and_restore(self):
+		'''
+		Stored outputs are restored under their relative paths.
+		'''
+		out_dir = os.path.join(self.tmp.name, 'out')
+		write(os.path.join(out_dir, 'tmp', 'cell_1.npy'), 'cell')
+		key = cache.stage_key('cells', [self.input_path], {})
+		self.assertIsNone(cache.restore(self.cache_dir, key, out_dir))
+		cache.store(self.cache_dir, key, out_dir,
+				[os.path.join('tmp', 'cell_1.npy')])
+
+		new_dir = os.path.join(self.tmp.name, 'new')
+		restored = cache.restore(self.cache_dir, key, new_dir)
+		self.assertEqual(restored, [os.path.join('tmp', 'cell_1.npy')])
+		with open(os.path.join(new_dir, 'tmp', 'cell_1.npy')) as f:
+			self.assertEqual(f.read(), 'cell')
+
+	def test_failed_store(self):
+		'''
+		A store that fails partway leaves nothing in the cache.
+		'''
+		out_dir = os.path.join(self.tmp.name, 'out')
+		write(os.path.join(out_dir, 'a.npy'), 'a')
+		key = cache.stage_key('cells', [self.input_path], {})
+		with self.assertRaises(OSError):
+			cache.store(self.cache_dir, key, out_dir, ['a.npy', 'b.npy'])
+		self.assertEqual(os.listdir(self.cache_dir), [])
+		self.assertIsNone(cache.restore(self.cache_dir, key, out_dir))
+
+	def test_evict(self):
+		'''
+		Old entries go first, then least recently used ones over the size.
+		'''
+		out_dir = os.path.join(self.tmp.name, 'out')
+		write(os.path.join(out_dir, 'a.npy'), 'a' * 10)
+		for i, stage in enumerate(['old', 'used', 'new']):
+			cache.store(self.cache_dir, stage, out_dir, ['a.npy'])
+			entry = os.path.join(self.cache_dir, stage)
+			os.utime(entry, (time.time() - 10 * (3 - i),) * 2)
+
+		self.assertEqual(cache.evict(self.cache_dir, max_age=25), 1)
+		self.assertEqual(cache.evict(self.cache_dir, max_bytes=10), 1)
+		self.assertEqual(os.listdir(self.cache_dir), ['new'])
+
+if __name__ == '__main__':
+	unittest.main()
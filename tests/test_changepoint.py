@@ -0,0 +1,107 @@
+'''
+Tests for the online change-point detection in changepoint.py.
+'''
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from ornet import pipeline
+from ornet.changepoint import ChangePointDetector, detect_change_points, \
+		frame_summary
+
+
+def splitting_components(frames, k, split, seed=0):
+	'''
+	Components that jitter in place until half of them move away at the
+	split frame.
+	'''
+	rng = np.random.RandomState(seed)
+	means = rng.uniform(40, 60, size=(1, k, 2)) + rng.normal(0, 0.5,
+			size=(frames, k, 2))
+	means[split:, :k // 2] += 60
+	covars = np.tile(9 * np.eye(2), (frames, k, 1, 1))
+	return means, covars
+
+
+def splitting_video(frames, split):
+	'''
+	Grayscale frames of a blob that breaks in two at the split frame.
+	'''
+	y, x = np.mgrid[:60, :60]
+	video = np.zeros((frames, 60, 60))
+	for t in range(frames):
+		gap = 7 if t < split else 16
+		for cx in [30 - gap, 30 + gap]:
+			video[t] += 150 * np.exp(-((y - 30) ** 2 + (x - cx) ** 2) / 40)
+	return video.astype(np.uint8)
+
+
+class Test_ChangePoint(unittest.TestCase):
+
+	def test_detects_split(self):
+		'''
+		A split is reported once, at its frame, and still components are not.
+		'''
+		means, covars = splitting_components(100, 12, 40)
+		events = detect_change_points(means, covars)
+		self.assertEqual([frame for frame, _ in events], [40])
+
+		means, covars = splitting_components(100, 12, 100, seed=1)
+		self.assertEqual(detect_change_points(means, covars), [])
+
+		summary = frame_summary(means[0, :3], covars[0, :3])
+		self.assertEqual(summary.shape, (5,))
+		np.testing.assert_array_equal(summary[3:], 0)
+
+	def test_streams_events(self):
+		'''
+		Events are written as soon as they are found, and a change still in
+		progress is reported when the stream closes.
+		'''
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			path = os.path.join(tmp_dir, 'events.csv')
+			detector = ChangePointDetector(window=3, path=path)
+			summaries = [1.0] * 10 + [5.0] * 10 + [9.0] * 3
+			events = []
+			for frame, value in enumerate(summaries):
+				events += detector.update(frame, [value])
+				if frame == 17:
+					with open(path) as f:
+						lines = f.read().splitlines()
+					self.assertEqual(len(lines), 2)
+					self.assertTrue(lines[1].startswith('10,'))
+			self.assertEqual([frame for frame, _ in events], [10])
+			self.assertEqual(len(detector._summaries), 6)
+			events = detector.close()
+			self.assertEqual([frame for frame, _ in events], [20])
+			with open(path) as f:
+				self.assertEqual(len(f.read().splitlines()), 3)
+
+	def test_fit_single_gmm(self):
+		'''
+		The pipeline writes the change points of a cell while fitting it,
+		and again when the fit is restored from the cache.
+		'''
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			video_path = os.path.join(tmp_dir, 'cell.npy')
+			np.save(video_path, splitting_video(40, 20))
+			cache_dir = os.path.join(tmp_dir, 'cache')
+			events_path = os.path.join(tmp_dir, 'cell.csv')
+			contents = []
+			for _ in range(2):
+				error = pipeline.fit_single_gmm(tmp_dir, 'cell.npy', tmp_dir,
+						cache_dir, changepoints_path=tmp_dir)
+				self.assertIsNone(error)
+				with open(events_path) as f:
+					contents.append(f.read())
+				os.remove(events_path)
+			self.assertEqual(contents[0], contents[1])
+			frames = [int(line.split(',')[0])
+					for line in contents[0].splitlines()[1:]]
+			self.assertEqual(frames, [20])
+
+if __name__ == '__main__':
+	unittest.main()
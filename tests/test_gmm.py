@@ -0,0 +1,274 @@
+'''
+Tests for the gmm subpackage.
+'''
+
+import unittest
+
+import numpy as np
+from sklearn.mixture import GaussianMixture
+
+from ornet.gmm import components, image, params
+from ornet.gmm.run_gmm import em, run_gmm, skl_gmm
+from ornet.gmm.weighted import WeightedGaussianMixture
+
+
+def blob_image(centers, shape=(40, 50), peak=60, spread=20):
+	'''
+	Draws gaussian blobs of light into an 8-bit grayscale image.
+	'''
+	yy, xx = np.mgrid[:shape[0], :shape[1]]
+	img = np.zeros(shape)
+	for i, j in centers:
+		img += peak * np.exp(-((yy - i) ** 2 + (xx - j) ** 2) / spread)
+	return np.clip(img, 0, 255).astype(np.uint8)
+
+
+class Test_GMM(unittest.TestCase):
+
+	def test_weighted_px(self):
+		'''
+		Weighted pixels carry the same mass as the replicated pixels.
+		'''
+		img = blob_image([(10, 10), (30, 35)])
+		X, W = image.img_to_weighted_px(img)
+		replicated = image.img_to_px(img)
+		self.assertEqual(W.sum(), replicated.shape[0])
+		np.testing.assert_array_equal(np.repeat(X, W, axis=0), replicated)
+
+	def test_weighted_fit_matches_replicated(self):
+		'''
+		Weighted EM reproduces the fit on the pixel-replicated data.
+		'''
+		img = blob_image([(10, 10), (30, 35), (20, 25)])
+		init = dict(n_components=3, weights_init=np.ones(3) / 3,
+				means_init=[[9, 9], [29, 34], [21, 24]],
+				precisions_init=np.tile(np.eye(2) / 4, (3, 1, 1)))
+		expected = GaussianMixture(**init).fit(image.img_to_px(img))
+		X, W = image.img_to_weighted_px(img)
+		actual = WeightedGaussianMixture(**init).fit(X, sample_weight=W)
+		self.assertEqual(actual.n_iter_, expected.n_iter_)
+		np.testing.assert_allclose(actual.means_, expected.means_)
+		np.testing.assert_allclose(actual.covariances_,
+				expected.covariances_)
+		np.testing.assert_allclose(actual.weights_, expected.weights_)
+		np.testing.assert_allclose(actual.score_samples(X),
+				expected.score_samples(X))
+
+	def test_weighted_kmeans_init(self):
+		'''
+		Without initial parameters, the weighted fit starts from a weighted
+		k-means and finds the blobs.
+		'''
+		img = blob_image([(10, 10), (30, 35)], peak=150)
+		X, W = image.img_to_weighted_px(img)
+		gmm = WeightedGaussianMixture(n_components=2, random_state=0)
+		gmm.fit(X, sample_weight=W)
+		self.assertTrue(gmm.converged_)
+		np.testing.assert_allclose(gmm.means_[np.argsort(gmm.means_[:, 0])],
+				[[10, 10], [30, 35]], atol=0.1)
+
+	def test_em_matches_weighted_mixture(self):
+		'''
+		The in-house EM reproduces scikit-learn's fit from the same start.
+		'''
+		img = blob_image([(10, 10), (30, 35), (20, 25)])
+		pi = np.ones(3) / 3
+		mu = np.array([[9., 9.], [29., 34.], [21., 24.]])
+		sigma = np.tile(np.eye(2) * 4, (3, 1, 1))
+		X, W = image.img_to_weighted_px(img)
+		expected = WeightedGaussianMixture(n_components=3, weights_init=pi,
+				means_init=mu, precisions_init=np.linalg.inv(sigma))
+		expected.fit(X, sample_weight=W)
+		pi, mu, sigma, ll, n_iter = em(X.astype(np.float64), W, pi, mu,
+				sigma)
+		self.assertEqual(n_iter, expected.n_iter_)
+		self.assertAlmostEqual(ll, expected.lower_bound_)
+		np.testing.assert_allclose(mu, expected.means_)
+		np.testing.assert_allclose(sigma, expected.covariances_)
+		np.testing.assert_allclose(pi, expected.weights_)
+
+	def test_run_gmm(self):
+		'''
+		run_gmm fits the first frame like the weighted skl_gmm and follows
+		a blob across the video.
+		'''
+		vid = np.stack([blob_image([(18, 18 + t), (32, 40)], shape=(50, 60))
+				for t in range(5)])
+		fit = run_gmm(vid)
+		self.assertEqual(fit[0].shape, (5, 2, 2))
+		for x, y in zip(fit, skl_gmm(vid[:1], weighted=True)):
+			np.testing.assert_allclose(x[:1], y, atol=1e-9)
+		np.testing.assert_allclose(fit[0][:, 0],
+				[[18, 18 + t] for t in range(5)], atol=0.05)
+		np.testing.assert_allclose(fit[3], np.linalg.inv(fit[1]))
+		self.assertEqual(run_gmm(vid, skipframes=2)[0].shape, (3, 2, 2))
+
+	def test_local_variance(self):
+		'''
+		The filtered variances match the variance of every window, cut off
+		at the borders.
+		'''
+		img = np.random.RandomState(0).randint(0, 256, (12, 15))
+		var = params.local_variance(img, 3)
+		for i in range(img.shape[0]):
+			for j in range(img.shape[1]):
+				window = img[max(i - 1, 0):i + 2, max(j - 1, 0):j + 2]
+				self.assertAlmostEqual(var[i, j], window.var())
+
+	def test_moments_init(self):
+		'''
+		The moments of a lone blob are its spread, and starting from them
+		EM converges sooner.
+		'''
+		img = blob_image([(20, 25)], peak=200, spread=40)
+		pi, mu, sigma = params.image_init(img, min_distance=10,
+				threshold_abs=6, init='moments')
+		np.testing.assert_array_equal(mu, [[20, 25]])
+		# The window cuts off the tails, so the spread is a bit smaller.
+		np.testing.assert_allclose(sigma[0], np.eye(2) * 20, rtol=0.2,
+				atol=1e-6)
+
+		img = blob_image([(20, 20), (20, 30), (31, 25)], shape=(50, 50),
+				peak=150, spread=80)
+		X, W = image.img_to_weighted_px(img)
+		n_iter = {}
+		for init in ['variance', 'moments']:
+			pi, mu, sigma = params.image_init(img, min_distance=3,
+					threshold_abs=6, init=init)
+			gmm = WeightedGaussianMixture(n_components=len(pi),
+					weights_init=pi, means_init=mu,
+					precisions_init=np.linalg.inv(sigma), max_iter=500)
+			n_iter[init] = gmm.fit(X, sample_weight=W).n_iter_
+		self.assertLess(n_iter['moments'], n_iter['variance'])
+
+	def test_skl_gmm(self):
+		'''
+		The weighted fit of a video matches the replicated one.
+		'''
+		vid = np.stack([blob_image([(18, 18 + t), (32, 40)], shape=(50, 60))
+				for t in range(4)] +
+				[blob_image([(18, 21), (32, 40)], shape=(50, 60))] * 3)
+		expected = skl_gmm(vid)
+		actual = skl_gmm(vid, weighted=True)
+		for x, y in zip(expected, actual):
+			# em's moment-based covariances round off near-zero terms.
+			np.testing.assert_allclose(x, y, atol=1e-9)
+
+	def test_adaptive_skl_gmm(self):
+		'''
+		The adaptive fit leaves the frames after the blobs stop alone, and
+		keeps the means of the full fit.
+		'''
+		vid = np.stack([blob_image([(18, 18 + t), (32, 40)], shape=(50, 60))
+				for t in range(4)] +
+				[blob_image([(18, 21), (32, 40)], shape=(50, 60))] * 3)
+		expected = skl_gmm(vid, weighted=True)
+		means, covars, weights, precs, n_iter = skl_gmm(vid, weighted=True,
+				adaptive=True, return_n_iter=True)
+		self.assertTrue(np.all(n_iter[:4] > 0))
+		np.testing.assert_array_equal(n_iter[4:], 0)
+		np.testing.assert_allclose(means, expected[0], atol=1e-6)
+
+		# Capped fits never skip a frame, so they catch up with the blobs.
+		means, covars, weights, precs, n_iter = skl_gmm(vid, weighted=True,
+				adaptive=True, cap_tol=1, warm_max_iter=1,
+				return_n_iter=True)
+		np.testing.assert_array_equal(n_iter[1:], 1)
+		np.testing.assert_allclose(means[-1], expected[0][-1], atol=1e-4)
+
+	def test_adaptive_fading_component(self):
+		'''
+		A frame where one blob vanishes explains the remaining pixels as
+		well as before, but the adaptive fit still refits it, because the
+		vanished component lost its share of the intensity.
+		'''
+		vid = np.stack([blob_image([(18, 18), (32, 40)], shape=(50, 60))] * 2
+				+ [blob_image([(18, 18)], shape=(50, 60))] * 2)
+		expected = skl_gmm(vid, weighted=True)
+		means, covars, weights, precs, n_iter = skl_gmm(vid, weighted=True,
+				adaptive=True, return_n_iter=True)
+		self.assertEqual(n_iter[1], 0)
+		self.assertGreater(n_iter[2], 0)
+		np.testing.assert_allclose(weights, expected[2], atol=1e-6)
+		self.assertAlmostEqual(weights[2, 0], 1)
+
+	def test_components(self):
+		'''
+		Light components die, overlapping ones merge into the heavier one
+		and unexplained peaks are born with new identifiers.
+		'''
+		weights = np.array([0.5, 0.3, 0.1995, 0.0005])
+		means = np.array([[20., 20.], [21., 20.], [20., 40.], [5., 5.]])
+		covars = np.tile(np.eye(2) * 4, (4, 1, 1))
+		ids = np.array([0, 1, 2, 3])
+		fit = components.prune_components(weights, means, covars, ids)
+		np.testing.assert_array_equal(fit[3], [0, 1, 2])
+		self.assertAlmostEqual(fit[0].sum(), 1)
+
+		weights, means, covars, ids = components.merge_components(*fit)
+		np.testing.assert_array_equal(ids, [0, 2])
+		np.testing.assert_allclose(means[0], [20.375, 20])
+		self.assertAlmostEqual(covars[0, 0, 0], 4 + 0.375 * 0.625)
+
+		img = blob_image([(20, 20), (20, 40), (30, 30)], shape=(50, 60),
+				peak=150, spread=8)
+		weights, means, covars, ids, next_id = components.spawn_components(
+				img, weights, means, covars, ids, 4, min_distance=5)
+		np.testing.assert_array_equal(ids, [0, 2, 4])
+		np.testing.assert_array_equal(means[2], [30, 30])
+		self.assertEqual(next_id, 5)
+
+	def test_dynamic_skl_gmm(self):
+		'''
+		Dynamic components follow a blob that breaks in two and one that
+		fades away, keeping their columns across frames.
+		'''
+		def frame(t):
+			split = blob_image([(20, 30 - min(t, 10)), (20, 30 + min(t, 10))],
+					shape=(60, 60), peak=100)
+			fading = blob_image([(40, 30)], shape=(60, 60),
+					peak=100 * max(0, 1 - t / 10))
+			return split + fading
+
+		vid = np.stack([frame(t) for t in range(16)])
+		means, covars, weights, precs = skl_gmm(vid, weighted=True,
+				dynamic=True)
+		active = weights > 0
+		self.assertEqual(active[0].sum(), 2)
+		self.assertEqual(active[-1].sum(), 2)
+		# The fading blob's component dies, and one component is born for
+		# each half of the broken blob, whose component then dies too.
+		self.assertEqual(means.shape[1], 4)
+		self.assertTrue(np.isnan(means[-1][~active[-1]]).all())
+		np.testing.assert_allclose(np.sort(means[-1][active[-1]][:, 1]),
+				[20, 40], atol=0.5)
+
+	def test_dynamic_static_video(self):
+		'''
+		Dynamic components of a video that does not change keep their
+		identifiers, even where a component is too wide to predict the
+		peak at its centre.
+		'''
+		centers = [(20, 20), (22, 40), (40, 25), (38, 45)]
+		vid = np.stack([blob_image(centers, shape=(60, 60), peak=90,
+				spread=10)] * 10)
+		means, covars, weights, precs = skl_gmm(vid, weighted=True,
+				dynamic=True, min_distance=5)
+		self.assertEqual(means.shape[1], 4)
+		self.assertTrue(np.all(weights > 0))
+
+		# A sharp peak on a wide blob: the peak is born once, merged back
+		# into the blob, and not born again.
+		img = blob_image([(30, 30)], shape=(60, 60), peak=60, spread=150)
+		img = np.clip(img.astype(int) + blob_image([(30, 35)],
+				shape=(60, 60), peak=120, spread=8), 0, 255).astype(np.uint8)
+		means, covars, weights, precs, n_iter = skl_gmm(
+				np.stack([img] * 20), weighted=True, dynamic=True,
+				min_distance=5, return_n_iter=True)
+		self.assertEqual(means.shape[1], 2)
+		np.testing.assert_array_equal(weights[2:, 1], 0)
+		self.assertTrue(np.all(weights[:, 0] > 0))
+		np.testing.assert_array_equal(n_iter[3:], 1)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -3,10 +3,22 @@ A test suite for the ornet package.
 '''
 #Author: Marcus Hill
 
+import io
 import os
+import tempfile
 import unittest
 
+import imageio
+import numpy as np
+from tqdm import tqdm
+
 import ornet.pipeline as pipeline
+from ornet.track_cells import track_cells
+from ornet.extract_cells import cell_boxes, save_offset, load_offset
+from ornet.framestore import FrameStore, write_frames, prefetch, \
+	open_frames, close_frames
+from ornet.median_normalization import median_normalize, frame_histogram, \
+	histogram_medians
 
 input_path = './data/test_vid.avi'
 out_path = os.path.join('./data', 'outputs')
@@ -22,6 +34,31 @@ tmp_path = os.path.join(out_path, 'tmp')
 
 class Test_Pipeline(unittest.TestCase):
 
+	def test_frame_store(self):
+		'''
+		Tests that frames read back from a store, whole, in part or
+		prefetched, are the frames that were saved.
+		'''
+
+		frames = np.random.RandomState(0).randint(0, 255, size=(70, 9, 11))
+		frames = frames.astype(np.uint8)
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			store_path = os.path.join(tmp_dir, 'frames.npz')
+			write_frames(store_path, frames, chunk_size=32)
+			with FrameStore(store_path) as store:
+				self.assertEqual(store.shape, frames.shape)
+				self.assertTrue(np.array_equal(store[33], frames[33]))
+				self.assertTrue(np.array_equal(store[-1], frames[-1]))
+				self.assertTrue(np.array_equal(store[10:60:7], frames[10:60:7]))
+				self.assertTrue(np.array_equal(np.asarray(store), frames))
+				prefetched = list(prefetch(store, range(1, 70, 3)))
+				self.assertTrue(np.array_equal(prefetched, frames[1::3]))
+			store = open_frames(store_path)
+			close_frames(store)
+			with self.assertRaises(Exception):
+				store[40]
+			close_frames(frames)
+
 	def test_cell_segmentation(self):
 		'''
 		Tests the cell segmentation function defined in track_cells.py.
@@ -45,6 +82,30 @@ class Test_Pipeline(unittest.TestCase):
 
 		self.assertTrue(True)
 
+	def test_histogram_medians(self):
+		'''
+		Tests that the histogram medians and the buffered normalization
+		agree with np.median and the two-pass normalization.
+		'''
+
+		frames = np.random.RandomState(0).randint(0, 40, size=(6, 7, 8))
+		frames = frames.astype(np.uint8)
+		histograms = np.array([frame_histogram(frame) for frame in frames])
+		self.assertTrue(np.array_equal(histogram_medians(histograms, 56),
+				np.array([np.median(frame) for frame in frames], dtype=np.uint8)))
+
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			median_normalize('two_pass', input_path, tmp_dir)
+			median_normalize('buffered', input_path, tmp_dir, buffered=True)
+			self.assertEqual(sorted(os.listdir(tmp_dir)),
+					['buffered.avi', 'two_pass.avi'])
+			readers = [imageio.get_reader(os.path.join(tmp_dir, name))
+					for name in sorted(os.listdir(tmp_dir))]
+			for buffered, two_pass in zip(*readers):
+				self.assertTrue(np.array_equal(buffered, two_pass))
+			for reader in readers:
+				reader.close()
+
 	def test_downsample_vid(self):
 		'''
 		Tests the downsampling function defined in pipeline.py
@@ -65,16 +126,18 @@ class Test_Pipeline(unittest.TestCase):
 		tests the grayscale conversion function defined in cells_to_gray.py.
 		'''
 
-		try:
-			pipeline.generate_single_vids(
-					os.path.join(downsampled_path, vid_name + '.avi'),
-					masks_path, tmp_path)
-			pipeline.convert_to_grayscale(os.path.join(tmp_path, 
-							'test_vid_1.avi'), tmp_path)
-		except:
-			self.assertTrue(False)
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			try:
+				pipeline.generate_single_vids(
+						os.path.join(downsampled_path, vid_name + '.avi'),
+						masks_path, tmp_dir)
+				pipeline.convert_to_grayscale(os.path.join(tmp_dir,
+								'test_vid_1.avi'), tmp_dir)
+			except:
+				self.assertTrue(False)
 
-		self.assertTrue(True)
+			self.assertTrue(os.path.exists(
+					os.path.join(tmp_dir, 'test_vid_1.json')))
 
 	def test_convert_to_grayscale(self):
 		'''
@@ -101,6 +164,18 @@ class Test_Pipeline(unittest.TestCase):
 
 		self.assertTrue(True)
 
+	def test_run_tasks(self):
+		'''
+		Results come back in task order and the progress bar counts every
+		completed call, in this process and in a pool.
+		'''
+		tasks = [(2, i) for i in range(6)]
+		for n_jobs in [1, 2]:
+			progress_bar = tqdm(total=len(tasks), file=io.StringIO())
+			results = pipeline.run_tasks(pow, tasks, n_jobs, progress_bar)
+			self.assertEqual(results, [2 ** i for i in range(6)])
+			self.assertEqual(progress_bar.n, len(tasks))
+
 	def test_compute_distances(self):
 		'''
 		Tests the Jensen-Shannon divergence function defined in affinityfunc.py.
@@ -113,5 +188,118 @@ class Test_Pipeline(unittest.TestCase):
 
 		self.assertTrue(True)
 
+	def test_compute_spectra(self):
+		'''
+		Tests the spectral decomposition of the distance tables.
+		'''
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			failures = pipeline.compute_spectra(distances_path, tmp_dir)
+			self.assertEqual(failures, {})
+			for table in os.listdir(distances_path):
+				spectrum = np.load(os.path.join(tmp_dir,
+						table.split('.')[0] + '.npz'))
+				self.assertEqual(spectrum['eigenvalues'].ndim, 2)
+				self.assertEqual(spectrum['eigenvectors'].ndim, 3)
+
+	def test_sparse_distances(self):
+		'''
+		Tests the sparse distance tables and their spectra.
+		'''
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			failures = pipeline.compute_distances(intermediates_path, tmp_dir,
+					n_neighbors=3)
+			self.assertEqual(failures, {})
+			tables = sorted(os.listdir(tmp_dir))
+			self.assertEqual(tables,
+					sorted(pipeline.distance_table_name(x, n_neighbors=3)
+					for x in os.listdir(intermediates_path)))
+			sparse_spectra = os.path.join(tmp_dir, 'spectra')
+			os.makedirs(sparse_spectra)
+			failures = pipeline.compute_spectra(tmp_dir, sparse_spectra,
+					tables)
+			self.assertEqual(failures, {})
+			for table in tables:
+				spectrum = np.load(os.path.join(sparse_spectra,
+						table.split('.')[0] + '.npz'))
+				self.assertEqual(spectrum['eigenvectors'].ndim, 3)
+
+	def test_stream_single_cells(self):
+		'''
+		Tests the single-decode streaming path defined in pipeline.py.
+		'''
+
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			segments = pipeline.stream_single_cells(vid_name, input_path,
+					os.path.join('data', vid_name + '.vtk'), tmp_dir, tmp_dir)
+			self.assertEqual(segments, 2)
+			for i in range(1, segments + 1):
+				single = os.path.join(tmp_dir, vid_name + '_' + str(i))
+				self.assertTrue(os.path.exists(single + '.avi'))
+				with FrameStore(single + '.npz') as frames:
+					self.assertEqual(frames.ndim, 3)
+				self.assertTrue(os.path.exists(single + '.json'))
+
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			with self.assertRaisesRegex(ValueError, 'test_vid.avi'):
+				pipeline.stream_single_cells(vid_name, input_path,
+						os.path.join('data', vid_name + '.vtk'), tmp_dir,
+						tmp_dir, constrain_count=0)
+
+	def test_failed_video(self):
+		'''
+		A video that fails to be extracted leaves no working directory.
+		'''
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			os.makedirs(os.path.join(tmp_dir, 'outputs', 'work'))
+			summary = pipeline.process_video('test_vid.avi', 'data',
+					os.path.join(tmp_dir, 'no_masks'), tmp_dir)
+			self.assertIsNotNone(summary['error'])
+			self.assertEqual(os.listdir(os.path.join(tmp_dir, 'outputs',
+					'work')), [])
+
+	def test_cell_boxes(self):
+		'''
+		Tests that cells are cropped to the region they cover over the video.
+		'''
+
+		masks = np.zeros((3, 100, 120), dtype=np.uint8)
+		masks[0, 10:20, 30:40] = 1
+		masks[2, 15:25, 50:60] = 1
+		masks[1, 80:90, 100:110] = 2
+		boxes = cell_boxes(masks, 3, padding=5)
+		self.assertEqual(boxes[0], (slice(5, 30), slice(25, 65)))
+		self.assertEqual(boxes[1], (slice(75, 95), slice(95, 115)))
+		self.assertEqual(boxes[2], (slice(0, 100), slice(0, 120)))
+		self.assertEqual(cell_boxes(iter(masks), 3, padding=5), boxes)
+		with self.assertRaises(ValueError):
+			cell_boxes([], 3)
+
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			cell_path = os.path.join(tmp_dir, 'cell.npy')
+			self.assertTrue(np.array_equal(load_offset(cell_path), [0, 0]))
+			save_offset(cell_path, boxes[0])
+			self.assertTrue(np.array_equal(load_offset(cell_path), [5, 25]))
+
+	def test_label_tracking(self):
+		'''
+		Tests that tracking on a label image into a memory-mapped file
+		agrees with the in-memory masks of track_cells. Competitive
+		dilation draws the boundaries between cells slightly differently,
+		so the masks of each cell are compared by their overlap.
+		'''
+
+		vtk_path = os.path.join('data', vid_name + '.vtk')
+		expected = np.array(track_cells(input_path, vtk_path))
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			labels_path = os.path.join(tmp_dir, vid_name + 'MASKS.npy')
+			labels = track_cells(input_path, vtk_path, out_path=labels_path,
+					label_image=True)
+			self.assertEqual(labels.shape, expected.shape)
+			for i in range(1, 3):
+				intersection = np.sum((labels == i) & (expected == i))
+				union = np.sum((labels == i) | (expected == i))
+				self.assertGreater(intersection / union, 0.95)
+			del labels
+
 if __name__ == '__main__':
     unittest.main()
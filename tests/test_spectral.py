@@ -0,0 +1,121 @@
+'''
+Tests for the spectral decomposition of the distance tables in spectral.py.
+'''
+
+import unittest
+
+import numpy as np
+
+from ornet import spectral
+from ornet.affinityfunc import get_all_aff_tables, get_sparse_aff_tables, \
+		cutoff_radius
+
+
+def drifting_tables(frames, k, seed=0):
+	'''
+	Hellinger tables of components that drift slowly over the frames.
+	'''
+	rng = np.random.RandomState(seed)
+	means = rng.uniform(0, 100, size=(1, k, 2)) + np.cumsum(
+			rng.normal(0, 0.3, size=(frames, k, 2)), axis=0)
+	a = rng.normal(0, 3, size=(1, k, 2, 2))
+	covars = np.repeat(a @ np.swapaxes(a, -1, -2) + np.eye(2), frames,
+			axis=0)
+	return get_all_aff_tables(means, covars, 'Hellinger', progress=False)
+
+
+class Test_Spectral(unittest.TestCase):
+
+	def test_batched_matches_frames(self):
+		'''
+		The batched and Lanczos solvers find the eigenvalues of every frame.
+		'''
+		tables = drifting_tables(30, 12)
+		values, vectors = spectral.spectra(tables, n_eigs=3, chunk_size=7)
+		self.assertEqual(values.shape, (30, 3))
+		self.assertEqual(vectors.shape, (30, 12, 3))
+		for t, table in enumerate(tables):
+			expected = np.linalg.eigvalsh(0.5 * (table + table.T))[::-1]
+			np.testing.assert_allclose(values[t], expected[:3])
+			matrix = spectral.graph_matrices(table)
+			np.testing.assert_allclose(matrix @ vectors[t],
+					vectors[t] * values[t], atol=1e-10)
+
+		lanczos = spectral.spectra(tables, n_eigs=3, solver='lanczos')
+		np.testing.assert_allclose(lanczos[0], values)
+		np.testing.assert_allclose(lanczos[1], vectors, atol=1e-8)
+
+	def test_signs_follow_frames(self):
+		'''
+		Eigenvectors keep their orientation from one frame to the next.
+		'''
+		values, vectors = spectral.spectra(drifting_tables(40, 10))
+		overlaps = np.einsum('fkm,fkm->fm', vectors[1:], vectors[:-1])
+		self.assertTrue(np.all(overlaps > 0))
+
+		flipped = vectors * np.sign(np.random.RandomState(1).normal(
+				size=(40, 1, 5)))
+		np.testing.assert_allclose(spectral.align_signs(flipped,
+				vectors[0]), vectors)
+
+	def test_lobpcg_tracks_vectors(self):
+		'''
+		The warm-started LOBPCG solver finds the eigenpairs of every frame
+		and keeps each eigenvector in its column.
+		'''
+		tables = drifting_tables(30, 40)
+		values, vectors = spectral.spectra(tables, n_eigs=4, solver='eigh')
+		tracked, tracked_vectors = spectral.spectra(tables, n_eigs=4,
+				solver='lobpcg')
+		for t, table in enumerate(tables):
+			np.testing.assert_allclose(np.sort(tracked[t]),
+					np.sort(values[t]), rtol=1e-6)
+			matrix = spectral.graph_matrices(table)
+			np.testing.assert_allclose(matrix @ tracked_vectors[t],
+					tracked_vectors[t] * tracked[t], atol=1e-4)
+		overlaps = np.einsum('fkm,fkm->fm', tracked_vectors[1:],
+				tracked_vectors[:-1])
+		self.assertTrue(np.all(overlaps > 0.5))
+
+		order = spectral.match_eigenvectors(vectors[0][:, ::-1],
+				vectors[0])
+		np.testing.assert_array_equal(order, [3, 2, 1, 0])
+
+	def test_sparse_tables(self):
+		'''
+		Sparse tables give the spectra of the dense tables, for either graph.
+		'''
+		rng = np.random.RandomState(3)
+		means = rng.uniform(0, 400, size=(4, 30, 2))
+		covars = np.repeat(np.eye(2)[np.newaxis, np.newaxis] * 4, 30, axis=1)
+		covars = np.repeat(covars, 4, axis=0)
+		dense = get_all_aff_tables(means, covars, 'Hellinger', progress=False)
+		tables = get_sparse_aff_tables(means, covars,
+				radius=cutoff_radius(covars, cutoff=1e-12), progress=False)
+		self.assertLess(tables[0].nnz, 30 * 30)
+		for graph, which in [('affinity', 'largest'),
+				('laplacian', 'smallest')]:
+			expected = spectral.spectra(dense, n_eigs=3, graph=graph,
+					which=which, solver='eigh')
+			for solver in ['auto', 'eigh', 'lobpcg']:
+				actual = spectral.spectra(tables, n_eigs=3, graph=graph,
+						which=which, solver=solver)
+				np.testing.assert_allclose(np.sort(actual[0]),
+						np.sort(expected[0]), atol=1e-6)
+
+	def test_laplacian(self):
+		'''
+		The normalized Laplacian has eigenvalues in [0, 2], with 0 for the
+		connected graph, and absent components are isolated.
+		'''
+		tables = drifting_tables(5, 8)
+		tables[:, 3, :] = tables[:, :, 3] = np.nan
+		laplacian = spectral.graph_matrices(tables, 'laplacian')
+		np.testing.assert_array_equal(laplacian[:, 3], 0)
+		values = np.linalg.eigvalsh(laplacian)
+		self.assertTrue(np.all(values > -1e-10))
+		self.assertTrue(np.all(values < 2 + 1e-10))
+		np.testing.assert_allclose(values[:, :2], 0, atol=1e-10)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -2,13 +2,23 @@
 import os
 import unittest
 
+import test_affinity
+import test_cache
+import test_changepoint
+import test_gmm
 import test_pipeline
+import test_spectral
 
 if __name__ == '__main__':
     loader = unittest.TestLoader()
     suite = unittest.TestSuite()
     suite.addTests([
-        loader.loadTestsFromModule(module=test_pipeline)
+        loader.loadTestsFromModule(module=test_pipeline),
+        loader.loadTestsFromModule(module=test_affinity),
+        loader.loadTestsFromModule(module=test_gmm),
+        loader.loadTestsFromModule(module=test_cache),
+        loader.loadTestsFromModule(module=test_spectral),
+        loader.loadTestsFromModule(module=test_changepoint)
     ])
     runner = unittest.TextTestRunner(warnings='ignore')
     runner.run(suite)